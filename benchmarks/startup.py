@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark lab-gcp startup time for each subcommand.
+
+For every subcommand, times "lab-gcp <command> --help" as shipped (Google Cloud libraries
+imported lazily) and with the Google Cloud libraries and pkg_resources imported up front,
+as every invocation used to do. The difference is the time saved per command.
+
+Usage: python benchmarks/startup.py [--repeat N] [command ...]
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+# Modules that used to be imported by every invocation
+eager_modules = ['googleapiclient.discovery', 'google.cloud.storage', 'pkg_resources']
+
+run_cli = "import sys; sys.argv = ['lab-gcp'] + sys.argv[1:]; from lab_sc_gcp.cli import main; main()"
+
+def time_command(code, args, repeat):
+    # Best of repeat runs in a fresh interpreter, in ms
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-W', 'ignore', '-c', code] + args,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement (best is kept).')
+    parser.add_argument('commands', nargs='*', help='Subcommands to time (defaults to all).')
+    args = parser.parse_args()
+
+    from lab_sc_gcp.cli import create_parser
+    commands = args.commands
+    if not commands:
+        subparsers = [action for action in create_parser()._actions if action.dest == 'command'][0]
+        commands = list(subparsers.choices)
+
+    eager_cli = 'import {}; {}'.format(', '.join(eager_modules), run_cli)
+    baseline = time_command('pass', [], args.repeat)
+    print('Python interpreter startup: {:.0f} ms'.format(baseline))
+    for module in eager_modules:
+        cost = time_command('import {}'.format(module), [], args.repeat) - baseline
+        print('import {}: {:.0f} ms'.format(module, cost))
+    print('')
+
+    print('{:<22}{:>10}{:>10}{:>10}'.format('command', 'lazy', 'eager', 'saved'))
+    for command in ['(none)'] + commands:
+        cli_args = ['--help'] if command == '(none)' else [command, '--help']
+        lazy = time_command(run_cli, cli_args, args.repeat)
+        eager = time_command(eager_cli, cli_args, args.repeat)
+        print('{:<22}{:>7.0f} ms{:>7.0f} ms{:>7.0f} ms'.format(command, lazy, eager, eager - lazy))
+
+if __name__ == '__main__':
+    main()
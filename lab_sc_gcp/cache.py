@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local cache of instance state, so repeated commands can skip API round trips.
+
+Entries are kept per project and zone under ~/.lab_sc_gcp/cache/ and expire after a TTL.
+Any call that changes an instance should invalidate its entry.
+"""
+import json
+import os
+import threading
+import time
+
+from lab_sc_gcp.config.configure import *
+
+config = get_config()
+
+cache_dir = os.path.join(os.path.dirname(user_config), 'cache')
+
+def summarize_instance(instance):
+    # Fields of an instance resource worth keeping between commands
+    nat_ip = None
+    for interface in instance.get('networkInterfaces', []):
+        for access_config in interface.get('accessConfigs', []):
+            nat_ip = nat_ip or access_config.get('natIP')
+    return {
+        'id': instance.get('id'),
+        'name': instance['name'],
+        'status': instance.get('status'),
+        'natIP': nat_ip,
+        'labels': instance.get('labels', {}),
+        'machineType': instance.get('machineType', '').split('/')[-1],
+        'fingerprint': instance.get('fingerprint'),
+        'labelFingerprint': instance.get('labelFingerprint'),
+        'metadataFingerprint': instance.get('metadata', {}).get('fingerprint'),
+        'cached_at': time.time(),
+    }
+
+class InstanceCache(object):
+    """
+    Instance summaries for one project and zone, keyed by instance name.
+    """
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        project,
+        zone,
+        ttl=config['CACHE']['instance_ttl'],
+    ):
+        self.path = os.path.join(cache_dir, 'instances-{}-{}.json'.format(project, zone))
+        self.ttl = float(ttl)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name, max_age=None):
+        """
+        Cached summary of instance, or None if missing or older than max_age (defaults to TTL).
+        """
+        max_age = self.ttl if max_age is None else max_age
+        entry = self._read().get(name)
+        if entry is None or time.time() - entry['cached_at'] > max_age:
+            return None
+        return entry
+
+    def put(self, *instances):
+        # Store summaries of one or more instance resources
+        with self._lock:
+            entries = self._read()
+            for instance in instances:
+                entries[instance['name']] = summarize_instance(instance)
+            self._write(entries)
+        return [entries[instance['name']] for instance in instances]
+
+    def invalidate(self, name=None):
+        # Drop one instance, or all instances in zone if no name given
+        with self._lock:
+            entries = self._read() if name is not None else {}
+            entries.pop(name, None)
+            self._write(entries)
@@ -5,9 +5,12 @@
 Command line interface for interacting with GCP projects, creating and managing instances.
 """
 import argparse
+import atexit
 import os
+import sys
 import time
 
+from lab_sc_gcp import clients
 from lab_sc_gcp.config.configure import *
 from lab_sc_gcp.gce import *
 from lab_sc_gcp.storage import *
@@ -29,6 +32,8 @@ c_CREATE_B = 'create-bucket'
 c_ENABLE = 'enable-apis'
 c_CONF_NETWORK = 'configure-network'
 c_CREATE_SCHED = 'create-schedule'
+c_BOOTSTRAP = 'bootstrap-project'
+c_RUN_SCHED = 'run-schedule'
 
 c_CREATE = 'create-instance'
 c_LIST = 'list-instances'
@@ -38,10 +43,14 @@ c_START = 'start-instance'
 c_SET_MACHINE = 'set-machine-type'
 c_LIST_MACHINES = 'list-machine-types'
 c_SET_TLABEL = 'set-time-label'
+c_PREFETCH_STATUS = 'prefetch-status'
+c_RECOMMEND = 'recommend-machine-type'
 
 c_UPLOAD_LIBS = 'upload-libs'
+c_PULL_LIBS = 'pull-libs'
 c_UPLOAD_DIR_INST = 'upload-dir-instance'
 c_DOWNLOAD_INST = 'download-from-inst'
+c_EXEC = 'exec'
 
 # Globals
 max_inst = 2  # max number of instances allowed at one time
@@ -65,6 +74,11 @@ def create_parser():
         help='Project ID (defaults to project specified in config file). ' +
              'Flag applies to all subcommands.',
     )
+    args.add_argument(
+        '--timings',
+        action='store_true',
+        help='Print time taken by the command and by Google Cloud API calls when done.',
+    )
 
     # Create subcommands
     subargs = args.add_subparsers(dest='command')
@@ -151,9 +165,107 @@ def create_parser():
         help='Start up time for instances in 24 hour format, eg "9:00".',
     )
     parser_create_schedule.add_argument(
+        '--zone',
+        nargs='+',
+        default=[config['GCP']['gcp_zone']],
+        help='Zone(s) of instances managed by schedule (several zones need the python engine).',
+    )
+    parser_create_schedule.add_argument(
+        '--engine',
+        choices=['nodejs', 'python'],
+        default='nodejs',
+        help='Start/stop engine to deploy. The python engine filters instances by label and status ' +
+             'server-side, handles several zones and limits requests in flight (default: nodejs).',
+    )
+
+    # Run schedule subparser
+    parser_run_schedule = subargs.add_parser(
+        c_RUN_SCHED,
+        help="Start or stop all time-managed instances now with the python schedule engine " +
+             "(or load test the engine against a fake compute backend).",
+    )
+    parser_run_schedule.add_argument(
+        'action',
+        choices=['start', 'stop'],
+        help='Action to apply to instances.',
+    )
+    parser_run_schedule.add_argument(
+        '--zone',
+        nargs='+',
+        default=[config['GCP']['gcp_zone']],
+        help='Zone(s) of instances.',
+    )
+    parser_run_schedule.add_argument(
+        '--label',
+        default='env=time-managed',
+        help='Label (key=value, or key) of instances to act on (default: env=time-managed).',
+    )
+    parser_run_schedule.add_argument(
+        '--max-workers',
+        type=int,
+        default=16,
+        help='Maximum number of API requests in flight (default: 16).',
+    )
+    parser_run_schedule.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only list instances that would be started or stopped.',
+    )
+    parser_run_schedule.add_argument(
+        '--fake-instances',
+        type=int,
+        default=None,
+        help='Run against a fake compute backend with this many instances spread over the zones, ' +
+             'for load testing.',
+    )
+    parser_run_schedule.add_argument(
+        '--fake-error-rate',
+        type=float,
+        default=0.0,
+        help='Fraction of fake API requests failing with rate limiting errors (default: 0).',
+    )
+
+    # Bootstrap project subparser
+    parser_bootstrap = subargs.add_parser(
+        c_BOOTSTRAP,
+        help="Set up a new project in one go (create project, link billing, enable APIs, create bucket, " +
+             "configure network and create schedule). Steps already done are skipped.",
+    )
+    parser_bootstrap.add_argument(
+        '--billing-account',
+        required=True,
+        help='Billing account to associate with project (eg. XXXXXX-XXXXXX-XXXXXX).',
+    )
+    parser_bootstrap.add_argument(
+        '--bucket',
+        default=None,
+        help='Name of bucket to create in project (no bucket is created if not given).',
+    )
+    parser_bootstrap.add_argument(
         '--zone',
         default=config['GCP']['gcp_zone'],
-        help='Zone (translated to region) to use for schedule targeting.',
+        help='Zone (translated to region) to use for bucket, subnetwork and schedule targeting.',
+    )
+    parser_bootstrap.add_argument(
+        '--shutdown-time',
+        default="23:59",
+        help='Shutdown time for instances in 24 hour format, eg "23:59".',
+    )
+    parser_bootstrap.add_argument(
+        '--startup-time',
+        default=None,
+        help='Start up time for instances in 24 hour format, eg "9:00".',
+    )
+    parser_bootstrap.add_argument(
+        '--set-default',
+        action='store_true',
+        help='Set the new project (and bucket) as your defaults.',
+    )
+    parser_bootstrap.add_argument(
+        '--engine',
+        choices=['nodejs', 'python'],
+        default='nodejs',
+        help='Start/stop engine to deploy for the schedule (see create-schedule).',
     )
 
 
@@ -193,6 +305,31 @@ def create_parser():
         default=config['GCP']['boot_disk_size'],
         help='Size of boot disk in GB (at least 20).',
     )
+    parser_create_instance.add_argument(
+        '--boot-disk-type',
+        default='pd-standard',
+        choices=['pd-standard', 'pd-balanced', 'pd-ssd'],
+        help='Type of boot disk.',
+    )
+    # Fast volume for libraries, either local SSDs or a persistent data disk
+    data_volume = parser_create_instance.add_mutually_exclusive_group()
+    data_volume.add_argument(
+        '--local-ssds',
+        type=int,
+        default=0,
+        help='Number of local NVMe SSDs (375 GB each) to attach. They are striped together and ' +
+             'mounted for /home/data/libraries. Their contents are lost when the instance is stopped.',
+    )
+    data_volume.add_argument(
+        '--data-disk-type',
+        choices=['pd-standard', 'pd-balanced', 'pd-ssd'],
+        help='Attach a persistent data disk of this type, mounted for /home/data/libraries.',
+    )
+    parser_create_instance.add_argument(
+        '--data-disk-size',
+        default=500,
+        help='Size of data disk in GB (with --data-disk-type).',
+    )
     parser_create_instance.add_argument(
         '--image',
         default=config['GCP']['image'],
@@ -203,6 +340,24 @@ def create_parser():
         default=config['GCP']['image_project'],
         help='Source project for image to use in creating instance.',
     )
+    parser_create_instance.add_argument(
+        '--prefetch-libs',
+        nargs='+',
+        help='Names of libraries or wildcard patterns (quoted, eg. "*BICCN*"), or path to file containing ' +
+             'library names one per line, to download from the bucket to /home/data/libraries while the ' +
+             'instance boots (and again at every start). Check progress with "lab-gcp prefetch-status".',
+    )
+    parser_create_instance.add_argument(
+        '--bucket',
+        default=config['GCP']['bucket'],
+        help='Bucket from which to prefetch libraries.',
+    )
+    parser_create_instance.add_argument(
+        '--wait-ready',
+        action='store_true',
+        help='Wait until the startup script is done and RStudio Server answers, ' +
+             'and print a timeline of the steps.',
+    )
 
     # List instances subparser
     parser_list_instances = subargs.add_parser(
@@ -211,8 +366,13 @@ def create_parser():
     )
     parser_list_instances.add_argument(
         '--zone',
-        default=config['GCP']['gcp_zone'],
-        help='GCP zone to show instances for.',
+        default=None,
+        help='GCP zone to show instances for (defaults to all zones).',
+    )
+    parser_list_instances.add_argument(
+        '--owner',
+        default=None,
+        help='Only show instances belonging to this user.',
     )
 
     # Stop instance subparser
@@ -232,8 +392,20 @@ def create_parser():
     )
     parser_stop_instance.add_argument(
         '--instance',
-        default=config['GCP']['instance_name'],
-        help='Name of instance to stop.',
+        nargs='+',
+        default=[config['GCP']['instance_name']],
+        help='Names of one or more instances to stop.',
+    )
+    parser_stop_instance.add_argument(
+        '--selector',
+        help='Label selector (eg. owner=jdoe or owner=jdoe,env=time-managed) choosing instances ' +
+             'in all zones to stop, instead of --instance.',
+    )
+    parser_stop_instance.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='Send requests concurrently from an asyncio event loop instead of as HTTP batch requests.',
     )
     # Delete instance subparser
     parser_delete_instance = subargs.add_parser(
@@ -252,8 +424,20 @@ def create_parser():
     )
     parser_delete_instance.add_argument(
         '--instance',
-        default=config['GCP']['instance_name'],
-        help='Name of instance to delete.',
+        nargs='+',
+        default=[config['GCP']['instance_name']],
+        help='Names of one or more instances to delete.',
+    )
+    parser_delete_instance.add_argument(
+        '--selector',
+        help='Label selector (eg. owner=jdoe or owner=jdoe,env=time-managed) choosing instances ' +
+             'in all zones to delete, instead of --instance.',
+    )
+    parser_delete_instance.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='Send requests concurrently from an asyncio event loop instead of as HTTP batch requests.',
     )
 
     # Start instance subparser
@@ -273,8 +457,26 @@ def create_parser():
     )
     parser_start_instance.add_argument(
         '--instance',
-        default=config['GCP']['instance_name'],
-        help='Name of instance to start.',
+        nargs='+',
+        default=[config['GCP']['instance_name']],
+        help='Names of one or more instances to start.',
+    )
+    parser_start_instance.add_argument(
+        '--selector',
+        help='Label selector (eg. owner=jdoe or owner=jdoe,env=time-managed) choosing instances ' +
+             'in all zones to start, instead of --instance.',
+    )
+    parser_start_instance.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='Send requests concurrently from an asyncio event loop instead of as HTTP batch requests.',
+    )
+    parser_start_instance.add_argument(
+        '--wait-ready',
+        action='store_true',
+        help='Wait until the startup script is done and RStudio Server answers, ' +
+             'and print a timeline of the steps (single instance only).',
     )
 
     # Set machine type subparser
@@ -313,6 +515,33 @@ def create_parser():
         default=config['GCP']['gcp_zone'],
         help='GCP zone.',
     )
+    parser_list_machines.add_argument(
+        '--min-cpus',
+        type=int,
+        default=0,
+        help='Only list machine types with at least this many vCPUs.',
+    )
+    parser_list_machines.add_argument(
+        '--max-cpus',
+        type=int,
+        default=None,
+        help='Only list machine types with at most this many vCPUs.',
+    )
+    parser_list_machines.add_argument(
+        '--min-mem',
+        default='0',
+        help='Only list machine types with at least this much memory (eg. 100G or 512M, GB if no unit).',
+    )
+    parser_list_machines.add_argument(
+        '--family',
+        default=None,
+        help='Only list machine types of this family (eg. n1, n2, e2).',
+    )
+    parser_list_machines.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Fetch machine types from the API even if they were cached less than a day ago.',
+    )
 
     # Set time-managed label
     parser_set_time_label = subargs.add_parser(
@@ -331,8 +560,20 @@ def create_parser():
     )
     parser_set_time_label.add_argument(
         '--instance',
-        default=config['GCP']['instance_name'],
-        help='Name of instance to set label on.',
+        nargs='+',
+        default=[config['GCP']['instance_name']],
+        help='Names of one or more instances to set label on.',
+    )
+    parser_set_time_label.add_argument(
+        '--selector',
+        help='Label selector (eg. owner=jdoe) choosing instances in all zones to set label on, ' +
+             'instead of --instance.',
+    )
+    parser_set_time_label.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='Send requests concurrently from an asyncio event loop instead of as HTTP batch requests.',
     )
     parser_set_time_label.add_argument(
         '--turn-off',
@@ -340,6 +581,67 @@ def create_parser():
         help='Whether to turn time-management off. (OFF=instance stays on past midnight).',
     )
 
+    # Prefetch status subparser
+    parser_prefetch_status = subargs.add_parser(
+        c_PREFETCH_STATUS,
+        help="Show progress of library prefetch on instance.",
+    )
+    parser_prefetch_status.add_argument(
+        '--user',
+        default=config['LOCAL']['USER'],
+        help='User name to associate with instance.',
+    )
+    parser_prefetch_status.add_argument(
+        '--zone',
+        default=config['GCP']['gcp_zone'],
+        help='GCP zone.',
+    )
+    parser_prefetch_status.add_argument(
+        '--instance',
+        default=config['GCP']['instance_name'],
+        help='Name of instance.',
+    )
+
+    # Recommend machine type subparser
+    parser_recommend = subargs.add_parser(
+        c_RECOMMEND,
+        help="Recommend the cheapest machine type fitting the CPU and memory usage observed on instance.",
+    )
+    parser_recommend.add_argument(
+        '--user',
+        default=config['LOCAL']['USER'],
+        help='User name to associate with instance.',
+    )
+    parser_recommend.add_argument(
+        '--zone',
+        default=config['GCP']['gcp_zone'],
+        help='GCP zone.',
+    )
+    parser_recommend.add_argument(
+        '--instance',
+        default=config['GCP']['instance_name'],
+        help='Name of instance.',
+    )
+    parser_recommend.add_argument(
+        '--headroom',
+        type=float,
+        default=0.2,
+        help='Fraction added on top of observed usage (default: 0.2).',
+    )
+    parser_recommend.add_argument(
+        '--cpu-stat',
+        choices=['p95', 'peak'],
+        default='p95',
+        help='Size vCPUs for the 95th percentile of per minute peaks (default) or for the highest peak.',
+    )
+    parser_recommend.add_argument(
+        '--families',
+        nargs='+',
+        choices=['n1', 'n2'],
+        default=['n1', 'n2'],
+        help='Machine families to consider (default: n1 n2).',
+    )
+
     ### DATA UPLOAD/DOWNLOAD UTILITIES ###
     # Upload libraries to bucket parser
     parser_upload_libs = subargs.add_parser(
@@ -355,7 +657,9 @@ def create_parser():
     parser_upload_libs.add_argument(
         '--libraries',
         required=True,
-        help='Name of library (not full path) to upload or path to file containing library names.\n'+
+        nargs='+',
+        help='Names of libraries (not full paths) or wildcard patterns (quoted, eg. "*BICCN*") to upload, ' +
+             'or path to file containing library names.\n' +
              'If file, libraries must be listed one per line with no other separators.',
     )
     parser_upload_libs.add_argument(
@@ -363,6 +667,55 @@ def create_parser():
         default=config['LOCAL']['lib_dir_sc'],
         help='Path to directory where libraries stored (defaults to /broad/macosko/data/libraries).',
     )
+    parser_upload_libs.add_argument(
+        '--workers',
+        default=config['TRANSFER']['max_workers'],
+        help='Number of files to upload concurrently.',
+    )
+    parser_upload_libs.add_argument(
+        '--max-inflight-mb',
+        default=config['TRANSFER']['max_inflight_mb'],
+        help='Upper bound on the combined size (in MB) of files being uploaded at once.',
+    )
+    parser_upload_libs.add_argument(
+        '--force',
+        action='store_true',
+        help='Upload all files, even those already in the bucket.',
+    )
+    parser_upload_libs.add_argument(
+        '--rescan',
+        action='store_true',
+        help='Scan library directories again instead of using the cached library index.',
+    )
+
+    # Pull libraries from bucket (on instance) parser
+    parser_pull_libs = subargs.add_parser(
+        c_PULL_LIBS,
+        help="Download single cell count libraries from bucket to this machine. " +
+             "Meant to be run on an instance.",
+    )
+    parser_pull_libs.add_argument(
+        '--bucket',
+        default=config['GCP']['bucket'],
+        help='Bucket from which to download libraries. "gs://" prefix is not necessary.',
+    )
+    parser_pull_libs.add_argument(
+        '--libraries',
+        required=True,
+        nargs='+',
+        help='Names of libraries or wildcard patterns (quoted, eg. "*BICCN*"), ' +
+             'or path to file containing library names one per line.',
+    )
+    parser_pull_libs.add_argument(
+        '--dest-dir',
+        default=instance_lib_dir,
+        help='Directory to download libraries to (defaults to {}).'.format(instance_lib_dir),
+    )
+    parser_pull_libs.add_argument(
+        '--workers',
+        default=config['TRANSFER']['max_workers'],
+        help='Number of files to download concurrently.',
+    )
 
     # Upload directory to instance parser
     parser_upload_dir_inst = subargs.add_parser(
@@ -394,6 +747,40 @@ def create_parser():
         default=config['GCP']['instance_name'],
         help='Name of instance to which to upload data.',
     )
+    parser_upload_dir_inst.add_argument(
+        '--mode',
+        default='sync',
+        choices=['sync', 'scp'],
+        help='Only send new or changed files over SSH (default) or copy everything with gcloud scp.',
+    )
+    parser_upload_dir_inst.add_argument(
+        '--delete',
+        action='store_true',
+        help='Delete files on instance that are no longer in the source directory. sync mode only.',
+    )
+    parser_upload_dir_inst.add_argument(
+        '--streams',
+        default=config['TRANSFER']['sync_streams'],
+        help='Number of parallel SSH streams to send files over.',
+    )
+    parser_upload_dir_inst.add_argument(
+        '--compression',
+        default='auto',
+        choices=['auto', 'zstd', 'gzip', 'none'],
+        help='Compression of file streams (auto uses zstd if supported on both ends, else gzip).',
+    )
+    parser_upload_dir_inst.add_argument(
+        '--route',
+        default='auto',
+        choices=['auto', 'ssh', 'bucket'],
+        help='How to send files in sync mode: straight over SSH, through the bucket, or picked from '
+             'their size and number (default).',
+    )
+    parser_upload_dir_inst.add_argument(
+        '--bucket',
+        default=config['GCP']['bucket'],
+        help='Bucket used to stage large transfers.',
+    )
 
     # Download from inst parser
     parser_download_dir_inst = subargs.add_parser(
@@ -425,18 +812,145 @@ def create_parser():
         default=config['GCP']['instance_name'],
         help='Name of instance from which to download data.',
     )
+    parser_download_dir_inst.add_argument(
+        '--mode',
+        default='tar',
+        choices=['tar', 'scp'],
+        help='Stream data as one compressed tar archive over SSH (default) or copy file by file with gcloud scp.',
+    )
+    parser_download_dir_inst.add_argument(
+        '--include',
+        nargs='+',
+        default=None,
+        help='Only download files matching these patterns (file names, or paths relative to source with a /). '
+             'tar mode only.',
+    )
+    parser_download_dir_inst.add_argument(
+        '--exclude',
+        nargs='+',
+        default=None,
+        help='Skip files matching these patterns. tar mode only.',
+    )
+    parser_download_dir_inst.add_argument(
+        '--compression',
+        default='auto',
+        choices=['auto', 'zstd', 'gzip', 'none'],
+        help='Compression of tar stream (auto uses zstd if the zstandard package is installed, else gzip).',
+    )
+    parser_download_dir_inst.add_argument(
+        '--route',
+        default='auto',
+        choices=['auto', 'ssh', 'bucket'],
+        help='How to download files in tar mode: straight over SSH, through the bucket, or picked from '
+             'their size and number (default).',
+    )
+    parser_download_dir_inst.add_argument(
+        '--bucket',
+        default=config['GCP']['bucket'],
+        help='Bucket used to stage large transfers.',
+    )
+
+    # Exec parser
+    parser_exec = subargs.add_parser(
+        c_EXEC,
+        help="Run command on GCP instance over SSH (or open a shell), reusing the connection of earlier "
+             "commands and transfers.",
+    )
+    parser_exec.add_argument(
+        '--user',
+        default=config['LOCAL']['USER'],
+        help='User name to associate with instance.',
+    )
+    parser_exec.add_argument(
+        '--zone',
+        default=config['GCP']['gcp_zone'],
+        help='GCP zone.',
+    )
+    parser_exec.add_argument(
+        '--instance',
+        default=config['GCP']['instance_name'],
+        help='Name of instance to run command on.',
+    )
+    parser_exec.add_argument(
+        '--close',
+        action='store_true',
+        help='Close the open connection to instance instead of running a command.',
+    )
+    parser_exec.add_argument(
+        'remote_command',
+        nargs=argparse.REMAINDER,
+        help='Command to run (put -- before it if it has options). Opens a shell if omitted.',
+    )
 
     return args
 
+def print_timings(command, start_time):
+    print('{} took {:.2f}s. {}'.format(command, time.time() - start_time, clients.timing_summary()))
+
+def library_names(values):
+    # Library names or patterns given on the command line, or read from a file (one per line)
+    if len(values) == 1 and os.path.isfile(values[0]):
+        print('Reading libraries from file.')
+        with open(values[0], 'r') as f:
+            return [lib.strip() for lib in f.read().splitlines() if lib.strip()]
+    return values
+
+def is_batch(parsed_args):
+    # Several instances (or a label selector) go through batch requests or the asyncio engine
+    return bool(parsed_args.selector) or len(parsed_args.instance) > 1 or parsed_args.use_async
+
+def batch_targets(parsed_args, details=False):
+    """
+    Instances named with --instance or chosen with --selector.
+    :param parsed_args:
+    :param details: fetch labels and fingerprints of named instances (selected instances always have them)
+    :return: list of instances (at least name and zone)
+    """
+    if parsed_args.selector:
+        instances = aggregated_list_instances(project=parsed_args.project,
+                                              selector=parsed_args.selector)
+        if not instances:
+            raise RuntimeError('No instances match selector "{}".'.format(parsed_args.selector))
+        return instances
+
+    names = [get_full_inst_name(name, parsed_args.user) for name in parsed_args.instance]
+    if not details:
+        return [{'name': name, 'zone': parsed_args.zone} for name in names]
+    instances, errors = get_instances([(parsed_args.zone, name) for name in names],
+                                      project=parsed_args.project)
+    if errors:
+        raise RuntimeError('Could not get instances:\n' +
+                           '\n'.join('{}: {}'.format(key, error) for key, error in sorted(errors.items())))
+    return instances
+
+def run_batch(action, instances, project, labels=None, use_async=False):
+    # Apply action to all instances, wait on all operations and report the outcome per instance
+    print('Sending {} request(s) for {} instance(s).'.format(action, len(instances)))
+    if use_async:
+        from lab_sc_gcp.gce_async import async_instance_action
+        results = async_instance_action(action, instances, project=project, labels=labels)
+    else:
+        results = batch_instance_action(action, instances, project=project, labels=labels)
+    print(format_results(results))
+    failed = [key for key, error in results.items() if error is not None]
+    if failed:
+        raise RuntimeError('{} of {} instance(s) failed.'.format(len(failed), len(results)))
+    return results
+
 def main():
 
     parsed_args = create_parser().parse_args()
+    if parsed_args.timings:
+        # Registered at exit so timings are also shown if the command fails
+        atexit.register(print_timings, parsed_args.command, time.time())
 
     if parsed_args.command == c_INIT:
         init_defaults()
 
     # Check for necessary defaults in all other cases
-    check_init()
+    # Instances usually have no user config, so pulling libraries only needs a bucket
+    if parsed_args.command != c_PULL_LIBS:
+        check_init()
 
     if parsed_args.command == c_CREATE_P:
         res = create_project(project_id=parsed_args.project,
@@ -465,198 +979,400 @@ def main():
         create_schedule(shutdown_time=parsed_args.shutdown_time,
                         startup_time=parsed_args.startup_time,
                         zone=parsed_args.zone,
-                        project=parsed_args.project)
+                        project=parsed_args.project,
+                        engine=parsed_args.engine)
+
+    if parsed_args.command == c_RUN_SCHED:
+        from lab_sc_gcp.scheduler import ScheduleEngine
+        if parsed_args.fake_instances is not None:
+            from lab_sc_gcp.fake_compute import FakeCompute
+            backend = FakeCompute(zones=parsed_args.zone,
+                                  instances=parsed_args.fake_instances,
+                                  error_rate=parsed_args.fake_error_rate)
+            service_factory = backend.client
+        else:
+            service_factory = lambda: clients.get_service('compute', 'v1')
+        engine = ScheduleEngine(project=parsed_args.project,
+                                service_factory=service_factory,
+                                max_workers=parsed_args.max_workers)
+        report = engine.run(parsed_args.action,
+                            {'zones': parsed_args.zone, 'label': parsed_args.label},
+                            dry_run=parsed_args.dry_run)
+        print(report.summary())
+        if parsed_args.fake_instances is not None:
+            print('Fake backend: {} request(s), {} in flight at most, {} injected error(s).'.format(
+                backend.requests, backend.peak_in_flight, backend.errors))
+        if report.errors:
+            raise RuntimeError('Could not {} {} instance(s).'.format(parsed_args.action, len(report.errors)))
+
+    if parsed_args.command == c_BOOTSTRAP:
+        bootstrap_project(project=parsed_args.project,
+                          billing_account=parsed_args.billing_account,
+                          bucket=parsed_args.bucket,
+                          zone=parsed_args.zone,
+                          shutdown_time=parsed_args.shutdown_time,
+                          startup_time=parsed_args.startup_time,
+                          engine=parsed_args.engine,
+                          set_default=parsed_args.set_default)
+        print("Project {} is ready. You can set user permissions at ".format(parsed_args.project) +
+              "https://console.cloud.google.com/iam-admin/iam?project={}&supportedpurview=project&prefix=".format(parsed_args.project))
 
     if parsed_args.command == c_CREATE:
-        # Check that user has fewer than max instances
+        from lab_sc_gcp.machine_types import validate_machine_type
+        validate_machine_type(parsed_args.machine_type, project=parsed_args.project, zone=parsed_args.zone)
+
+        # Check that user has fewer than max instances (in any zone)
         user = parsed_args.user
-        instances = list_instances(parsed_args.project)
-        curr_user = [inst.get('labels', {}).get('owner') for inst in instances.get('items', [])]
+        user_instances = aggregated_list_instances(parsed_args.project, owner=user, fields='name,zone')
 
-        if curr_user.count(user) >= max_inst:
+        if len(user_instances) >= max_inst:
             raise RuntimeError('You already have {} instances in use. '.format(max_inst) +
                                'Please delete one before creating another.\n' +
-                               'You can see your existing instances with "lab-gcp list instances".')
+                               'You can see your existing instances with "lab-gcp list-instances".')
         # Generate full instance name
         full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
-        curr_names = [inst['name'] for inst in instances.get('items', [])]
-        if full_name in curr_names:
-            raise RuntimeError('An instance with the name {} already exists. '.format(full_name) +
-                               'Please select a different name.')
 
         # TODO: make sure instance name contains no slashes, other breaking chars
         instance_m = GCEInstanceManager(user=parsed_args.user,
                                         name=parsed_args.instance,
                                         project=parsed_args.project,
                                         zone=parsed_args.zone)
+        if instance_m.exists():
+            raise RuntimeError('An instance with the name {} already exists. '.format(full_name) +
+                               'Please select a different name.')
+        prefetch_libs = None
+        if parsed_args.prefetch_libs:
+            if not parsed_args.bucket:
+                raise RuntimeError('No default bucket set. Please provide one with --bucket.')
+            prefetch_libs = library_names(parsed_args.prefetch_libs)
+
+        from lab_sc_gcp.readiness import Timeline, wait_ready
+        timeline = Timeline()
         res = instance_m.create(rstudio_passwd=parsed_args.rpass,
                                 machine_type=parsed_args.machine_type,
                                 boot_disk_size=parsed_args.boot_disk_size,
                                 image=parsed_args.image,
-                                image_project=parsed_args.image_project)
-
-        # In case creation is slow
-        time.sleep(5)
-        instances = list_instances(project=parsed_args.project)
-        nat_ip = [item for item in instances['items']
-                  if item['name'] == full_name][0]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+                                image_project=parsed_args.image_project,
+                                disk_type=parsed_args.boot_disk_type,
+                                local_ssds=parsed_args.local_ssds,
+                                data_disk_type=parsed_args.data_disk_type,
+                                data_disk_size=parsed_args.data_disk_size,
+                                prefetch_libs=prefetch_libs,
+                                bucket=parsed_args.bucket)
+        timeline.mark('create request accepted')
+
+        if parsed_args.wait_ready:
+            instance = wait_ready(instance_m, res, timeline)
+            print(timeline.format())
+        else:
+            # Wait for creation to finish and an external IP to be assigned
+            instance_m.wait_for_operation(res)
+            instance = instance_m.wait_until_running()
         print('Your instance {} has been created.'.format(full_name))
-        print('You can access RStudio Server at http://{}:8787.'.format(nat_ip))
+        print('You can access RStudio Server at http://{}:8787.'.format(get_nat_ip(instance)))
 
 
     if parsed_args.command == c_LIST:
-        # In this case, probably easier for the user to just see list output from google cloud sdk
-        # Could change to call API later
-        sdk_command = ['gcloud', 'compute', 'instances', 'list', '--project', parsed_args.project]
-        call(sdk_command)
+        if parsed_args.zone:
+            instances = list_instances(project=parsed_args.project,
+                                       zone=parsed_args.zone,
+                                       owner=parsed_args.owner)['items']
+        else:
+            instances = aggregated_list_instances(project=parsed_args.project,
+                                                  owner=parsed_args.owner)
+        if instances:
+            print(format_instances(instances))
+        else:
+            print('No instances found.')
 
     if parsed_args.command == c_STOP:
-        instance_m = GCEInstanceManager(user=parsed_args.user,
-                                        name=parsed_args.instance,
-                                        project=parsed_args.project,
-                                        zone=parsed_args.zone)
-        #TODO: Add check to see if instance has already been stopped
-        res = instance_m.stop()
-        full_name = res['targetLink'].split('/')[-1]
-        print('Your instance {} is being stopped. This may take a minute.'.format(full_name))
+        if is_batch(parsed_args):
+            run_batch('stop', batch_targets(parsed_args), parsed_args.project,
+                      use_async=parsed_args.use_async)
+        else:
+            instance_m = GCEInstanceManager(user=parsed_args.user,
+                                            name=parsed_args.instance[0],
+                                            project=parsed_args.project,
+                                            zone=parsed_args.zone)
+            #TODO: Add check to see if instance has already been stopped
+            res = instance_m.stop()
+            full_name = res['targetLink'].split('/')[-1]
+            print('Your instance {} is being stopped. This may take a minute.'.format(full_name))
 
     if parsed_args.command == c_DELETE:
-        # Generate full instance name
-        full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
+        if is_batch(parsed_args):
+            instances = batch_targets(parsed_args)
+            names = ', '.join(sorted(inst['name'] for inst in instances))
+            confirmed = confirm("Are you sure you want to delete {} instance(s): {}? ".format(len(instances), names) +
+                                "The corresponding boot disks will also be deleted.")
+            if confirmed:
+                run_batch('delete', instances, parsed_args.project,
+                          use_async=parsed_args.use_async)
+        else:
+            # Generate full instance name
+            full_name = get_full_inst_name(parsed_args.instance[0], parsed_args.user)
+
+            confirmed = confirm("Are you sure you want to delete instance {}? ".format(full_name) +
+                                "The corresponding boot disk will also be deleted.")
+            if confirmed:
+                instance_m = GCEInstanceManager(user=parsed_args.user,
+                                                name=parsed_args.instance[0],
+                                                project=parsed_args.project,
+                                                zone=parsed_args.zone)
+                res = instance_m.delete()
+                print('Your instance {} is being deleted. This may take a minute.'.format(full_name))
 
-        confirmed = confirm("Are you sure you want to delete instance {}? ".format(full_name) +
-                            "The corresponding boot disk will also be deleted.")
-        if confirmed:
+    if parsed_args.command == c_START:
+        if is_batch(parsed_args):
+            results = run_batch('start', batch_targets(parsed_args), parsed_args.project,
+                                use_async=parsed_args.use_async)
+            # Show external IPs of the started instances
+            started, _ = get_instances([tuple(key.split('/')) for key in sorted(results)],
+                                       project=parsed_args.project)
+            print(format_instances(started))
+        else:
+            # TODO: Add check to see if instance has already been started
             instance_m = GCEInstanceManager(user=parsed_args.user,
-                                            name=parsed_args.instance,
+                                            name=parsed_args.instance[0],
                                             project=parsed_args.project,
                                             zone=parsed_args.zone)
-            res = instance_m.delete()
-            print('Your instance {} is being deleted. This may take a minute.'.format(full_name))
-
-    if parsed_args.command == c_START:
-        # TODO: Add check to see if instance has already been started
-        instance_m = GCEInstanceManager(user=parsed_args.user,
-                                        name=parsed_args.instance,
-                                        project=parsed_args.project,
-                                        zone=parsed_args.zone)
-        res = instance_m.start()
-
-        full_name = res['targetLink'].split('/')[-1]
-        print('Your instance {} is being started. This may take a minute.'.format(full_name))
-        time.sleep(5)
-        instances = list_instances(project=parsed_args.project)
-        nat_ip = [item for item in instances['items']
-                  if item['name'] == full_name][0]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+            from lab_sc_gcp.readiness import Timeline, wait_ready
+            timeline = Timeline()
+            res = instance_m.start()
+            timeline.mark('start request accepted')
+
+            full_name = res['targetLink'].split('/')[-1]
+            print('Your instance {} is being started. This may take a minute.'.format(full_name))
+            if parsed_args.wait_ready:
+                instance = wait_ready(instance_m, res, timeline)
+                print(timeline.format())
+            else:
+                instance_m.wait_for_operation(res)
+                instance = instance_m.wait_until_running()
 
-        print('You can access RStudio Server at http://{}:8787.'.format(nat_ip))
+            print('You can access RStudio Server at http://{}:8787.'.format(get_nat_ip(instance)))
 
     if parsed_args.command == c_SET_MACHINE:
+        from lab_sc_gcp.machine_types import validate_machine_type
+        validate_machine_type(parsed_args.machine_type, project=parsed_args.project, zone=parsed_args.zone)
+
         # Generate full instance name
         full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
 
-        # Check that instance is stopped
-        instances = list_instances(project=parsed_args.project)
-        status = nat_ip = [item for item in instances['items']
-                  if item['name'] == full_name][0]['status']
-        if status != 'TERMINATED':
-            raise RuntimeError('You must stop your instance before changing its machine type. ' +
-                               'If you have recently sent a stop command, wait one or two minutes\n' +
-                               'for the instance to stop fully before trying to set the machine type again.')
-
         instance_m = GCEInstanceManager(user=parsed_args.user,
                                         name=parsed_args.instance,
                                         project=parsed_args.project,
                                         zone=parsed_args.zone)
+
+        # Check that instance is stopped, refreshing cached status if it is not
+        status = instance_m.describe()['status']
+        if status != 'TERMINATED':
+            status = instance_m.describe(max_age=0)['status']
+        if status != 'TERMINATED':
+            raise RuntimeError('You must stop your instance before changing its machine type. ' +
+                               'If you have recently sent a stop command, wait one or two minutes\n' +
+                               'for the instance to stop fully before trying to set the machine type again.')
         res = instance_m.set_machine_type(machine_type=parsed_args.machine_type)
+        instance_m.wait_for_operation(res)
 
         print('The machine type of your instance {} has been updated to {}.'.format(full_name,
                                                                                     parsed_args.machine_type))
 
     if parsed_args.command == c_LIST_MACHINES:
-        # Again use google cloud SDK output
-        sdk_command = ['gcloud', 'compute', 'machine-types',
-                       'list', "--filter=zone:{}".format(parsed_args.zone)]
-        call(sdk_command)
+        from lab_sc_gcp.machine_types import MachineTypeCatalog, parse_memory
+        catalog = MachineTypeCatalog(project=parsed_args.project, zone=parsed_args.zone).load(
+            refresh=parsed_args.refresh)
+        if parsed_args.family and parsed_args.family not in catalog.families():
+            raise RuntimeError('No machine types of family {} in zone {}. Families: {}.'.format(
+                parsed_args.family, parsed_args.zone, ', '.join(catalog.families())))
+        machine_types = catalog.query(min_cpus=parsed_args.min_cpus,
+                                      min_mem_mb=parse_memory(parsed_args.min_mem),
+                                      family=parsed_args.family,
+                                      max_cpus=parsed_args.max_cpus)
+        rows = [[item['name'], item['cpus'], '{:g} GB'.format(round(item['mem_mb'] / 1024.0, 2))]
+                for item in machine_types]
+        print(format_table(rows, ['NAME', 'CPUS', 'MEMORY']))
+        print('{} of {} machine types in zone {} (fetched {:.0f} minutes ago).\n'.format(
+            len(machine_types), len(catalog.machine_types), parsed_args.zone,
+            (time.time() - catalog.fetched_at) / 60))
         print("To specify a custom machine type, use the following format;\n" +
-              "where CPUS is 1 or an even number up to 32 (2, 4, 6, etc), and \n" +
+              "where CPUS is 1 or an even number up to 96 (2, 4, 6, etc), and \n" +
               "MEMORY is the total memory for this instance. Memory must be a \n" +
               "multiple of 256 MB and must be supplied in MB (e.g. 5 GB of memory is 5120 MB):\n" +
-              "custom-CPUS-MEMORY\nFor example: custom-4-5120")
+              "custom-CPUS-MEMORY\nFor example: custom-4-5120\n" +
+              "Custom n2, n2d and e2 machine types are named FAMILY-custom-CPUS-MEMORY (e.g. n2-custom-4-5120).")
 
     if parsed_args.command == c_SET_TLABEL:
         label_value = 'time-unmanaged' if parsed_args.turn_off else 'time-managed'
 
+        if is_batch(parsed_args):
+            run_batch('setLabels', batch_targets(parsed_args, details=True), parsed_args.project,
+                      labels={'env': label_value}, use_async=parsed_args.use_async)
+        else:
+            instance_m = GCEInstanceManager(user=parsed_args.user,
+                                            name=parsed_args.instance[0],
+                                            project=parsed_args.project,
+                                            zone=parsed_args.zone)
+            res = instance_m.set_label(label_key='env',
+                                       label_value=label_value)
+            instance_m.wait_for_operation(res)
+
+            full_name = res['targetLink'].split('/')[-1]
+            print('Your instance {} has been set to {}.'.format(full_name,
+                                                                label_value))
+
+    if parsed_args.command == c_PREFETCH_STATUS:
+        from lab_sc_gcp.readiness import prefetch_status
         instance_m = GCEInstanceManager(user=parsed_args.user,
                                         name=parsed_args.instance,
                                         project=parsed_args.project,
                                         zone=parsed_args.zone)
-        res = instance_m.set_label(label_key='env',
-                                   label_value=label_value)
+        print(prefetch_status(instance_m))
 
-        full_name = res['targetLink'].split('/')[-1]
-        print('Your instance {} has been set to {}.'.format(full_name,
-                                                            label_value))
+    if parsed_args.command == c_RECOMMEND:
+        from lab_sc_gcp.machine_types import recommend_machine_type
+        instance_m = GCEInstanceManager(user=parsed_args.user,
+                                        name=parsed_args.instance,
+                                        project=parsed_args.project,
+                                        zone=parsed_args.zone)
+        report, recommended = recommend_machine_type(instance_m,
+                                                     headroom=parsed_args.headroom,
+                                                     cpu_stat=parsed_args.cpu_stat,
+                                                     families=parsed_args.families)
+        print(report)
+        if recommended is not None:
+            print('To switch, stop the instance and run:\n' +
+                  'lab-gcp set-machine-type --instance {} --zone {} --machine-type {}'.format(
+                      parsed_args.instance, parsed_args.zone, recommended))
 
     if parsed_args.command == c_UPLOAD_LIBS:
-        # As of 2019, storage API does not have native support for recursive upload
-        # Rely on existing gsutil utilities for now
-        # Check if uploading from file
-        if os.path.isdir('{}/{}'.format(parsed_args.library_dir, parsed_args.libraries)):
-            libraries = [parsed_args.libraries]
-        elif os.path.isfile(parsed_args.libraries):
-            print('Reading libraries from file.')
-            with open(parsed_args.libraries, 'r') as f:
-                libraries = f.read().splitlines()
+        # Check if uploading from file (a library of the same name takes precedence)
+        if (len(parsed_args.libraries) == 1 and
+                os.path.isdir(os.path.join(parsed_args.library_dir, parsed_args.libraries[0]))):
+            libraries = parsed_args.libraries
         else:
-            raise RuntimeError('Provided "libraries" must be valid directory or file path.')
-
-        for lib in libraries:
-            # Check if generated by 10x or new pipeline (jp)
-            short_lib = '_'.join(lib.split('_')[1:])
-            if os.path.isdir('{}/{}/outs'.format(parsed_args.library_dir, lib)):
-                upload_libraries_10x(libraries=lib,
-                                     bucket_name=parsed_args.bucket,
-                                     library_dir=parsed_args.library_dir)
-            elif os.path.isfile('{}/{}/{}.bam'.format(parsed_args.library_dir, lib, short_lib)):
-                upload_libraries_jp(libraries=lib,
-                                    bucket_name=parsed_args.bucket,
-                                    library_dir=parsed_args.library_dir)
-            else:
-                warnings.warn('Library {} does not have a recognized output format (10x, jp)'.format(lib) +
-                              ' and is being skipped.', RuntimeWarning)
-
-        # TODO: Check if some libraries have already been uploaded?
-        # gsutil will log directly to console
+            libraries = library_names(parsed_args.libraries)
+
+        # All files of all libraries go through one worker pool
+        report = upload_libraries(libraries=libraries,
+                                  bucket_name=parsed_args.bucket,
+                                  library_dir=parsed_args.library_dir,
+                                  max_workers=parsed_args.workers,
+                                  max_inflight_mb=parsed_args.max_inflight_mb,
+                                  force=parsed_args.force,
+                                  rescan=parsed_args.rescan)
+        if report.failures:
+            raise RuntimeError('{} file(s) failed to upload. '.format(len(report.failures)) +
+                               'Rerun the same command to retry them.')
+
+    if parsed_args.command == c_PULL_LIBS:
+        if not parsed_args.bucket:
+            raise RuntimeError('No default bucket set. Please provide one with --bucket.')
+        libraries = library_names(parsed_args.libraries)
+
+        report = pull_libraries(libraries=libraries,
+                                bucket_name=parsed_args.bucket,
+                                dest_dir=parsed_args.dest_dir,
+                                max_workers=parsed_args.workers)
+        if report.failures:
+            raise RuntimeError('{} file(s) failed to download. '.format(len(report.failures)) +
+                               'Rerun the same command to retry them.')
 
     if parsed_args.command == c_UPLOAD_DIR_INST:
         # Set default destination
-        if parsed_args.dest_path is None:
+        dest_path = parsed_args.dest_path
+        if dest_path is None:
             dest_path = '/home/{}/'.format(parsed_args.user)
 
-        # Generate full instance name
-        full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
-
-        # Could also do this with paramiko instead
-        scp_args = ['gcloud', 'compute', 'scp', '--recurse', parsed_args.source_path,
-                    '{}:{}'.format(full_name, dest_path), '--project', parsed_args.project,
-                    '--zone', parsed_args.zone]
-        call(scp_args)
+        if parsed_args.mode == 'sync':
+            from lab_sc_gcp.instance_transfer import format_sync, sync_upload
+            from lab_sc_gcp.ssh import SSHConnection
+
+            connection = SSHConnection(user=parsed_args.user,
+                                       name=parsed_args.instance,
+                                       project=parsed_args.project,
+                                       zone=parsed_args.zone)
+            stats = sync_upload(connection,
+                                source_path=parsed_args.source_path,
+                                dest_path=dest_path,
+                                delete=parsed_args.delete,
+                                streams=parsed_args.streams,
+                                compression=parsed_args.compression,
+                                route=parsed_args.route,
+                                bucket_name=parsed_args.bucket)
+            print(format_sync(stats))
+        else:
+            if parsed_args.delete:
+                raise RuntimeError('--delete is only supported with --mode sync.')
 
-        # gcloud logs directly to console
+            # Generate full instance name
+            full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
 
-    if parsed_args.command == c_DOWNLOAD_INST:
-        # Generate full instance name
-        full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
+            # Could also do this with paramiko instead
+            scp_args = ['gcloud', 'compute', 'scp', '--recurse', parsed_args.source_path,
+                        '{}:{}'.format(full_name, dest_path), '--project', parsed_args.project,
+                        '--zone', parsed_args.zone]
+            call(scp_args)
 
-        # Could also do this with paramiko instead
-        scp_args = ['gcloud', 'compute', 'scp', '--recurse',
-                    '{}:{}'.format(full_name, parsed_args.source_path), parsed_args.dest_path,
-                    '--project', parsed_args.project,
-                    '--zone', parsed_args.zone]
-        call(scp_args)
+            # gcloud logs directly to console
 
-        # gcloud logs directly to console
+    if parsed_args.command == c_DOWNLOAD_INST:
+        if parsed_args.mode == 'tar':
+            from lab_sc_gcp.instance_transfer import download_from_instance, format_transfer
+            from lab_sc_gcp.ssh import SSHConnection
+
+            connection = SSHConnection(user=parsed_args.user,
+                                       name=parsed_args.instance,
+                                       project=parsed_args.project,
+                                       zone=parsed_args.zone)
+            stats = download_from_instance(connection,
+                                           source_path=parsed_args.source_path,
+                                           dest_path=parsed_args.dest_path,
+                                           include=parsed_args.include,
+                                           exclude=parsed_args.exclude,
+                                           compression=parsed_args.compression,
+                                           route=parsed_args.route,
+                                           bucket_name=parsed_args.bucket)
+            print(format_transfer(stats))
+        else:
+            if parsed_args.include or parsed_args.exclude:
+                raise RuntimeError('--include and --exclude are only supported with --mode tar.')
+
+            # Generate full instance name
+            full_name = get_full_inst_name(parsed_args.instance, parsed_args.user)
+
+            # Could also do this with paramiko instead
+            scp_args = ['gcloud', 'compute', 'scp', '--recurse',
+                        '{}:{}'.format(full_name, parsed_args.source_path), parsed_args.dest_path,
+                        '--project', parsed_args.project,
+                        '--zone', parsed_args.zone]
+            call(scp_args)
+
+            # gcloud logs directly to console
+
+    if parsed_args.command == c_EXEC:
+        from lab_sc_gcp.ssh import SSHConnection
+
+        connection = SSHConnection(user=parsed_args.user,
+                                   name=parsed_args.instance,
+                                   project=parsed_args.project,
+                                   zone=parsed_args.zone)
+        if parsed_args.close:
+            if connection.close():
+                print('Closed connection to instance {}.'.format(connection.name))
+            else:
+                print('No open connection to instance {}.'.format(connection.name))
+        else:
+            remote_command = parsed_args.remote_command
+            if remote_command and remote_command[0] == '--':
+                remote_command = remote_command[1:]
+            connection.ensure_access()
+            # Words are joined like ssh does, so shell syntax (eg. pipes, ~) reaches the remote shell
+            status = connection.call(' '.join(remote_command) if remote_command else None,
+                                     tty=not remote_command)
+            # Pass on exit status of remote command
+            if status != 0:
+                sys.exit(status)
 
 # CLI entry points
 if __name__ == '__main__':
@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared Google Cloud API clients.
+
+API clients are built once per process (per thread when used from worker threads) from the
+discovery documents bundled with google-api-python-client, or from documents fetched once and
+cached on disk for APIs not bundled. All clients share one set of credentials. Discovery based
+clients (compute, resource manager, billing) used in the same thread share one authorized httplib2
+transport, so connections are kept alive across their requests. The Cloud Storage library needs a
+requests session instead, so each thread's storage client gets its own authorized session. Requests
+on both are counted for timing reports.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from lab_sc_gcp.config.configure import *
+
+# On-disk cache for discovery documents that are not bundled with the client library
+discovery_cache_dir = os.path.join(os.path.dirname(user_config), 'discovery')
+# Discovery documents are refreshed after this many seconds
+discovery_cache_ttl = 7 * 24 * 3600
+
+# httplib2 transports are not thread safe, so these are kept per thread
+_local = threading.local()
+_lock = threading.Lock()
+_credentials = None
+_default_project = None
+
+# Counters for timing reports
+stats = {
+    'clients_built': 0,
+    'build_seconds': 0.0,
+    'requests': 0,
+    'request_seconds': 0.0,
+    'storage_requests': 0,
+    'storage_request_seconds': 0.0,
+}
+
+def _record(count_key, seconds_key, seconds):
+    with _lock:
+        stats[count_key] += 1
+        stats[seconds_key] += seconds
+
+class DiscoveryFileCache(object):
+    """
+    Discovery document cache on disk, with the interface expected by googleapiclient.
+    """
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) < discovery_cache_ttl:
+                with open(path, 'r') as f:
+                    return f.read()
+        except (IOError, OSError):
+            pass
+        return None
+
+    def set(self, url, content):
+        os.makedirs(discovery_cache_dir, exist_ok=True)
+        path = self._path(url)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _path(url):
+        return os.path.join(discovery_cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+def get_credentials():
+    # Application default credentials, loaded (and refreshed) once for all clients
+    global _credentials, _default_project
+    with _lock:
+        if _credentials is None:
+            import google.auth
+            _credentials, _default_project = google.auth.default()
+    return _credentials
+
+def get_http():
+    """
+    Authorized HTTP transport for the current thread, shared by all API clients built in it.
+    """
+    http = getattr(_local, 'http', None)
+    if http is None:
+        import httplib2
+        import google_auth_httplib2
+
+        class TimedHttp(google_auth_httplib2.AuthorizedHttp):
+            # Count requests and time spent waiting on them
+            def request(self, *args, **kwargs):
+                start = time.time()
+                try:
+                    return super(TimedHttp, self).request(*args, **kwargs)
+                finally:
+                    _record('requests', 'request_seconds', time.time() - start)
+
+        http = TimedHttp(get_credentials(), http=httplib2.Http(timeout=60))
+        _local.http = http
+    return http
+
+def get_storage_session():
+    """
+    Authorized requests session for the current thread's Cloud Storage client.
+    """
+    session = getattr(_local, 'storage_session', None)
+    if session is None:
+        from google.auth.transport.requests import AuthorizedSession
+
+        class TimedSession(AuthorizedSession):
+            # Count requests and time spent waiting on them (including transfers of object data)
+            def request(self, *args, **kwargs):
+                start = time.time()
+                try:
+                    return super(TimedSession, self).request(*args, **kwargs)
+                finally:
+                    _record('storage_requests', 'storage_request_seconds', time.time() - start)
+
+        session = TimedSession(get_credentials())
+        _local.storage_session = session
+    return session
+
+def get_service(name, version):
+    """
+    API client for a discovery based API (eg. compute v1), built once per thread.
+    :param name: API name
+    :param version: API version
+    :return: googleapiclient Resource
+    """
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    if (name, version) not in services:
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import UnknownApiNameOrVersion
+
+        start = time.time()
+        http = get_http()
+        try:
+            # Bundled discovery document, no network round trip
+            service = build(name, version, http=http, static_discovery=True)
+        except TypeError:
+            # google-api-python-client < 2.0 does not bundle discovery documents
+            service = build(name, version, http=http, cache=DiscoveryFileCache())
+        except UnknownApiNameOrVersion:
+            service = build(name, version, http=http, cache=DiscoveryFileCache(), static_discovery=False)
+        _record('clients_built', 'build_seconds', time.time() - start)
+        services[(name, version)] = service
+    return services[(name, version)]
+
+def get_storage_client():
+    """
+    Cloud Storage client for the current thread, sharing credentials with the other clients
+    (see get_storage_session).
+    """
+    client = getattr(_local, 'storage_client', None)
+    if client is None:
+        from google.cloud import storage
+
+        start = time.time()
+        credentials = get_credentials()
+        project = get_config()['GCP']['gcp_project_id'] or _default_project
+        client = storage.Client(project=project, credentials=credentials, _http=get_storage_session())
+        _record('clients_built', 'build_seconds', time.time() - start)
+        _local.storage_client = client
+    return client
+
+def timing_summary():
+    return ('{} API client(s) built in {:.2f}s, {} API request(s) taking {:.2f}s, '
+            '{} storage request(s) taking {:.2f}s.'.format(
+                stats['clients_built'], stats['build_seconds'], stats['requests'], stats['request_seconds'],
+                stats['storage_requests'], stats['storage_request_seconds']))
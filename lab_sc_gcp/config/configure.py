@@ -8,20 +8,22 @@ Configure defaults and user settings for package.
 import os
 import shutil
 import configparser
-from pkg_resources import resource_filename
 from pathlib import Path
 from subprocess import call
 from lab_sc_gcp.utilities import *
-from googleapiclient.discovery import build
-from google.cloud import storage
 
 # Config paths
-default_config = resource_filename('lab_sc_gcp', 'config/config.ini')
+default_config = package_path('config', 'config.ini')
 user_config = os.path.join(Path.home(), '.lab_sc_gcp', 'config.ini')
 
+# Parsed config, shared by all modules in the process
+_config = None
+
 # A few project and bucket related functions
+# Google Cloud libraries are imported where needed as they are slow to import
 def list_projects():
-    service = build('cloudresourcemanager', 'v1')
+    from lab_sc_gcp.clients import get_service
+    service = get_service('cloudresourcemanager', 'v1')
     projects = service.projects()
 
     res = projects.list().execute()
@@ -29,7 +31,8 @@ def list_projects():
     return res
 
 def list_buckets(project):
-    storage_client = storage.Client()
+    from lab_sc_gcp.clients import get_storage_client
+    storage_client = get_storage_client()
     buckets = storage_client.list_buckets(project=project)
 
     return [bucket.name for bucket in buckets]
@@ -46,18 +49,21 @@ def generate_config():
         print('Created user config file {}.\n\n'.format(user_config))
 
 def get_config():
-    # First generate user config file if necessary
-    generate_config()
-    # Read config
-    config = configparser.SafeConfigParser(allow_no_value=True)
-    config.read(user_config)
-
-    return config
+    global _config
+    # Only parse config once per process
+    if _config is None:
+        # First generate user config file if necessary
+        generate_config()
+        # Read config, falling back to package defaults for sections added since the
+        # user config file was created
+        _config = configparser.ConfigParser(allow_no_value=True)
+        _config.read([default_config, user_config])
+
+    return _config
 
 def check_init():
     # Check initialization of important defaults
-    config = configparser.SafeConfigParser(allow_no_value=True)
-    config.read(user_config)
+    config = get_config()
 
     if '' in [config['LOCAL']['user'],
               config['LOCAL']['lib_dir_sc'],
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory stand-in for the parts of the Compute Engine API used by the schedule engine, for
+load testing it locally with thousands of instances.
+
+Requests take a configurable latency, a fraction of them fail with rate limiting errors, and
+start/stop operations finish after a configurable time. Request counts and the peak number of
+requests in flight are recorded, so the engine's concurrency bound can be checked.
+"""
+import itertools
+import random
+import re
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+_filter_term = re.compile(r'\((labels\.[\w-]+|status) *(?::\*|= *"([^"]*)")\)')
+_filter_token = re.compile(r'\s*(?:(?P<term>\((?:labels\.[\w-]+|status) *(?::\*|= *"[^"]*")\))|'
+                           r'(?P<op>AND|OR)\b|(?P<paren>[()]))')
+
+def _term_matches(instance, term):
+    field, value = _filter_term.fullmatch(term).groups()
+    if field.startswith('labels.'):
+        actual = instance['labels'].get(field.split('.', 1)[1])
+    else:
+        actual = instance['status']
+    return actual is not None if value is None else actual == value
+
+def matches(instance, filter):
+    """
+    Whether instance matches a filter: (field = "value") and (labels.key:*) terms combined with AND,
+    OR (AND binds tighter, like in the Compute API), juxtaposition (AND) and parentheses.
+    Raises ValueError for anything else, so filters the API would reject fail here too.
+    """
+    tokens, pos = [], 0
+    filter = (filter or '').strip()
+    while pos < len(filter):
+        match = _filter_token.match(filter, pos)
+        if match is None:
+            raise ValueError('Invalid filter at {!r}'.format(filter[pos:]))
+        if match.group('term'):
+            if tokens and tokens[-1] not in ('and', 'or', '('):
+                tokens.append('and')
+            tokens.append(str(_term_matches(instance, match.group('term'))))
+        elif match.group('op'):
+            tokens.append(match.group('op').lower())
+        else:
+            if match.group('paren') == '(' and tokens and tokens[-1] not in ('and', 'or', '('):
+                tokens.append('and')
+            tokens.append(match.group('paren'))
+        pos = match.end()
+    if not tokens:
+        return True
+    try:
+        return bool(eval(' '.join(tokens), {'__builtins__': {}}))
+    except SyntaxError:
+        raise ValueError('Invalid filter {!r}'.format(filter))
+
+class FakeRequest(object):
+    def __init__(self, backend, func):
+        self.backend = backend
+        self.func = func
+
+    def execute(self):
+        return self.backend.call(self.func)
+
+class FakeBatch(object):
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # One round trip for the whole batch, each call may fail on its own
+        self.backend.call(lambda: None)
+        for request_id, request in self.requests:
+            try:
+                response = self.backend.call(request.func, latency=False)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+class FakeCompute(object):
+    """
+    Shared state of the fake API. Use client() as the service factory.
+    """
+    def __init__(
+        self,
+        zones=('us-east1-b',),
+        instances=1000,
+        labeled_fraction=0.8,
+        running_fraction=0.9,
+        latency=0.05,
+        error_rate=0.0,
+        operation_seconds=2.0,
+        seed=0,
+    ):
+        """
+        :param zones: zones instances are spread over
+        :param instances: number of instances
+        :param labeled_fraction: fraction of instances with the env=time-managed label
+        :param running_fraction: fraction of instances running at the start
+        :param latency: seconds taken by each request
+        :param error_rate: fraction of requests failing with HTTP 429
+        :param operation_seconds: seconds taken by start/stop operations
+        """
+        self.rand = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.operation_seconds = operation_seconds
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.operation_ids = itertools.count()
+        self.operations = {}
+        self.instances = {}
+        for i in range(instances):
+            zone = zones[i % len(zones)]
+            labels = {'env': 'time-managed'} if self.rand.random() < labeled_fraction else {}
+            status = 'RUNNING' if self.rand.random() < running_fraction else 'TERMINATED'
+            self.instances[(zone, 'instance-{:05d}'.format(i))] = {'name': 'instance-{:05d}'.format(i),
+                                                                   'zone': zone,
+                                                                   'labels': labels,
+                                                                   'status': status}
+
+    def call(self, func, latency=True):
+        # Run an API call, with latency and injected errors
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            fail = self.rand.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        try:
+            if latency:
+                time.sleep(self.latency)
+            if fail:
+                raise HttpError(httplib2.Response({'status': 429}), b'Rate limit exceeded')
+            with self.lock:
+                return func()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def client(self):
+        return FakeComputeClient(self)
+
+    def status_counts(self, label=('env', 'time-managed')):
+        # Number of labeled instances per status
+        counts = {}
+        for instance in self.instances.values():
+            if instance['labels'].get(label[0]) == label[1]:
+                self._refresh(instance)
+                counts[instance['status']] = counts.get(instance['status'], 0) + 1
+        return counts
+
+    def _refresh(self, instance):
+        # Finish instance transition once its operation is done
+        operation = instance.get('operation')
+        if operation is not None and self._operation(operation)['status'] == 'DONE':
+            instance['status'] = operation['target_status']
+            del instance['operation']
+
+    def _operation(self, operation):
+        done = time.time() - operation['started'] >= self.operation_seconds
+        return {'name': operation['name'],
+                'zone': operation['zone'],
+                'operationType': operation['type'],
+                'status': 'DONE' if done else 'RUNNING'}
+
+    def _list(self, zone, filter=None, maxResults=500, pageToken=None, **kwargs):
+        names = []
+        for (instance_zone, name), instance in self.instances.items():
+            if instance_zone == zone:
+                self._refresh(instance)
+                if matches(instance, filter):
+                    names.append(name)
+        names.sort()
+        start = int(pageToken or 0)
+        page = names[start:start + maxResults]
+        res = {'items': [{'name': name, 'status': self.instances[(zone, name)]['status']} for name in page]}
+        if start + maxResults < len(names):
+            res['nextPageToken'] = str(start + maxResults)
+        return res
+
+    def _transition(self, zone, instance, op_type, target_status):
+        try:
+            state = self.instances[(zone, instance)]
+        except KeyError:
+            raise HttpError(httplib2.Response({'status': 404}), b'Instance not found')
+        operation = {'name': 'operation-{}'.format(next(self.operation_ids)),
+                     'zone': zone,
+                     'type': op_type,
+                     'target_status': target_status,
+                     'started': time.time()}
+        self.operations[operation['name']] = operation
+        state['status'] = 'STOPPING' if op_type == 'stop' else 'STAGING'
+        state['operation'] = operation
+        return self._operation(operation)
+
+class FakeComputeClient(object):
+    """
+    Per-thread view of FakeCompute with the googleapiclient call structure.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def instances(self):
+        backend = self.backend
+
+        class Instances(object):
+            def list(self, project, zone, **kwargs):
+                return FakeRequest(backend, lambda: backend._list(zone, **kwargs))
+
+            def start(self, project, zone, instance):
+                return FakeRequest(backend, lambda: backend._transition(zone, instance, 'start', 'RUNNING'))
+
+            def stop(self, project, zone, instance):
+                return FakeRequest(backend, lambda: backend._transition(zone, instance, 'stop', 'TERMINATED'))
+
+        return Instances()
+
+    def zoneOperations(self):
+        backend = self.backend
+
+        class ZoneOperations(object):
+            def get(self, project, zone, operation):
+                return FakeRequest(backend, lambda: backend._operation(backend.operations[operation]))
+
+        return ZoneOperations()
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self.backend, callback)
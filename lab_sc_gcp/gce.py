@@ -6,13 +6,226 @@ Functions for managing Google Compute Engine (GCE) resources.
 
 Code referenced from Deverman lab pipeline repo (author Albert Chen).
 """
-from googleapiclient.discovery import build
-from pkg_resources import resource_filename
+from lab_sc_gcp.cache import InstanceCache, summarize_instance
+from lab_sc_gcp.clients import get_service
 from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.operations import execute_batch, poll, wait_for_operation, wait_for_operations
 from lab_sc_gcp.utilities import *
 
 config = get_config()
 
+# Partial response fields for instance listings (enough for tables and the instance cache)
+instance_fields = ('id,name,zone,status,machineType,labels,labelFingerprint,fingerprint,'
+                   'networkInterfaces/accessConfigs/natIP')
+
+# Guest attribute namespace the startup script reports progress under
+guest_namespace = 'lab-sc-gcp'
+
+def render_startup_script(user, rstudio_passwd):
+    # Read basic start-up script and fill in template variables
+    with open(package_path('startup', 'script_template.sh'), 'r') as f:
+        startup_script = f.read()
+    startup_script = startup_script.replace("${USER}", user)
+    startup_script = startup_script.replace("${R_PASS}", rstudio_passwd)
+    return startup_script
+
+def instance_body(
+    name,
+    user,
+    zone,
+    rstudio_passwd,
+    machine_type=config['GCP']['machine_type'],
+    boot_disk_size=config['GCP']['boot_disk_size'],
+    image=config['GCP']['image'],
+    image_project=config['GCP']['image_project'],
+    disk_type='pd-standard',
+    local_ssds=0,
+    data_disk_type=None,
+    data_disk_size=500,
+    prefetch_libs=None,
+    bucket=config['GCP']['bucket'],
+):
+    """
+    Request body for inserting a new RStudio instance.
+    :param name: full instance name
+    :param user: owner of instance
+    :param zone:
+    :param rstudio_passwd: RStudio Server password for user
+    :param machine_type:
+    :param boot_disk_size: in GB
+    :param image:
+    :param image_project:
+    :param disk_type: boot disk type
+    :param local_ssds: number of local NVMe SSDs (375 GB each) to attach as scratch space
+    :param data_disk_type: type of additional persistent data disk (eg. pd-ssd), None for no data disk
+    :param data_disk_size: size of data disk in GB
+    :param prefetch_libs: list of library names or patterns for the startup script to download from bucket
+    :param bucket: bucket to prefetch libraries from
+    :return: instance resource
+    """
+    startup_script = render_startup_script(user, rstudio_passwd)
+
+    # Convert compute region zone to region (works for most zones)
+    region = '-'.join(zone.split('-')[:-1])
+
+    # http://googleapis.github.io/google-api-python-client/docs/dyn/compute_v1.instances.html#insert
+    body = {
+        "labels": {
+            "env": "time-managed",  # shuts off every night at midnight
+            "owner": user,  # keep track of who's using compute resources
+        },
+        'scheduling': {
+            'preemptible': False,
+            'automaticRestart': False,
+            'onHostMaintenance': 'MIGRATE'
+        },
+        # 'minCpuPlatform': 'Intel Skylake',
+        'serviceAccounts': [{
+            'scopes': [
+                # Allows instance to manage itself and other instances
+                'https://www.googleapis.com/auth/compute',
+                # Allows instance to manage storage engine (bucket) resources
+                'https://www.googleapis.com/auth/devstorage.full_control',
+                # For logging to stackdriver
+                'https://www.googleapis.com/auth/logging.write',
+                'https://www.googleapis.com/auth/monitoring',
+                'https://www.googleapis.com/auth/monitoring.write'
+            ],
+            # Defaults to basic compute engine service account
+        }],
+        # IP access
+        'networkInterfaces': [{
+            # Assumes managed network already created
+            'network': 'global/networks/managed',
+            'accessConfigs': [{
+                'name': 'External NAT',
+                'networkTier': 'PREMIUM',  # STANDARD or PREMIUM
+                "kind": "compute#accessConfig",
+                "type": "ONE_TO_ONE_NAT",
+            }],
+            # 'networkIP': '', # IPv4 internal IP address. If not specified by the user,
+            # an unused internal IP is assigned by the system.
+            # 'fingerprint': '',
+            # Assumes appropriate subnet (managed-subnet) has already been created in same zone
+            'subnetwork': '/regions/{}/subnetworks/managed-subnet'.format(region),
+        }],
+        # 'hostname': hostname,
+        'metadata': {
+            'items': [
+                {
+                    'key': 'startup-script',
+                    'value': startup_script,
+                },
+                {
+                    # Lets the startup script report progress (see readiness.py)
+                    'key': 'enable-guest-attributes',
+                    'value': 'TRUE',
+                },
+            ]
+            # 'fingerprint': '' # get fingerprint??
+        },
+        'deletionProtection': False,
+        'canIpForward': False,
+        'description': "",
+        'tags': {
+            # 'allow-http' is the name of a custom firewall rule
+            'items': ['allow-http', ],
+        },
+        # 'labelFingerprint': ''
+        # in the format: zones/<zone>/machineTypes/<machine-type>
+        # To create a custom machine type, provide a URL to a machine type in the following format,
+        # where CPUS is 1 or an even number up to 32 (2, 4, 6, ... 24, etc), and MEMORY is the total memory
+        # for this instance. Memory must be a multiple of 256 MB and must be supplied in MB
+        # (e.g. 5 GB of memory is 5120 MB):
+        # zones/zone/machineTypes/custom-CPUS-MEMORY
+        # For example: zones/us-central1-f/machineTypes/custom-4-5120
+        'machineType': 'zones/{zone}/machineTypes/{machine_type}'.format(zone=zone,
+                                                                         machine_type=machine_type),
+        'name': name,
+        'disks': [
+            {
+                # 'diskEncryptionKey': '', # If we ever encrypt our disk
+                # 'deviceName': '', # For persistent disks
+                # Parameters for a new disk that will be created alongside the instance
+                # Mutually exclusive with the "source" parameter
+                'initializeParams': {
+                    # 'sourceSnapshot': '', # Use a snapshot to create this disk
+                    # 'diskName': '', # Unique disk name - will be generated if not provided
+                    # 'description: '', # Optional disk description
+                    # 'labels': { 'key': 'value' }, # Optional labels for this disk
+                    # Disk type choices:
+                    # pd-standard: disk drive, standard i/o
+                    # pd-ssd: solid-state drive
+                    # local-ssd: solid-state drive, directly wired to the hardware. very fast
+                    # Specify with the partial URL: zones/<zone>/diskTypes/<diskType>
+                    'diskType': 'zones/{zone}/diskTypes/{disk_type}'.format(zone=zone,
+                                                                            disk_type=disk_type),
+                    'diskSizeGb': boot_disk_size,
+                    # You can also specify a custom image by its image family,
+                    # which returns the latest version of the image in that family.
+                    # Replace the image name with family/family-name:
+                    # global/images/family/my-image-family
+                    #
+                    # Use the specified custom image.
+                    'sourceImage': 'projects/{}/global/images/{}'.format(image_project,
+                                                                         image)
+                },
+                'autoDelete': True,  # Delete the disk when the instance is deleted
+                'boot': True,  # This is a boot disk
+                'mode': 'READ_WRITE',  # READ_ONLY or READ_WRITE
+                'interface': 'SCSI',  # SCSI or NVME. Only local SSDs can use NVME
+                'type': 'PERSISTENT',  # SCRATCH or PERSISTENT
+                # 'source': '' # Full or partial URL to an existing disk instance
+            },
+        ]  # END DISKS
+    }  # END BODY
+    # The startup script builds the libraries volume from these disks
+    body['disks'].extend(data_disks(zone, local_ssds, data_disk_type, data_disk_size))
+
+    if prefetch_libs:
+        # Downloaded in the background by the startup script at every boot
+        body['metadata']['items'].extend([
+            {'key': 'prefetch-libs', 'value': ' '.join(prefetch_libs)},
+            {'key': 'prefetch-bucket', 'value': bucket},
+        ])
+
+    return body
+
+def data_disks(zone, local_ssds=0, data_disk_type=None, data_disk_size=500):
+    """
+    Disks to attach to a new instance in addition to its boot disk.
+    :param zone:
+    :param local_ssds: number of local NVMe SSDs (scratch, contents lost when instance is stopped)
+    :param data_disk_type: type of persistent data disk (pd-standard, pd-balanced or pd-ssd), None for none
+    :param data_disk_size: size of data disk in GB
+    :return: list of attached disks
+    """
+    disks = []
+    for _ in range(int(local_ssds)):
+        disks.append({
+            'initializeParams': {
+                'diskType': 'zones/{}/diskTypes/local-ssd'.format(zone),
+            },
+            'autoDelete': True,
+            'boot': False,
+            'interface': 'NVME',
+            'type': 'SCRATCH',
+        })
+    if data_disk_type:
+        disks.append({
+            # Shows up on the instance as /dev/disk/by-id/google-data
+            'deviceName': 'data',
+            'initializeParams': {
+                'diskType': 'zones/{}/diskTypes/{}'.format(zone, data_disk_type),
+                'diskSizeGb': data_disk_size,
+            },
+            'autoDelete': True,
+            'boot': False,
+            'mode': 'READ_WRITE',
+            'type': 'PERSISTENT',
+        })
+    return disks
+
 class GCEInstanceManager(object):
     """
     Basic class for compute engine instance interaction.
@@ -38,7 +251,9 @@ class GCEInstanceManager(object):
 
         # http://googleapis.github.io/google-api-python-client/docs/dyn/compute_v1.html
         # Authenticate with SDK credentials, may replace with service account authentication later
-        self.connection = build('compute', 'v1').instances()
+        self.connection = get_service('compute', 'v1').instances()
+        # Local state cache, invalidated by every call that changes the instance
+        self.cache = InstanceCache(project, zone)
 
     def create(
         self,
@@ -48,136 +263,109 @@ class GCEInstanceManager(object):
         image=config['GCP']['image'],
         image_project=config['GCP']['image_project'],
         disk_type='pd-standard',
+        local_ssds=0,
+        data_disk_type=None,
+        data_disk_size=500,
+        prefetch_libs=None,
+        bucket=config['GCP']['bucket'],
     ):
-        # Read basic start-up script
-        with open(resource_filename('lab_sc_gcp', 'startup/script_template.sh'), 'r') as f:
-            startup_script = f.read()
-            startup_script = startup_script.replace("${USER}", self.user)
-            startup_script = startup_script.replace("${R_PASS}", rstudio_passwd)
-
-        # Convert compute region zone to region (works for most zones)
-        region = '-'.join(self.zone.split('-')[:-1])
-
-        # http://googleapis.github.io/google-api-python-client/docs/dyn/compute_v1.instances.html#insert
         req = self.connection.insert(
             project=self.project,
             zone=self.zone,
-            body={
-                "labels": {
-                    "env": "time-managed",  # shuts off every night at midnight
-                    "owner": self.user,  # keep track of who's using compute resources
-                },
-                'scheduling': {
-                    'preemptible': False,
-                    'automaticRestart': False,
-                    'onHostMaintenance': 'MIGRATE'
-                },
-                # 'minCpuPlatform': 'Intel Skylake',
-                'serviceAccounts': [{
-                    'scopes': [
-                        # Allows instance to manage itself and other instances
-                        'https://www.googleapis.com/auth/compute',
-                        # Allows instance to manage storage engine (bucket) resources
-                        'https://www.googleapis.com/auth/devstorage.full_control',
-                        # For logging to stackdriver
-                        'https://www.googleapis.com/auth/logging.write',
-                        'https://www.googleapis.com/auth/monitoring',
-                        'https://www.googleapis.com/auth/monitoring.write'
-                    ],
-                    # Defaults to basic compute engine service account
-                }],
-                # IP access
-                'networkInterfaces': [{
-                    # Assumes managed network already created
-                    'network': 'global/networks/managed',
-                    'accessConfigs': [{
-                        'name': 'External NAT',
-                        'networkTier': 'PREMIUM',  # STANDARD or PREMIUM
-                        "kind": "compute#accessConfig",
-                        "type": "ONE_TO_ONE_NAT",
-                    }],
-                    # 'networkIP': '', # IPv4 internal IP address. If not specified by the user,
-                    # an unused internal IP is assigned by the system.
-                    # 'fingerprint': '',
-                    # Assumes appropriate subnet (managed-subnet) has already been created in same zone
-                    'subnetwork': '/regions/{}/subnetworks/managed-subnet'.format(region),
-                }],
-                # 'hostname': hostname,
-                'metadata': {
-                    'items': [
-                        {
-                            'key': 'startup-script',
-                            'value': startup_script,
-                        }
-                    ]
-                    # 'fingerprint': '' # get fingerprint??
-                },
-                'deletionProtection': False,
-                'canIpForward': False,
-                'description': "",
-                'tags': {
-                    # 'allow-http' is the name of a custom firewall rule
-                    'items': ['allow-http', ],
-                },
-                # 'labelFingerprint': ''
-                # in the format: zones/<zone>/machineTypes/<machine-type>
-                # To create a custom machine type, provide a URL to a machine type in the following format,
-                # where CPUS is 1 or an even number up to 32 (2, 4, 6, ... 24, etc), and MEMORY is the total memory
-                # for this instance. Memory must be a multiple of 256 MB and must be supplied in MB
-                # (e.g. 5 GB of memory is 5120 MB):
-                # zones/zone/machineTypes/custom-CPUS-MEMORY
-                # For example: zones/us-central1-f/machineTypes/custom-4-5120
-                'machineType': 'zones/{zone}/machineTypes/{machine_type}'.format(zone=self.zone,
-                                                                                 machine_type=machine_type),
-                'name': self.name,
-                'disks': [
-                    {
-                        # 'diskEncryptionKey': '', # If we ever encrypt our disk
-                        # 'deviceName': '', # For persistent disks
-                        # Parameters for a new disk that will be created alongside the instance
-                        # Mutually exclusive with the "source" parameter
-                        'initializeParams': {
-                            # 'sourceSnapshot': '', # Use a snapshot to create this disk
-                            # 'diskName': '', # Unique disk name - will be generated if not provided
-                            # 'description: '', # Optional disk description
-                            # 'labels': { 'key': 'value' }, # Optional labels for this disk
-                            # Disk type choices:
-                            # pd-standard: disk drive, standard i/o
-                            # pd-ssd: solid-state drive
-                            # local-ssd: solid-state drive, directly wired to the hardware. very fast
-                            # Specify with the partial URL: zones/<zone>/diskTypes/<diskType>
-                            'diskType': 'zones/{zone}/diskTypes/{disk_type}'.format(zone=self.zone,
-                                                                                    disk_type=disk_type),
-                            'diskSizeGb': boot_disk_size,
-                            # You can also specify a custom image by its image family,
-                            # which returns the latest version of the image in that family.
-                            # Replace the image name with family/family-name:
-                            # global/images/family/my-image-family
-                            #
-                            # Use the specified custom image.
-                            'sourceImage': 'projects/{}/global/images/{}'.format(image_project,
-                                                                                 image)
-                        },
-                        'autoDelete': True,  # Delete the disk when the instance is deleted
-                        'boot': True,  # This is a boot disk
-                        'mode': 'READ_WRITE',  # READ_ONLY or READ_WRITE
-                        'interface': 'SCSI',  # SCSI or NVME. Only local SSDs can use NVME
-                        'type': 'PERSISTENT',  # SCRATCH or PERSISTENT
-                        # 'source': '' # Full or partial URL to an existing disk instance
-                    },
-                ]  # END DISKS
-            }  # END BODY
-        )  # END INSERT
+            body=instance_body(name=self.name,
+                               user=self.user,
+                               zone=self.zone,
+                               rstudio_passwd=rstudio_passwd,
+                               machine_type=machine_type,
+                               boot_disk_size=boot_disk_size,
+                               image=image,
+                               image_project=image_project,
+                               disk_type=disk_type,
+                               local_ssds=local_ssds,
+                               data_disk_type=data_disk_type,
+                               data_disk_size=data_disk_size,
+                               prefetch_libs=prefetch_libs,
+                               bucket=bucket),
+        )
+
+        res = req.execute()
+        self.cache.invalidate(self.name)
+
+        return res
 
+    def get(self):
+        req = self.connection.get(project=self.project,
+                                  zone=self.zone,
+                                  instance=self.name)
         res = req.execute()
+        self.cache.put(res)
 
         return res
 
+    def exists(self):
+        from googleapiclient.errors import HttpError
+        try:
+            self.get()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return False
+            raise
+        return True
+
+    def describe(self, max_age=None):
+        """
+        Summary of instance (status, NAT IP, labels, fingerprints), from the local cache if fresh.
+        :param max_age: maximum age in seconds of cached summary (defaults to cache TTL)
+        :return: dict
+        """
+        summary = self.cache.get(self.name, max_age=max_age)
+        if summary is None:
+            summary = summarize_instance(self.get())
+        return summary
+
+    def get_guest_attributes(self, namespace=guest_namespace):
+        """
+        Guest attributes written by the instance under namespace.
+        :param namespace:
+        :return: dict of key -> value (empty if none written yet)
+        """
+        from googleapiclient.errors import HttpError
+        req = self.connection.getGuestAttributes(project=self.project,
+                                                 zone=self.zone,
+                                                 instance=self.name,
+                                                 queryPath='{}/'.format(namespace))
+        try:
+            res = req.execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return {}
+            raise
+        return {item['key']: item['value'] for item in res.get('queryValue', {}).get('items', [])}
+
+    def wait_for_operation(self, operation, timeout=300):
+        return wait_for_operation(operation, project=self.project, timeout=timeout)
+
+    def wait_until_running(self, timeout=300):
+        """
+        Wait for instance to be running with an external IP assigned.
+        :param timeout: seconds before giving up
+        :return: instance resource
+        """
+        def is_ready(instance):
+            if instance['status'] in ('STOPPING', 'TERMINATED', 'SUSPENDED'):
+                raise RuntimeError('Instance {} is {} and will not become ready.'.format(self.name,
+                                                                                       instance['status']))
+            return instance['status'] == 'RUNNING' and get_nat_ip(instance) is not None
+
+        return poll(self.get, is_ready, timeout=timeout,
+                    description='instance {} to be running'.format(self.name))
+
     def stop(self):
         req = self.connection.stop(project=self.project,
                                    zone=self.zone,
                                    instance=self.name)
         res = req.execute()
+        self.cache.invalidate(self.name)
 
         return res
 
@@ -187,6 +375,7 @@ class GCEInstanceManager(object):
                                      zone=self.zone,
                                      instance=self.name)
         res = req.execute()
+        self.cache.invalidate(self.name)
 
         return res
 
@@ -196,6 +385,7 @@ class GCEInstanceManager(object):
                                      zone=self.zone,
                                      instance=self.name)
         res = req.execute()
+        self.cache.invalidate(self.name)
 
         return res
 
@@ -213,6 +403,7 @@ class GCEInstanceManager(object):
             }
         )
         res = req.execute()
+        self.cache.invalidate(self.name)
 
         return res
 
@@ -221,42 +412,229 @@ class GCEInstanceManager(object):
         label_key,
         label_value,
     ):
-        # Get label fingerprint as it is required
-        req = self.connection.get(project=self.project,
-                                  zone=self.zone,
-                                  instance=self.name)
-        res = req.execute()
-        labels = res['labels']
-        label_fingerprint = res['labelFingerprint']
-        # Set new label value
-        labels[label_key] = label_value
+        from googleapiclient.errors import HttpError
 
-        req = self.connection.setLabels(
-            project=self.project,
-            zone=self.zone,
-            instance=self.name,
-            body={
-                "labelFingerprint": label_fingerprint,
-                "labels": labels,
-            }
-        )
-        res = req.execute()
+        # Label fingerprint is required, try the cached one first
+        for max_age in (None, 0):
+            summary = self.describe(max_age=max_age)
+            labels = dict(summary['labels'])
+            # Set new label value
+            labels[label_key] = label_value
+
+            req = self.connection.setLabels(
+                project=self.project,
+                zone=self.zone,
+                instance=self.name,
+                body={
+                    "labelFingerprint": summary['labelFingerprint'],
+                    "labels": labels,
+                }
+            )
+            try:
+                res = req.execute()
+                break
+            except HttpError as e:
+                # Stale fingerprint, retry with fresh instance state
+                if e.resp.status != 412 or max_age == 0:
+                    raise
+        self.cache.invalidate(self.name)
 
         return res
 
+def get_nat_ip(instance):
+    # External IP of instance (resource or cached summary), None if not (yet) assigned
+    if 'natIP' in instance:
+        return instance['natIP']
+    for interface in instance.get('networkInterfaces', []):
+        for access_config in interface.get('accessConfigs', []):
+            if access_config.get('natIP'):
+                return access_config['natIP']
+    return None
+
+def owner_filter(owner):
+    # Server side filter expression for instances with owner label
+    return 'labels.owner = "{}"'.format(owner) if owner else None
+
+def selector_filter(selector):
+    """
+    Server side filter expression from a label selector.
+    :param selector: comma separated label conditions, eg. "owner=jdoe,env=time-managed"
+    :return: filter expression
+    """
+    conditions = []
+    for condition in selector.split(','):
+        if '=' not in condition:
+            raise ValueError('Label selector conditions must look like key=value, got "{}".'.format(condition))
+        key, value = [part.strip() for part in condition.split('=', 1)]
+        conditions.append('(labels.{} = "{}")'.format(key, value))
+    return ' '.join(conditions)
+
+def _cache_by_zone(project, instances):
+    zones = {}
+    for instance in instances:
+        zones.setdefault(instance['zone'].split('/')[-1], []).append(instance)
+    for zone, zone_instances in zones.items():
+        InstanceCache(project, zone).put(*zone_instances)
+
 def list_instances(
     project=config['GCP']['gcp_project_id'],
     zone=config['GCP']['gcp_zone'],
+    owner=None,
+    fields=instance_fields,
 ):
+    """
+    Instances in one zone, following all pages.
+    :param project:
+    :param zone:
+    :param owner: only list instances with this owner label
+    :param fields: instance fields to request (None for full resources)
+    :return: dict with list of instances under "items"
+    """
     # http://googleapis.github.io/google-api-python-client/docs/dyn/compute_v1.html
-    service = build('compute', 'v1')
+    service = get_service('compute', 'v1')
     instances = service.instances()
 
     # http://googleapis.github.io/google-api-python-client/docs/dyn/compute_v1.instances.html#list
-    req = instances.list(project=project, zone=zone)
-    res = req.execute()
-    # print(json.dumps(res, sort_keys=True, indent=4))
-    return res
+    kwargs = {}
+    if fields:
+        kwargs['fields'] = 'items({}),nextPageToken'.format(fields)
+    if owner:
+        kwargs['filter'] = owner_filter(owner)
+    items = []
+    req = instances.list(project=project, zone=zone, **kwargs)
+    while req is not None:
+        res = req.execute()
+        items.extend(res.get('items', []))
+        req = instances.list_next(previous_request=req, previous_response=res)
+
+    # Only cache complete summaries
+    if fields in (None, instance_fields):
+        _cache_by_zone(project, items)
+    return {'items': items}
+
+def aggregated_list_instances(
+    project=config['GCP']['gcp_project_id'],
+    owner=None,
+    fields=instance_fields,
+    selector=None,
+):
+    """
+    Instances in all zones of project with a single aggregated listing, following all pages.
+    :param project:
+    :param owner: only list instances with this owner label (filtered server side)
+    :param selector: only list instances matching label selector, eg. "owner=jdoe" (overrides owner)
+    :param fields: instance fields to request (None for full resources)
+    :return: list of instances
+    """
+    service = get_service('compute', 'v1')
+    instances = service.instances()
+
+    kwargs = {}
+    if fields:
+        kwargs['fields'] = 'items/*/instances({}),nextPageToken'.format(fields)
+    if owner:
+        kwargs['filter'] = owner_filter(owner)
+    if selector:
+        kwargs['filter'] = selector_filter(selector)
+    items = []
+    req = instances.aggregatedList(project=project, **kwargs)
+    while req is not None:
+        res = req.execute()
+        for scoped_list in res.get('items', {}).values():
+            items.extend(scoped_list.get('instances', []))
+        req = instances.aggregatedList_next(previous_request=req, previous_response=res)
+
+    # Only cache complete summaries
+    if fields in (None, instance_fields):
+        _cache_by_zone(project, items)
+    return items
+
+def get_instances(
+    targets,
+    project=config['GCP']['gcp_project_id'],
+    fields=instance_fields,
+):
+    """
+    Fetch many instances with batch requests.
+    :param targets: list of (zone, instance name) pairs
+    :param project:
+    :param fields: instance fields to request (None for full resources)
+    :return: (list of instances found, dict of "zone/name" -> error message for the rest)
+    """
+    instances = get_service('compute', 'v1').instances()
+    kwargs = {'fields': fields} if fields else {}
+    requests = {'{}/{}'.format(zone, name): instances.get(project=project, zone=zone, instance=name, **kwargs)
+                for zone, name in targets}
+    found, errors = [], {}
+    for key, (instance, exception) in execute_batch(get_service('compute', 'v1'), requests).items():
+        if exception is None:
+            found.append(instance)
+        else:
+            errors[key] = str(exception)
+    return found, errors
+
+def batch_instance_action(
+    action,
+    instances,
+    project=config['GCP']['gcp_project_id'],
+    labels=None,
+    timeout=600,
+):
+    """
+    Start, stop, delete or relabel many instances with batch requests, then wait on all operations.
+    :param action: one of 'start', 'stop', 'delete', 'setLabels'
+    :param instances: list of instance resources (need name and zone; labels and labelFingerprint
+                      for setLabels)
+    :param project:
+    :param labels: dict of labels to set (for setLabels)
+    :param timeout: seconds to wait for operations
+    :return: dict of "zone/name" -> error message, or None if successful
+    """
+    service = get_service('compute', 'v1')
+    method = getattr(service.instances(), action)
+    requests = {}
+    for inst in instances:
+        zone = inst['zone'].split('/')[-1]
+        kwargs = {'project': project, 'zone': zone, 'instance': inst['name']}
+        if action == 'setLabels':
+            new_labels = dict(inst.get('labels', {}))
+            new_labels.update(labels)
+            kwargs['body'] = {'labelFingerprint': inst['labelFingerprint'], 'labels': new_labels}
+        requests['{}/{}'.format(zone, inst['name'])] = method(**kwargs)
+
+    results, operations = {}, {}
+    for key, (operation, exception) in execute_batch(service, requests).items():
+        if exception is None:
+            operations[key] = operation
+        else:
+            results[key] = str(exception)
+    results.update(wait_for_operations(operations, project, timeout=timeout))
+
+    for key in results:
+        zone, name = key.split('/')
+        InstanceCache(project, zone).invalidate(name)
+
+    return results
+
+def format_results(results):
+    # Per instance outcome of a batch action
+    rows = [[key.split('/')[1], key.split('/')[0], 'OK' if error is None else 'FAILED: {}'.format(error)]
+            for key, error in sorted(results.items())]
+    return format_table(rows, ['NAME', 'ZONE', 'RESULT'])
+
+def format_instances(instances):
+    # Compact table of instances, sorted by zone and name
+    rows = []
+    for inst in sorted(instances, key=lambda i: (i['zone'], i['name'])):
+        labels = inst.get('labels', {})
+        rows.append([inst['name'],
+                     inst['zone'].split('/')[-1],
+                     inst.get('machineType', '').split('/')[-1],
+                     inst.get('status'),
+                     get_nat_ip(inst),
+                     labels.get('owner'),
+                     labels.get('env')])
+    return format_table(rows, ['NAME', 'ZONE', 'MACHINE_TYPE', 'STATUS', 'EXTERNAL_IP', 'OWNER', 'TIME_LABEL'])
 
 #TODO: Add a function to automatically attach a snapshot schedule to someone's disk once
 # instance is created
@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous counterpart of GCEInstanceManager, for driving many instances from one event loop.
+
+API requests run on a pool of worker threads sharing one set of credentials (each worker keeps
+its own authorized HTTP transport, see clients.py), so no extra dependencies are needed. A
+semaphore bounds the number of requests in flight, and operations are awaited with asyncio.sleep
+between polls, so waiting on hundreds of operations does not hold any threads.
+
+Usage:
+    async with AsyncGCEInstanceManager(project='my-project') as manager:
+        await asyncio.gather(*[manager.stop(name) for name in names])
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from lab_sc_gcp.cache import InstanceCache
+from lab_sc_gcp.clients import get_service
+from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.gce import aggregated_list_instances, get_nat_ip, instance_body, list_instances
+from lab_sc_gcp.operations import operation_errors, operation_request
+from lab_sc_gcp.utilities import *
+
+config = get_config()
+
+class AsyncGCEInstanceManager(object):
+    """
+    Compute engine instance interaction with coroutines, for any number of instances.
+    Instance names are used as given (not combined with a user name).
+    """
+    def __init__(
+        self,
+        project=config['GCP']['gcp_project_id'],
+        zone=config['GCP']['gcp_zone'],
+        max_concurrency=32,
+    ):
+        """
+        :param project:
+        :param zone: default zone for instances
+        :param max_concurrency: maximum number of API requests in flight
+        """
+        self.project = project
+        self.zone = zone
+        self.max_concurrency = int(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        # Created on first use, inside the running event loop
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args, **kwargs):
+        # Run blocking function in the worker pool, with at most max_concurrency in flight
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    async def _execute(self, make_request):
+        """
+        Execute a compute API request in the worker pool.
+        :param make_request: function of the compute API client returning an unexecuted request
+        :return: response
+        """
+        return await self._run(lambda: make_request(get_service('compute', 'v1')).execute())
+
+    async def _instance_call(self, method, name, zone=None, wait=True, timeout=300, **kwargs):
+        # Call an instances method taking project, zone and instance, optionally waiting on the operation
+        zone = zone or self.zone
+        operation = await self._execute(
+            lambda service: getattr(service.instances(), method)(project=self.project,
+                                                                 zone=zone,
+                                                                 instance=name,
+                                                                 **kwargs))
+        InstanceCache(self.project, zone).invalidate(name)
+        if wait:
+            operation = await self.wait_for_operation(operation, timeout=timeout)
+        return operation
+
+    async def wait_for_operation(self, operation, timeout=300, initial_delay=1.0, max_delay=10.0):
+        """
+        Wait for a compute operation to finish, backing off exponentially between polls.
+        :param operation: operation resource
+        :param timeout: seconds before giving up
+        :param initial_delay: seconds before the first poll
+        :param max_delay: upper bound on seconds between polls
+        :return: finished operation resource
+        """
+        target = operation.get('targetLink', operation['name']).split('/')[-1]
+        description = '{} of {}'.format(operation.get('operationType', 'operation'), target)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = initial_delay
+        while operation.get('status') != 'DONE':
+            if loop.time() + delay > deadline:
+                raise RuntimeError('Timed out after {}s waiting for {}.'.format(timeout, description))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            operation = await self._execute(
+                lambda service, op=operation: operation_request(service, op, self.project))
+
+        errors = operation_errors(operation)
+        if errors:
+            raise RuntimeError('{} failed: {}'.format(description, '; '.join(errors)))
+        return operation
+
+    async def get(self, name, zone=None):
+        zone = zone or self.zone
+        instance = await self._execute(
+            lambda service: service.instances().get(project=self.project, zone=zone, instance=name))
+        InstanceCache(self.project, zone).put(instance)
+        return instance
+
+    async def list(self, zone=None, owner=None, selector=None):
+        """
+        Instances of project, in one zone or (by default) all zones.
+        :param zone:
+        :param owner: only list instances with this owner label
+        :param selector: only list instances matching label selector (all zones only)
+        :return: list of instances
+        """
+        if zone:
+            res = await self._run(list_instances, project=self.project, zone=zone, owner=owner)
+            return res['items']
+        return await self._run(aggregated_list_instances, project=self.project, owner=owner, selector=selector)
+
+    async def wait_until_running(self, name, zone=None, timeout=300, initial_delay=1.0, max_delay=10.0):
+        """
+        Wait for instance to be running with an external IP assigned.
+        :return: instance resource
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = initial_delay
+        while True:
+            instance = await self.get(name, zone=zone)
+            if instance['status'] in ('STOPPING', 'TERMINATED', 'SUSPENDED'):
+                raise RuntimeError('Instance {} is {} and will not become ready.'.format(name, instance['status']))
+            if instance['status'] == 'RUNNING' and get_nat_ip(instance) is not None:
+                return instance
+            if loop.time() + delay > deadline:
+                raise RuntimeError('Timed out after {}s waiting for instance {} to be running.'.format(timeout,
+                                                                                                      name))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    async def create(self, name, user, rstudio_passwd, zone=None, wait=True, timeout=300, **kwargs):
+        """
+        Create instance (see gce.instance_body for the optional machine and disk arguments).
+        :param name: full instance name
+        :param user: owner of instance
+        :param rstudio_passwd: RStudio Server password for user
+        :return: operation resource
+        """
+        zone = zone or self.zone
+        body = instance_body(name=name, user=user, zone=zone, rstudio_passwd=rstudio_passwd, **kwargs)
+        operation = await self._execute(
+            lambda service: service.instances().insert(project=self.project, zone=zone, body=body))
+        InstanceCache(self.project, zone).invalidate(name)
+        if wait:
+            operation = await self.wait_for_operation(operation, timeout=timeout)
+        return operation
+
+    async def start(self, name, zone=None, wait=True, timeout=300):
+        return await self._instance_call('start', name, zone=zone, wait=wait, timeout=timeout)
+
+    async def stop(self, name, zone=None, wait=True, timeout=300):
+        return await self._instance_call('stop', name, zone=zone, wait=wait, timeout=timeout)
+
+    async def delete(self, name, zone=None, wait=True, timeout=300):
+        return await self._instance_call('delete', name, zone=zone, wait=wait, timeout=timeout)
+
+    async def set_machine_type(
+        self,
+        name,
+        machine_type=config['GCP']['machine_type'],
+        zone=None,
+        wait=True,
+        timeout=300,
+    ):
+        zone = zone or self.zone
+        body = {
+            "machineType": 'zones/{zone}/machineTypes/{machine_type}'.format(zone=zone,
+                                                                             machine_type=machine_type),
+        }
+        return await self._instance_call('setMachineType', name, zone=zone, wait=wait, timeout=timeout, body=body)
+
+    async def set_labels(self, name, labels, zone=None, wait=True, timeout=300):
+        """
+        Add or update labels on instance, keeping its other labels.
+        :param labels: dict of labels to set
+        :return: operation resource
+        """
+        from googleapiclient.errors import HttpError
+
+        zone = zone or self.zone
+        # Label fingerprint is required, try the cached one first
+        summary = InstanceCache(self.project, zone).get(name)
+        while True:
+            if summary is None:
+                summary = await self.get(name, zone=zone)
+            new_labels = dict(summary.get('labels', {}))
+            new_labels.update(labels)
+            body = {'labelFingerprint': summary['labelFingerprint'], 'labels': new_labels}
+            try:
+                return await self._instance_call('setLabels', name, zone=zone, wait=wait, timeout=timeout,
+                                                 body=body)
+            except HttpError as e:
+                # Stale fingerprint, retry once with fresh instance state
+                if e.resp.status != 412 or 'cached_at' not in summary:
+                    raise
+                summary = None
+
+    async def set_label(self, name, label_key, label_value, zone=None, wait=True, timeout=300):
+        return await self.set_labels(name, {label_key: label_value}, zone=zone, wait=wait, timeout=timeout)
+
+    async def run_action(self, action, instances, labels=None, timeout=600):
+        """
+        Apply action to many instances concurrently and wait for all of them.
+        :param action: one of 'start', 'stop', 'delete', 'setLabels'
+        :param instances: list of instances (need name and zone)
+        :param labels: dict of labels to set (for setLabels)
+        :param timeout: seconds to wait for each operation
+        :return: dict of "zone/name" -> error message, or None if successful
+        """
+        async def run_one(instance):
+            zone = instance['zone'].split('/')[-1]
+            key = '{}/{}'.format(zone, instance['name'])
+            try:
+                if action == 'setLabels':
+                    await self.set_labels(instance['name'], labels, zone=zone, timeout=timeout)
+                else:
+                    await getattr(self, action)(instance['name'], zone=zone, timeout=timeout)
+            except Exception as e:
+                return key, str(e)
+            return key, None
+
+        return dict(await asyncio.gather(*[run_one(instance) for instance in instances]))
+
+def async_instance_action(
+    action,
+    instances,
+    project=config['GCP']['gcp_project_id'],
+    labels=None,
+    max_concurrency=32,
+    timeout=600,
+):
+    """
+    Blocking wrapper around AsyncGCEInstanceManager.run_action, with the same results as
+    gce.batch_instance_action.
+    """
+    async def run():
+        async with AsyncGCEInstanceManager(project=project, max_concurrency=max_concurrency) as manager:
+            return await manager.run_action(action, instances, labels=labels, timeout=timeout)
+
+    return asyncio.run(run())
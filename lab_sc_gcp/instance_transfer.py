@@ -0,0 +1,701 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Transfers between this machine and instances over SSH.
+
+Directory trees are sent as one tar stream over a single SSH channel instead of file by file,
+compressed on the fly (zstd if available on both ends, else gzip) and unpacked as they arrive,
+so trees with thousands of small files move at close to link bandwidth.
+
+Uploads are delta syncs: a manifest of the remote tree (size and modification time, plus a
+hash for files whose time changed but size did not) is compared with the local tree, and only
+new or changed files are sent, split over a few parallel streams.
+
+Large transfers are routed through the bucket instead, where parallel streams to and from Cloud
+Storage (and the instance's in-region bandwidth) beat a single SSH connection from the site.
+"""
+import hashlib
+import os
+import posixpath
+import shlex
+import tarfile
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
+
+from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.ssh import remote_path
+from lab_sc_gcp.utilities import *
+
+config = get_config()
+
+# Bytes read from the SSH channel at a time
+chunk_size = 1024 * 1024
+
+# Bucket prefix for files staged by transfers routed through the bucket
+bucket_staging_prefix = 'tmp/instance_transfers'
+
+zstd_magic = b'\x28\xb5\x2f\xfd'
+gzip_magic = b'\x1f\x8b'
+
+def zstd_available():
+    # zstd streams are decompressed with the optional zstandard package
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+def remote_compressor(compression):
+    """
+    Remote shell command compressing stdin, falling back to gzip when zstd is not installed on the
+    instance (the format is detected from the stream when unpacking).
+    :param compression: 'zstd', 'gzip' or 'none'
+    """
+    if compression == 'zstd':
+        return ('if command -v zstd >/dev/null; then zstd -q -c -T0 -3; '
+                'elif command -v pigz >/dev/null; then pigz -c; else gzip -c -1; fi')
+    if compression == 'gzip':
+        return 'if command -v pigz >/dev/null; then pigz -c; else gzip -c -1; fi'
+    return 'cat'
+
+def pattern_tests(patterns, root):
+    # find tests matching file name patterns, or paths relative to root for patterns with a /
+    tests = []
+    for pattern in patterns:
+        if '/' in pattern:
+            tests.append('-path {}'.format(shlex.quote('{}/{}'.format(root, pattern.lstrip('/')))))
+        else:
+            tests.append('-name {}'.format(shlex.quote(pattern)))
+    return '\\( {} \\)'.format(' -o '.join(tests))
+
+def split_source(source_path):
+    # Parent directory and name of a path on the instance
+    source_path = source_path.rstrip('/') or '/'
+    return os.path.dirname(source_path) or '.', os.path.basename(source_path)
+
+def find_command(name, include=None, exclude=None):
+    # find command selecting files (and links) under name, relative to the current directory
+    find = 'find {} \\( -type f -o -type l \\)'.format(shlex.quote(name))
+    if include:
+        find += ' ' + pattern_tests(include, name)
+    if exclude:
+        find += ' ! ' + pattern_tests(exclude, name)
+    return find
+
+def remote_tar_command(source_path, include=None, exclude=None, compression='gzip'):
+    """
+    Remote shell command writing a compressed tar archive of source_path to stdout.
+    :param include: only files matching one of these patterns
+    :param exclude: no files matching one of these patterns
+    """
+    parent, name = split_source(source_path)
+    if include or exclude:
+        # Select files with find, so patterns can match names anywhere in the tree
+        tar = '{} -print0 | tar --null -T - -cf -'.format(find_command(name, include=include, exclude=exclude))
+    else:
+        tar = 'tar -cf - {}'.format(shlex.quote(name))
+    return 'set -o pipefail; cd {} && {} | {}'.format(remote_path(parent), tar, remote_compressor(compression))
+
+def remote_selection_command(source_path, include=None, exclude=None):
+    # Remote shell command printing NUL separated (path relative to parent, size, mtime) triples of selected files
+    parent, name = split_source(source_path)
+    return "cd {} && {} -printf '%p\\0%s\\0%T@\\0'".format(remote_path(parent),
+                                                           find_command(name, include=include, exclude=exclude))
+
+class DecompressingReader(object):
+    """
+    File-like reader of a gzip, zstd or uncompressed stream, with the format detected from its first bytes.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.compressed_bytes = 0
+        # Decompressed data not read yet starts at offset (tarfile reads in small blocks)
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        head = b''
+        while len(head) < 4:
+            data = self.raw.read(4 - len(head))
+            if not data:
+                break
+            head += data
+        if head.startswith(gzip_magic):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif head.startswith(zstd_magic):
+            if not zstd_available():
+                raise RuntimeError('Instance sent a zstd stream, install the zstandard package to unpack it ' +
+                                   '(pip install zstandard) or use --compression gzip.')
+            import zstandard
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self.decompressor = None
+        self._feed(head)
+
+    def _feed(self, data):
+        self.compressed_bytes += len(data)
+        data = self.decompressor.decompress(data) if self.decompressor is not None else data
+        self.buffer = self.buffer[self.offset:] + data
+        self.offset = 0
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.offset < size):
+            data = self.raw.read1(chunk_size) if hasattr(self.raw, 'read1') else self.raw.read(chunk_size)
+            if not data:
+                self.eof = True
+                break
+            self._feed(data)
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset += len(data)
+        return data
+
+def _safe_members(tar, dest_path):
+    # Members of streamed archive, refusing paths outside destination
+    dest_path = os.path.realpath(dest_path)
+    for member in tar:
+        target = os.path.realpath(os.path.join(dest_path, member.name))
+        if os.path.commonpath([dest_path, target]) != dest_path:
+            raise RuntimeError('Refusing to unpack {} outside of {}.'.format(member.name, dest_path))
+        yield member
+
+def download_tar(connection, source_path, dest_path='.', include=None, exclude=None, compression='auto'):
+    """
+    Download file or directory from instance as one compressed tar stream, unpacking it as it arrives.
+    :param connection: SSHConnection to instance
+    :param source_path: path on instance
+    :param dest_path: local directory to unpack into (source directory is created inside it)
+    :param include: only download files matching one of these glob patterns (names, or paths with a /)
+    :param exclude: skip files matching one of these glob patterns
+    :param compression: 'auto' (zstd if the zstandard package is installed, else gzip), 'zstd', 'gzip' or 'none'
+    :return: dict with files, bytes, wire_bytes and seconds
+    """
+    if compression == 'auto':
+        compression = 'zstd' if zstd_available() else 'gzip'
+    elif compression == 'zstd' and not zstd_available():
+        raise RuntimeError('zstd compression needs the zstandard package (pip install zstandard).')
+    os.makedirs(dest_path, exist_ok=True)
+    connection.ensure_access()
+
+    start = time.time()
+    files, size = 0, 0
+    proc = connection.popen(remote_tar_command(source_path, include=include, exclude=exclude,
+                                               compression=compression),
+                            stdout=PIPE)
+    try:
+        reader = DecompressingReader(proc.stdout)
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in _safe_members(tar, dest_path):
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, dest_path, filter='data')
+                else:
+                    tar.extract(member, dest_path)
+                if member.isfile():
+                    files += 1
+                    size += member.size
+    except (tarfile.ReadError, zlib.error) as e:
+        proc.kill()
+        proc.wait()
+        raise RuntimeError('Download of {} failed ({}).'.format(source_path, e))
+    except BaseException:
+        # Also stop the remote tar if extraction fails or is interrupted
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError('Download of {} failed (remote exit status {}).'.format(source_path, proc.returncode))
+
+    return {'files': files,
+            'bytes': size,
+            'wire_bytes': reader.compressed_bytes,
+            'seconds': time.time() - start,
+            'route': 'ssh'}
+
+def choose_route(
+    files,
+    total_bytes,
+    bucket_name,
+    threshold_mb=config['TRANSFER']['bucket_route_threshold_mb'],
+    min_file_kb=config['TRANSFER']['bucket_route_min_file_kb'],
+):
+    """
+    Pick how to move files between this machine and an instance. Big transfers go through the bucket,
+    with parallel streams in and out of Cloud Storage, small ones (or many tiny files, which cost a request
+    each in the bucket) are streamed straight over SSH.
+    :param files: number of files to transfer
+    :param total_bytes: combined size of files
+    :param bucket_name: staging bucket, without one everything goes over SSH
+    :return: 'ssh' or 'bucket'
+    """
+    if not bucket_name or not files:
+        return 'ssh'
+    if (total_bytes >= float(threshold_mb) * 1024 ** 2 and
+            total_bytes / files >= float(min_file_kb) * 1024):
+        return 'bucket'
+    return 'ssh'
+
+def staging_prefix(connection):
+    # Unique bucket prefix for the files of one transfer
+    return '{}/{}-{}/'.format(bucket_staging_prefix, connection.name, uuid.uuid4().hex[:12])
+
+def delete_staging(bucket, prefix):
+    # Remove staged objects left by a transfer (missing ones are ignored)
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    if blobs:
+        bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
+def remote_storage_command(args):
+    # Remote shell command running a Cloud Storage copy with gcloud storage, or gsutil on older images
+    # (staged large files are composite objects without MD5, which gsutil refuses to download when it
+    # has no compiled crcmod unless hash checks may be skipped)
+    return ('if gcloud storage cp --help >/dev/null 2>&1; then gcloud storage --no-user-output-enabled {args}; '
+            'else gsutil -o GSUtil:check_hashes=if_fast_else_skip -q -m {args}; fi').format(args=args)
+
+def download_bucket(
+    connection,
+    selection,
+    source_path,
+    dest_path='.',
+    bucket_name=config['GCP']['bucket'],
+    streams=config['TRANSFER']['bucket_route_streams'],
+):
+    """
+    Download files from instance through the bucket: the instance writes tar archives of size balanced
+    groups of files to the bucket in parallel, and each archive is unpacked here as it is read back.
+    Staged archives are deleted afterwards.
+    :param connection: SSHConnection to instance
+    :param selection: dict of path (relative to parent of source_path) -> (size, mtime), see remote_selection_command
+    :param source_path: path on instance
+    :param dest_path: local directory to unpack into
+    :param bucket_name: staging bucket
+    :param streams: number of archives transferred in parallel
+    :return: dict with files, bytes, wire_bytes, seconds, route and bucket
+    """
+    from lab_sc_gcp.clients import get_storage_client
+
+    os.makedirs(dest_path, exist_ok=True)
+    parent, _ = split_source(source_path)
+    prefix = staging_prefix(connection)
+    sizes = {path: size for path, (size, _) in selection.items()}
+    groups = balanced_groups(list(selection), sizes, streams)
+    start = time.time()
+
+    def transfer(index, group):
+        object_name = '{}part-{:03d}.tar'.format(prefix, index)
+        res = connection.run('set -o pipefail; cd {} && tar --null -T - -cf - | {}'.format(
+                                 remote_path(parent),
+                                 remote_storage_command('cp - {}'.format(shlex.quote('gs://{}/{}'.format(
+                                     bucket_name, object_name))))),
+                             input=b''.join(os.fsencode(path) + b'\0' for path in group))
+        if res.returncode != 0:
+            raise RuntimeError('Could not stage files in gs://{} (remote exit status {}).'.format(bucket_name,
+                                                                                                 res.returncode))
+        blob = get_storage_client().bucket(bucket_name).get_blob(object_name)
+        files, size, wire_bytes = 0, 0, blob.size
+        with blob.open('rb') as f:
+            with tarfile.open(fileobj=f, mode='r|') as tar:
+                for member in _safe_members(tar, dest_path):
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extract(member, dest_path, filter='data')
+                    else:
+                        tar.extract(member, dest_path)
+                    if member.isfile():
+                        files += 1
+                        size += member.size
+        blob.delete()
+        return files, size, wire_bytes
+
+    stats = {'files': 0, 'bytes': 0, 'wire_bytes': 0, 'route': 'bucket', 'bucket': bucket_name}
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [executor.submit(transfer, index, group) for index, group in enumerate(groups)]
+            for future in futures:
+                try:
+                    files, size, wire_bytes = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                else:
+                    stats['files'] += files
+                    stats['bytes'] += size
+                    stats['wire_bytes'] += wire_bytes
+    finally:
+        delete_staging(get_storage_client().bucket(bucket_name), prefix)
+    if errors:
+        raise RuntimeError('{} of {} archive(s) failed: {}'.format(len(errors), len(groups), '; '.join(errors)))
+    stats['seconds'] = time.time() - start
+    return stats
+
+def download_from_instance(
+    connection,
+    source_path,
+    dest_path='.',
+    include=None,
+    exclude=None,
+    compression='auto',
+    route='auto',
+    bucket_name=config['GCP']['bucket'],
+):
+    """
+    Download file or directory from instance, straight over SSH or through the bucket.
+    :param route: 'auto' (chosen from size and number of files, see choose_route), 'ssh' or 'bucket'
+    :return: dict with files, bytes, wire_bytes, seconds and route (see download_tar and download_bucket)
+    """
+    bucket_name = (bucket_name or '').replace('gs://', '').strip('/')
+    if route == 'bucket' and not bucket_name:
+        raise RuntimeError('No default bucket set. Please provide one with --bucket.')
+    if route != 'ssh':
+        connection.ensure_access()
+        res = connection.run(remote_selection_command(source_path, include=include, exclude=exclude), stdout=PIPE)
+        if res.returncode != 0:
+            raise RuntimeError('Could not list {} on instance (exit status {}).'.format(source_path, res.returncode))
+        selection = parse_manifest(res.stdout)
+        if not selection:
+            raise RuntimeError('No files to download from {}.'.format(source_path))
+        if route == 'auto':
+            route = choose_route(len(selection), sum(size for size, _ in selection.values()), bucket_name)
+        print('Downloading {} file(s) ({}) {}.'.format(
+            len(selection), format_bytes(sum(size for size, _ in selection.values())),
+            'through bucket gs://{}'.format(bucket_name) if route == 'bucket' else 'over SSH'))
+    if route == 'bucket':
+        return download_bucket(connection, selection, source_path, dest_path=dest_path, bucket_name=bucket_name)
+    return download_tar(connection, source_path, dest_path=dest_path, include=include, exclude=exclude,
+                        compression=compression)
+
+def format_transfer(stats, action='Downloaded'):
+    # One line summary of a transfer
+    seconds = max(stats['seconds'], 1e-6)
+    route = ' through bucket gs://{}'.format(stats['bucket']) if stats.get('route') == 'bucket' else ' over SSH'
+    return '{} {} file(s){}, {} ({} over the wire) in {:.1f}s ({}/s).'.format(
+        action, stats['files'], route, format_bytes(stats['bytes']), format_bytes(stats['wire_bytes']),
+        stats['seconds'], format_bytes(stats['bytes'] / seconds))
+
+def _glob_escape(name):
+    # Match name literally in find -name
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in name)
+
+def remote_manifest_command(root, name=None):
+    """
+    Remote shell command listing files under root: a line with the best compression the instance can
+    decompress, then NUL separated (relative path, size, modification time) triples.
+    :param name: only list this file directly in root
+    """
+    find = 'find . -type f'
+    if name is not None:
+        find = 'find . -maxdepth 1 -type f -name {}'.format(shlex.quote(_glob_escape(name)))
+    return ('if command -v zstd >/dev/null; then echo zstd; else echo gzip; fi; '
+            "if [ -d {root} ]; then cd {root} && {find} -printf '%P\\0%s\\0%T@\\0'; fi").format(root=remote_path(root),
+                                                                                               find=find)
+
+def remote_hash_command(root):
+    # Remote shell command printing NUL separated (sha256, path) pairs for NUL separated paths on stdin,
+    # failing if any path could not be hashed
+    return ('cd ' + remote_path(root) + " && s=0 && while IFS= read -r -d '' f; do "
+            "h=$(sha256sum < \"$f\") && printf '%s\\0%s\\0' \"${h%% *}\" \"$f\" || s=1; done; exit $s")
+
+def remote_touch_command(root):
+    # Remote shell command setting modification times from NUL separated (mtime, path) pairs on stdin
+    return ('cd ' + remote_path(root) + " && while IFS= read -r -d '' t && IFS= read -r -d '' f; do "
+            'touch -m -d "@$t" -- "$f"; done')
+
+def remote_chmod_command(root):
+    # Remote shell command setting permissions from NUL separated (octal mode, path) pairs on stdin
+    return ('cd ' + remote_path(root) + " && while IFS= read -r -d '' m && IFS= read -r -d '' f; do "
+            'chmod "$m" -- "$f"; done')
+
+def _set_remote_mtimes(connection, remote_root, paths, local):
+    # Give remote copies the local modification times, so the next sync sees them as unchanged
+    res = connection.run(remote_touch_command(remote_root),
+                         input=b''.join('{:.6f}'.format(local[path][1]).encode() + b'\0' +
+                                        os.fsencode(path) + b'\0' for path in paths))
+    if res.returncode != 0:
+        raise RuntimeError('Could not set modification times on instance (exit status {}).'.format(
+            res.returncode))
+
+def remote_untar_command(root, compression):
+    # Remote shell command unpacking a compressed tar stream from stdin into root
+    decompress = {'zstd': 'zstd -q -d -c', 'gzip': 'gzip -d -c', 'none': 'cat'}[compression]
+    return 'set -o pipefail; mkdir -p {root} && cd {root} && {} | tar -xf -'.format(decompress, root=remote_path(root))
+
+def parse_manifest(data):
+    # Manifest dict of relative path -> (size, mtime) from NUL separated triples
+    fields = data.split(b'\0')
+    manifest = {}
+    for i in range(0, len(fields) - 2, 3):
+        manifest[os.fsdecode(fields[i])] = (int(fields[i + 1]), float(fields[i + 2]))
+    return manifest
+
+def local_manifest(root, name=None):
+    """
+    Manifest of files under a local directory (following symbolic links to files).
+    :param name: only this file directly in root
+    :return: dict of relative path -> (size, mtime)
+    """
+    if name is not None:
+        stat = os.stat(os.path.join(root, name))
+        return {name: (stat.st_size, stat.st_mtime)}
+    manifest = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if os.path.isfile(path):
+                manifest[os.path.relpath(path, root)] = (stat.st_size, stat.st_mtime)
+    return manifest
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def balanced_groups(paths, sizes, n):
+    # Split paths into at most n groups of similar total size, largest files first
+    groups = [[] for _ in range(max(min(int(n), len(paths)), 1))]
+    loads = [0] * len(groups)
+    for path in sorted(paths, key=lambda path: sizes[path], reverse=True):
+        i = loads.index(min(loads))
+        groups[i].append(path)
+        loads[i] += sizes[path]
+    return [group for group in groups if group]
+
+class CompressingWriter(object):
+    """
+    File-like writer compressing data (gzip, zstd or not at all) into a raw stream.
+    """
+    def __init__(self, raw, compression):
+        self.raw = raw
+        self.compressed_bytes = 0
+        if compression == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        elif compression == 'gzip':
+            self.compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.compressor = None
+
+    def _send(self, data):
+        if data:
+            self.compressed_bytes += len(data)
+            self.raw.write(data)
+
+    def write(self, data):
+        self._send(self.compressor.compress(data) if self.compressor is not None else data)
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self._send(self.compressor.flush())
+        self.raw.close()
+
+def _send_group(connection, local_root, remote_root, paths, compression, multiplex=True):
+    # Send files as one tar stream, returning bytes sent over the wire
+    proc = connection.popen(remote_untar_command(remote_root, compression), multiplex=multiplex, stdin=PIPE)
+    writer = CompressingWriter(proc.stdin, compression)
+    try:
+        tar = tarfile.open(fileobj=writer, mode='w|', dereference=True)
+        for path in paths:
+            tar.add(os.path.join(local_root, path), arcname=path, recursive=False)
+        tar.close()
+        writer.close()
+    except BrokenPipeError:
+        # Remote side failed, its exit status is reported below
+        pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        raise RuntimeError('Upload to {} failed (remote exit status {}).'.format(remote_root, proc.returncode))
+    return writer.compressed_bytes
+
+def _send_ssh(connection, local_root, remote_root, paths, sizes, streams, compression):
+    # Send files as parallel tar streams over SSH, returning bytes sent over the wire
+    groups = balanced_groups(paths, sizes, streams)
+    wire_bytes = 0
+    errors = []
+    # Streams sharing the master connection would share its TCP window, so parallel ones get their own
+    multiplex = len(groups) == 1
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [executor.submit(_send_group, connection, local_root, remote_root, group, compression,
+                                   multiplex=multiplex)
+                   for group in groups]
+        for future in futures:
+            try:
+                wire_bytes += future.result()
+            except Exception as e:
+                errors.append(str(e))
+    if errors:
+        raise RuntimeError('{} of {} upload stream(s) failed: {}'.format(len(errors), len(groups), '; '.join(errors)))
+    return wire_bytes
+
+def _send_bucket(connection, local_root, remote_root, paths, local, bucket_name):
+    """
+    Send files through the bucket: upload them to a staging prefix (large files as parallel composite
+    uploads), then have the instance copy them in-region. Staged objects are deleted afterwards.
+    :return: bytes sent
+    """
+    from lab_sc_gcp.storage import TransferEngine, TransferTask
+
+    engine = TransferEngine(bucket_name=bucket_name)
+    prefix = staging_prefix(connection)
+    tasks = [TransferTask(library='',
+                          local_path=os.path.join(local_root, path),
+                          object_name=prefix + path.replace(os.sep, '/'),
+                          size=local[path][0],
+                          mtime=local[path][1],
+                          crc32c=None) for path in paths]
+    try:
+        report = engine.upload(tasks)
+        if report.failures:
+            raise RuntimeError(report.summary())
+        res = connection.run('mkdir -p {root} && {}'.format(
+            remote_storage_command('cp -r {} {}/'.format(shlex.quote('gs://{}/{}*'.format(engine.bucket_name, prefix)),
+                                                          remote_path(remote_root))),
+            root=remote_path(remote_root)))
+        if res.returncode != 0:
+            raise RuntimeError('Could not copy staged files to instance (remote exit status {}).'.format(
+                res.returncode))
+        # Bucket copies do not keep permissions, so give files their local modes (eg. executables)
+        modes = [os.stat(task.local_path).st_mode & 0o7777 for task in tasks]
+        res = connection.run(remote_chmod_command(remote_root),
+                             input=b''.join('{:o}'.format(mode).encode() + b'\0' + os.fsencode(path) + b'\0'
+                                            for path, mode in zip(paths, modes)))
+        if res.returncode != 0:
+            raise RuntimeError('Could not set permissions on instance (exit status {}).'.format(res.returncode))
+        _set_remote_mtimes(connection, remote_root, paths, local)
+    finally:
+        delete_staging(engine.bucket(), prefix)
+    return sum(task.size for task in tasks)
+
+def sync_upload(
+    connection,
+    source_path,
+    dest_path='~',
+    delete=False,
+    streams=config['TRANSFER']['sync_streams'],
+    compression='auto',
+    hash_workers=config['TRANSFER']['hash_workers'],
+    route='auto',
+    bucket_name=config['GCP']['bucket'],
+):
+    """
+    Upload file or directory to instance, sending only files that are new or changed on the instance.
+    Files with the same size and modification time are unchanged. Files with the same size but a
+    different time are compared by hash, and identical ones get the local time on the instance.
+    :param connection: SSHConnection to instance
+    :param source_path: local file or directory
+    :param dest_path: directory on instance to upload into (source directory is created inside it)
+    :param delete: delete files in the remote copy of the directory that are not present locally
+    :param streams: number of parallel SSH streams to send files over
+    :param compression: 'auto' (zstd if supported on both ends, else gzip), 'zstd', 'gzip' or 'none'
+    :param hash_workers: number of local files hashed concurrently
+    :param route: 'auto' (chosen from size and number of files to send, see choose_route), 'ssh' or 'bucket'
+    :param bucket_name: staging bucket for the bucket route
+    :return: dict with files, bytes, wire_bytes, seconds, route, bucket, unchanged, unchanged_bytes,
+    total_bytes and deleted
+    """
+    bucket_name = (bucket_name or '').replace('gs://', '').strip('/')
+    if route == 'bucket' and not bucket_name:
+        raise RuntimeError('No default bucket set. Please provide one with --bucket.')
+    source_path = os.path.normpath(source_path)
+    if os.path.isdir(source_path):
+        local_root, name = source_path, None
+        remote_root = posixpath.join(dest_path, os.path.basename(os.path.abspath(source_path)))
+    elif os.path.isfile(source_path):
+        if delete:
+            raise RuntimeError('--delete can only be used when uploading a directory.')
+        local_root, name = os.path.dirname(source_path) or '.', os.path.basename(source_path)
+        remote_root = dest_path
+    else:
+        raise RuntimeError('{} does not exist.'.format(source_path))
+
+    start = time.time()
+    connection.ensure_access()
+    res = connection.run(remote_manifest_command(remote_root, name=name), stdout=PIPE)
+    if res.returncode != 0:
+        raise RuntimeError('Could not list {} on instance (exit status {}).'.format(remote_root, res.returncode))
+    remote_compression, _, data = res.stdout.partition(b'\n')
+    remote = parse_manifest(data)
+    local = local_manifest(local_root, name=name)
+
+    if compression == 'auto':
+        compression = 'zstd' if zstd_available() and remote_compression == b'zstd' else 'gzip'
+    elif compression == 'zstd' and not (zstd_available() and remote_compression == b'zstd'):
+        raise RuntimeError('zstd compression needs the zstandard package locally and zstd on the instance.')
+
+    # Modification times are compared to the second, as tar may not keep fractions
+    new = [path for path in local if path not in remote]
+    changed = [path for path in local if path in remote and local[path][0] != remote[path][0]]
+    touched = [path for path in local if path in remote and local[path][0] == remote[path][0] and
+               abs(local[path][1] - remote[path][1]) >= 1]
+    if touched:
+        res = connection.run(remote_hash_command(remote_root),
+                             input=b''.join(os.fsencode(path) + b'\0' for path in touched),
+                             stdout=PIPE)
+        if res.returncode != 0:
+            raise RuntimeError('Could not hash files in {} on instance (exit status {}).'.format(
+                remote_root, res.returncode))
+        fields = res.stdout.split(b'\0')
+        remote_hashes = {os.fsdecode(fields[i + 1]): fields[i].decode() for i in range(0, len(fields) - 1, 2)}
+        with ThreadPoolExecutor(max_workers=int(hash_workers)) as executor:
+            local_hashes = executor.map(lambda path: sha256_file(os.path.join(local_root, path)), touched)
+            same = {path for path, sha256 in zip(touched, local_hashes) if remote_hashes.get(path) == sha256}
+        changed.extend(path for path in touched if path not in same)
+        if same:
+            # Only the time differs, so fix it once instead of hashing these files on every sync
+            _set_remote_mtimes(connection, remote_root, sorted(same), local)
+    send = new + changed
+    deleted = sorted(path for path in remote if path not in local) if delete else []
+    print('{} new, {} changed and {} unchanged file(s){}.'.format(
+        len(new), len(changed), len(local) - len(send),
+        ', {} to delete on instance'.format(len(deleted)) if deleted else ''))
+
+    sizes = {path: local[path][0] for path in send}
+    sent_bytes = sum(sizes.values())
+    if route == 'auto':
+        route = choose_route(len(send), sent_bytes, bucket_name)
+    wire_bytes = 0
+    if send and route == 'bucket':
+        print('Sending {} through bucket gs://{}.'.format(format_bytes(sent_bytes), bucket_name))
+        wire_bytes = _send_bucket(connection, local_root, remote_root, send, local, bucket_name)
+    elif send:
+        wire_bytes = _send_ssh(connection, local_root, remote_root, send, sizes, streams, compression)
+
+    if deleted:
+        res = connection.run('cd {} && xargs -0 rm -f --'.format(remote_path(remote_root)),
+                             input=b''.join(os.fsencode(path) + b'\0' for path in deleted))
+        if res.returncode != 0:
+            raise RuntimeError('Could not delete files on instance (exit status {}).'.format(res.returncode))
+
+    total_bytes = sum(size for size, _ in local.values())
+    return {'files': len(send),
+            'bytes': sent_bytes,
+            'wire_bytes': wire_bytes,
+            'seconds': time.time() - start,
+            'route': route,
+            'bucket': bucket_name,
+            'unchanged': len(local) - len(send),
+            'unchanged_bytes': total_bytes - sent_bytes,
+            'total_bytes': total_bytes,
+            'deleted': len(deleted)}
+
+def format_sync(stats):
+    # Summary of a sync, with savings against copying the whole tree
+    lines = [format_transfer(stats, action='Uploaded')]
+    saved = max(stats['total_bytes'] - stats['wire_bytes'], 0)
+    lines.append('{} unchanged file(s) ({}) skipped. Sent {} instead of {} for a full copy ({:.0%} saved).'.format(
+        stats['unchanged'], format_bytes(stats['unchanged_bytes']), format_bytes(stats['wire_bytes']),
+        format_bytes(stats['total_bytes']), saved / stats['total_bytes'] if stats['total_bytes'] else 0))
+    if stats['deleted']:
+        lines.append('Deleted {} file(s) no longer present locally.'.format(stats['deleted']))
+    return '\n'.join(lines)
@@ -0,0 +1,218 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Index of single cell libraries in the local library directory.
+
+Each library is scanned once with os.scandir (libraries in parallel, as the library directory
+usually lives on NFS where every metadata call is a round trip) to find its layout (10x or
+slide-seq pipeline) and the exact files to upload with their size and modification time. The
+index is cached under ~/.lab_sc_gcp/cache/ along with the modification times of the directories
+scanned, and a library is only scanned again once one of those directories has changed. Sizes
+and modification times of files in the index can be stale (a file rewritten in place does not
+change its directory), so they must be checked again before being relied on (see
+storage.reconcile_uploads and TransferEngine.upload).
+"""
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from lab_sc_gcp.cache import cache_dir
+from lab_sc_gcp.config.configure import *
+
+config = get_config()
+
+# Files of 10x libraries (v>=3), under outs/
+files_10x = ['raw_feature_bc_matrix.h5', 'filtered_feature_bc_matrix.h5']
+dirs_10x = ['raw_feature_bc_matrix', 'filtered_feature_bc_matrix']
+# Name fragments of files of slide-seq pipeline (jp) libraries, under */alignment/
+patterns_jp = ['digital_expression_matrix', 'digital_expression_barcodes',
+               'digital_expression_features', 'digital_expression_summary']
+
+def _scandir(path):
+    # Entries of directory without hidden ones (like glob), empty if it does not exist
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries if not entry.name.startswith('.')]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def _file_record(entry, object_name):
+    stat = entry.stat()
+    return {'path': entry.path, 'object_name': object_name, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def detect_layout(library, entries):
+    # Check if generated by 10x or new pipeline (jp), from the entries of the library directory
+    short_lib = '_'.join(library.split('_')[1:])
+    bam = '{}.bam'.format(short_lib)
+    if 'outs' in entries and entries['outs'].is_dir():
+        return '10x'
+    elif bam in entries and entries[bam].is_file():
+        return 'jp'
+    return None
+
+def scan_library(library_dir, library, layout=None):
+    """
+    Layout and files to upload of one library.
+    :param library_dir:
+    :param library:
+    :param layout: '10x' or 'jp' to skip detecting the layout
+    :return: dict with layout ('10x', 'jp' or None), files (path, object_name, size and mtime of each),
+    missing (expected files not found) and dirs (modification time of each directory scanned)
+    """
+    lib_path = os.path.join(library_dir, library)
+    prefix = 'libraries/{}/'.format(library)
+    entries = {entry.name: entry for entry in _scandir(lib_path)}
+    dirs = {lib_path: os.stat(lib_path).st_mtime_ns} if entries else {}
+    files, missing = [], []
+
+    if layout is None:
+        layout = detect_layout(library, entries)
+    if layout == '10x':
+        outs = os.path.join(lib_path, 'outs')
+        try:
+            dirs[outs] = os.stat(outs).st_mtime_ns
+        except FileNotFoundError:
+            pass
+        out_entries = {entry.name: entry for entry in _scandir(outs)}
+        for name in files_10x:
+            entry = out_entries.get(name)
+            if entry is not None and entry.is_file():
+                files.append(_file_record(entry, prefix + 'outs/' + name))
+            else:
+                missing.append(os.path.join(outs, name))
+        # Walk matrix directories, keeping their layout in the bucket
+        stack = [(out_entries[name], 'outs/' + name) for name in dirs_10x
+                 if name in out_entries and out_entries[name].is_dir()]
+        while stack:
+            dir_entry, rel_path = stack.pop()
+            dirs[dir_entry.path] = dir_entry.stat().st_mtime_ns
+            for entry in sorted(_scandir(dir_entry.path), key=lambda entry: entry.name):
+                if entry.is_dir():
+                    stack.append((entry, rel_path + '/' + entry.name))
+                elif entry.is_file():
+                    files.append(_file_record(entry, prefix + rel_path + '/' + entry.name))
+    elif layout == 'jp':
+        matches = {pattern: [] for pattern in patterns_jp}
+        for sub_entry in sorted(entries.values(), key=lambda entry: entry.name):
+            if not sub_entry.is_dir():
+                continue
+            # A new alignment directory changes the modification time of its parent
+            dirs[sub_entry.path] = sub_entry.stat().st_mtime_ns
+            alignment = os.path.join(sub_entry.path, 'alignment')
+            try:
+                dirs[alignment] = os.stat(alignment).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            for entry in _scandir(alignment):
+                for pattern in patterns_jp:
+                    if pattern in entry.name and entry.is_file():
+                        matches[pattern].append(entry)
+        # Files are stored flat in the bucket
+        for pattern in patterns_jp:
+            for entry in sorted(matches[pattern], key=lambda entry: entry.path):
+                files.append(_file_record(entry, prefix + entry.name))
+
+    return {'layout': layout, 'files': files, 'missing': missing, 'dirs': dirs}
+
+class LibraryIndex(object):
+    """
+    Cached layout and file list of the libraries in a library directory.
+    """
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        library_dir=config['LOCAL']['lib_dir_sc'],
+        max_workers=config['TRANSFER']['scan_workers'],
+    ):
+        """
+        :param library_dir:
+        :param max_workers: number of libraries scanned concurrently
+        """
+        self.library_dir = library_dir
+        self.max_workers = int(max_workers)
+        key = hashlib.sha1(os.path.abspath(library_dir).encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(cache_dir, 'library-index-{}.json'.format(key))
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def names(self):
+        # Names of all libraries (directories) in library directory
+        return sorted(entry.name for entry in _scandir(self.library_dir) if entry.is_dir())
+
+    def select(self, libraries):
+        """
+        Expand glob patterns (eg. "*BICCN*") against the libraries in library directory.
+        :param libraries: list of library names or patterns
+        :return: list of library names, in the order given
+        """
+        available = None
+        names = []
+        for lib in libraries:
+            if glob.has_magic(lib):
+                if available is None:
+                    available = self.names()
+                matches = fnmatch.filter(available, lib)
+                if not matches:
+                    warnings.warn('No libraries in {} match {}.'.format(self.library_dir, lib), RuntimeWarning)
+                names.extend(m for m in matches if m not in names)
+            elif lib not in names:
+                names.append(lib)
+        return names
+
+    def _is_current(self, entry):
+        # Cached entry is current if none of the directories scanned changed. Files rewritten in place
+        # do not change their directory, so sizes and times of files are re-checked by their users.
+        if not entry['dirs']:
+            return False
+        for path, mtime_ns in entry['dirs'].items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def scan(self, libraries, refresh=False):
+        """
+        Index entries of libraries (see scan_library), scanning those not cached or changed since.
+        :param libraries: list of library names
+        :param refresh: scan all libraries again
+        :return: dict of library -> entry
+        """
+        cached = self._read()
+
+        def get_entry(lib):
+            entry = cached.get(lib)
+            if entry is not None and not refresh and self._is_current(entry):
+                return lib, entry, False
+            return lib, scan_library(self.library_dir, lib), True
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(get_entry, libraries))
+
+        scanned = {lib: entry for lib, entry, new in results if new}
+        if scanned:
+            with self._lock:
+                entries = self._read()
+                entries.update(scanned)
+                self._write(entries)
+        return {lib: entry for lib, entry, _ in results}
@@ -0,0 +1,393 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Machine type catalog, shapes and prices, and machine type recommendations from instance usage.
+
+The machine types available in a zone are fetched from the API once and cached on disk for a
+day, so listing and validating machine types usually needs no request. Custom machine types are
+validated locally against the shape rules of their family.
+
+Usage is sampled on the instance by the agent installed by the startup script, which publishes
+a summary of the last 7 days as the usage-summary guest attribute. Prices are on-demand list
+prices for us-central1 (USD per hour), good enough for comparing machine types with each other.
+"""
+import bisect
+import difflib
+import json
+import math
+import os
+import re
+import threading
+import time
+
+from lab_sc_gcp.cache import cache_dir
+from lab_sc_gcp.clients import get_service
+from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.utilities import *
+
+config = get_config()
+
+# Hours per month used for monthly prices
+hours_per_month = 730
+
+# Price per vCPU and per GB of memory and hour, for predefined and custom machine types of each family
+prices = {
+    'n1': {'vcpu': 0.031611, 'gb': 0.004237, 'custom_vcpu': 0.033174, 'custom_gb': 0.004446},
+    'n2': {'vcpu': 0.031611, 'gb': 0.004237, 'custom_vcpu': 0.033174, 'custom_gb': 0.004446},
+}
+
+# Predefined machine types: (family, kind) -> (vCPU counts, GB of memory per vCPU)
+predefined = {
+    ('n1', 'standard'): ([1, 2, 4, 8, 16, 32, 64, 96], 3.75),
+    ('n1', 'highmem'): ([2, 4, 8, 16, 32, 64, 96], 6.5),
+    ('n1', 'highcpu'): ([2, 4, 8, 16, 32, 64, 96], 0.9),
+    ('n2', 'standard'): ([2, 4, 8, 16, 32, 48, 64, 80, 96, 128], 4),
+    ('n2', 'highmem'): ([2, 4, 8, 16, 32, 48, 64, 80, 96, 128], 8),
+    ('n2', 'highcpu'): ([2, 4, 8, 16, 32, 48, 64, 80, 96], 1),
+}
+
+# Custom machine type limits per family: vCPU counts and GB of memory per vCPU (without extended memory)
+custom_limits = {
+    'n1': {'cpus': [1] + list(range(2, 97, 2)), 'cpus_rule': '1 or an even number up to 96',
+           'min_gb_per_cpu': 0.9, 'max_gb_per_cpu': 6.5},
+    'n2': {'cpus': list(range(2, 33, 2)) + list(range(36, 81, 4)),
+           'cpus_rule': 'an even number up to 32, then a multiple of 4 up to 80',
+           'min_gb_per_cpu': 0.5, 'max_gb_per_cpu': 8},
+    'n2d': {'cpus': [2, 4, 8, 16, 32, 48, 64, 80, 96], 'cpus_rule': '2, 4, 8, 16, 32, 48, 64, 80 or 96',
+            'min_gb_per_cpu': 0.5, 'max_gb_per_cpu': 8},
+    'e2': {'cpus': list(range(2, 33, 2)), 'cpus_rule': 'an even number from 2 to 32',
+           'min_gb_per_cpu': 0.5, 'max_gb_per_cpu': 8},
+}
+
+# custom-CPUS-MEMORY, FAMILY-custom-CPUS-MEMORY, optionally with -ext for extended memory
+_custom_pattern = re.compile(r'^(?:([a-z0-9]+)-)?custom-(\d+)-(\d+)(-ext)?$')
+
+def custom_name(family, cpus, mem_mb):
+    # Name of custom machine type (n1 custom types have no family prefix)
+    if family == 'n1':
+        return 'custom-{}-{}'.format(cpus, mem_mb)
+    return '{}-custom-{}-{}'.format(family, cpus, mem_mb)
+
+def parse_custom(machine_type):
+    """
+    Shape of custom machine type.
+    :return: (family, cpus, memory in MB, extended memory) or None if not a custom machine type
+    """
+    match = _custom_pattern.match(machine_type)
+    if match is None:
+        return None
+    family, cpus, mem_mb, extended = match.groups()
+    return family or 'n1', int(cpus), int(mem_mb), bool(extended)
+
+def machine_shape(machine_type):
+    """
+    Family, vCPUs and memory of a predefined or custom machine type.
+    :param machine_type: eg. n1-highmem-8, custom-4-5120, n2-custom-4-5120
+    :return: (family, cpus, memory in GB, custom)
+    """
+    custom = parse_custom(machine_type)
+    if custom is not None:
+        return custom[0], custom[1], custom[2] / 1024.0, True
+    parts = machine_type.split('-')
+    try:
+        cpu_counts, gb_per_cpu = predefined[(parts[0], parts[1])]
+        cpus = int(parts[2])
+    except (IndexError, KeyError, ValueError):
+        raise RuntimeError('Unknown machine type {}.'.format(machine_type))
+    if cpus not in cpu_counts:
+        raise RuntimeError('Unknown machine type {}.'.format(machine_type))
+    return parts[0], cpus, cpus * gb_per_cpu, False
+
+def custom_shape_error(family, cpus, mem_mb, extended=False):
+    """
+    Why a custom machine shape is not allowed, None if it is.
+    :param family: n1, n2, n2d or e2
+    :param cpus: number of vCPUs
+    :param mem_mb: memory in MB
+    :param extended: extended memory (no upper bound on memory per vCPU)
+    """
+    if family not in custom_limits:
+        return 'Custom machine types are only available for families {}.'.format(', '.join(sorted(custom_limits)))
+    limits = custom_limits[family]
+    if cpus not in limits['cpus']:
+        return 'The number of vCPUs of {} custom machine types must be {} (got {}).'.format(
+            family, limits['cpus_rule'], cpus)
+    if mem_mb % 256:
+        return 'Memory of custom machine types must be a multiple of 256 MB (got {} MB).'.format(mem_mb)
+    gb_per_cpu = mem_mb / 1024.0 / cpus
+    if gb_per_cpu < limits['min_gb_per_cpu'] or (gb_per_cpu > limits['max_gb_per_cpu'] and not extended):
+        return '{} custom machine types need {} to {} GB of memory per vCPU (got {:.2f}).'.format(
+            family, limits['min_gb_per_cpu'], limits['max_gb_per_cpu'], gb_per_cpu)
+    return None
+
+def price(machine_type):
+    # On-demand price of machine type in USD per hour
+    family, cpus, mem_gb, custom = machine_shape(machine_type)
+    if family not in prices:
+        raise RuntimeError('No prices for machine family {}.'.format(family))
+    rates = prices[family]
+    if custom:
+        return cpus * rates['custom_vcpu'] + mem_gb * rates['custom_gb']
+    return cpus * rates['vcpu'] + mem_gb * rates['gb']
+
+def parse_memory(value):
+    """
+    Memory size in MB from a string like 100G, 512M, 1.5T or 100 (GB).
+    """
+    match = re.match(r'^\s*([\d.]+)\s*([mgt]?)b?\s*$', str(value), re.IGNORECASE)
+    if match is None:
+        raise RuntimeError('Cannot read memory size {} (expected eg. 100G or 512M).'.format(value))
+    factor = {'m': 1, 'g': 1024, 't': 1024 ** 2, '': 1024}[match.group(2).lower()]
+    return float(match.group(1)) * factor
+
+def machine_family(machine_type):
+    # Family of machine type, eg. n2 for n2-highmem-8, n1 for custom-4-5120
+    custom = parse_custom(machine_type)
+    return custom[0] if custom is not None else machine_type.split('-')[0]
+
+class MachineTypeCatalog(object):
+    """
+    Machine types available in a zone, fetched from the API and cached on disk.
+    Machine types are indexed by name and, per family, sorted by vCPUs for range queries.
+    """
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        project=config['GCP']['gcp_project_id'],
+        zone=config['GCP']['gcp_zone'],
+        ttl=config['CACHE']['machine_type_ttl'],
+    ):
+        self.project = project
+        self.zone = zone
+        self.ttl = float(ttl)
+        self.path = os.path.join(cache_dir, 'machine-types-{}-{}.json'.format(project, zone))
+        self.machine_types = None
+        self.fetched_at = None
+
+    def _fetch(self):
+        machine_types = []
+        service = get_service('compute', 'v1')
+        page_token = None
+        while True:
+            res = service.machineTypes().list(project=self.project,
+                                              zone=self.zone,
+                                              fields='items(name,guestCpus,memoryMb,isSharedCpu),nextPageToken',
+                                              pageToken=page_token).execute()
+            machine_types.extend({'name': item['name'],
+                                  'cpus': item['guestCpus'],
+                                  'mem_mb': item['memoryMb'],
+                                  'shared_cpu': item.get('isSharedCpu', False)} for item in res.get('items', []))
+            page_token = res.get('nextPageToken')
+            if not page_token:
+                return machine_types
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, entry):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self, refresh=False):
+        """
+        Read catalog from cache, fetching it from the API if missing, expired or refresh is set.
+        :return: self
+        """
+        entry = None if refresh else self._read()
+        if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+            entry = {'fetched_at': time.time(), 'machine_types': self._fetch()}
+            with self._lock:
+                self._write(entry)
+        self.fetched_at = entry['fetched_at']
+        self.machine_types = sorted(entry['machine_types'], key=lambda item: (item['cpus'], item['mem_mb'],
+                                                                              item['name']))
+        self._by_name = {item['name']: item for item in self.machine_types}
+        self._by_family = {}
+        for item in self.machine_types:
+            self._by_family.setdefault(machine_family(item['name']), []).append(item)
+        self._family_cpus = {family: [item['cpus'] for item in items] for family, items in self._by_family.items()}
+        return self
+
+    def _loaded(self):
+        return self if self.machine_types is not None else self.load()
+
+    def get(self, name):
+        # Machine type entry, None if not available in zone
+        return self._loaded()._by_name.get(name)
+
+    def families(self):
+        return sorted(self._loaded()._by_family)
+
+    def query(self, min_cpus=0, min_mem_mb=0, family=None, max_cpus=None):
+        """
+        Machine types with at least min_cpus vCPUs and min_mem_mb of memory.
+        :param family: only this family (eg. n2), all families if None
+        :return: list of machine type entries, by vCPUs and memory
+        """
+        self._loaded()
+        families = [family] if family else list(self._by_family)
+        results = []
+        for name in families:
+            items = self._by_family.get(name, [])
+            # Skip smaller machine types without looking at them
+            start = bisect.bisect_left(self._family_cpus.get(name, []), min_cpus)
+            results.extend(item for item in items[start:]
+                           if item['mem_mb'] >= min_mem_mb and (max_cpus is None or item['cpus'] <= max_cpus))
+        return sorted(results, key=lambda item: (item['cpus'], item['mem_mb'], item['name']))
+
+def validate_machine_type(
+    machine_type,
+    project=config['GCP']['gcp_project_id'],
+    zone=config['GCP']['gcp_zone'],
+):
+    """
+    Check machine type before sending a request with it. Custom shapes are checked locally,
+    predefined machine types against the (cached) catalog of the zone.
+    :raises RuntimeError: if the machine type is not available
+    """
+    custom = parse_custom(machine_type)
+    if custom is not None:
+        error = custom_shape_error(*custom)
+        if error is not None:
+            raise RuntimeError('Invalid custom machine type {}: {}'.format(machine_type, error))
+        return
+    catalog = MachineTypeCatalog(project=project, zone=zone)
+    if catalog.get(machine_type) is None:
+        suggestions = difflib.get_close_matches(machine_type, [item['name'] for item in catalog.machine_types])
+        raise RuntimeError('Machine type {} is not available in zone {}.{}'.format(
+            machine_type, zone, ' Did you mean {}?'.format(' or '.join(suggestions)) if suggestions else '') +
+            ' List machine types with "lab-gcp list-machine-types".')
+
+def cheapest_custom(family, cpus, mem_gb):
+    """
+    Smallest allowed custom machine type of family with at least cpus vCPUs and mem_gb of memory.
+    :return: machine type name, None if no custom shape is large enough
+    """
+    limits = custom_limits[family]
+    mem_mb = int(math.ceil(mem_gb * 1024 / 256.0)) * 256
+    for count in limits['cpus']:
+        if count < cpus or mem_mb / 1024.0 / count > limits['max_gb_per_cpu']:
+            continue
+        # Round memory up to the minimum for this many vCPUs
+        shape_mb = max(mem_mb, int(math.ceil(count * limits['min_gb_per_cpu'] * 1024 / 256.0)) * 256)
+        return custom_name(family, count, shape_mb)
+    return None
+
+def fitting_machine_types(cpus, mem_gb, families=('n1', 'n2')):
+    """
+    Predefined machine types, and the smallest custom machine type of each family, with at least
+    cpus vCPUs and mem_gb of memory.
+    :return: list of (machine type, price per hour), cheapest first
+    """
+    machine_types = []
+    for (family, kind), (cpu_counts, gb_per_cpu) in predefined.items():
+        if family in families:
+            machine_types.extend('{}-{}-{}'.format(family, kind, count) for count in cpu_counts
+                                 if count >= cpus and count * gb_per_cpu >= mem_gb)
+    for family in families:
+        custom = cheapest_custom(family, cpus, mem_gb)
+        if custom is not None:
+            machine_types.append(custom)
+    return sorted(((machine_type, price(machine_type)) for machine_type in machine_types),
+                  key=lambda item: item[1])
+
+def parse_usage_summary(summary):
+    # Usage summary published by the instance agent ("key=value ..."), as a dict of floats
+    usage = {}
+    for item in summary.split():
+        key, _, value = item.partition('=')
+        try:
+            usage[key] = float(value)
+        except ValueError:
+            continue
+    return usage
+
+def usage_requirements(usage, headroom=0.2, cpu_stat='p95'):
+    """
+    vCPUs and memory needed for the observed usage.
+    Memory covers the peak working set, including what was pushed out to swap.
+    :param usage: parsed usage summary
+    :param headroom: fraction added on top of observed usage
+    :param cpu_stat: 'p95' (95th percentile of per minute peaks) or 'peak'
+    :return: (vCPUs, memory in GB)
+    """
+    cpus = usage['cpu_{}'.format(cpu_stat)] * (1 + headroom)
+    mem_gb = (usage['mem_peak_mb'] + usage.get('swap_peak_mb', 0)) / 1024.0 * (1 + headroom)
+    return max(1, int(math.ceil(cpus - 0.01))), max(1.0, mem_gb)
+
+def recommendation_report(machine_type, usage, headroom=0.2, cpu_stat='p95', families=('n1', 'n2'), count=5):
+    """
+    Observed usage, machine types fitting it and the cheapest one.
+    :param machine_type: current machine type of instance
+    :param usage: parsed usage summary
+    :return: (report string, recommended machine type or None)
+    """
+    lines = ['Usage over the last {:.1f} hours on {:.0f} vCPUs and {:.1f} GB of memory:'.format(
+        usage.get('window', 0) / 3600.0, usage.get('cpus', 0), usage.get('mem_total_mb', 0) / 1024.0)]
+    lines.append(format_table([
+        ['vCPUs busy', '{:.2f}'.format(usage.get('cpu_p95', 0)), '{:.2f}'.format(usage.get('cpu_peak', 0))],
+        ['memory used', format_bytes(usage.get('mem_p95_mb', 0) * 2 ** 20),
+         format_bytes(usage.get('mem_peak_mb', 0) * 2 ** 20)],
+        ['swap used', '', format_bytes(usage.get('swap_peak_mb', 0) * 2 ** 20)],
+        ['swap I/O', '', '{:.0f} pages/s'.format(usage.get('swap_io_peak', 0))],
+        ['disk I/O', '', '{}/s'.format(format_bytes(usage.get('disk_peak_kbps', 0) * 1024))],
+    ], ['', 'P95', 'PEAK']))
+    if usage.get('window', 0) < 3600:
+        lines.append('Warning: less than an hour of usage observed, run your usual analyses first.')
+    if usage.get('swap_io_peak', 0) > 0:
+        lines.append('The instance swapped, so memory use would have been higher with more memory.')
+
+    cpus, mem_gb = usage_requirements(usage, headroom=headroom, cpu_stat=cpu_stat)
+    lines.append('Needed with {:.0f}% headroom: {} vCPUs, {:.1f} GB of memory.'.format(headroom * 100, cpus, mem_gb))
+    candidates = fitting_machine_types(cpus, mem_gb, families=families)
+    if not candidates:
+        lines.append('No machine type of families {} is large enough.'.format(', '.join(families)))
+        return '\n'.join(lines), None
+
+    try:
+        current_price = price(machine_type)
+    except RuntimeError:
+        current_price = None
+    rows = [[name, '${:.3f}'.format(hourly), '${:.0f}'.format(hourly * hours_per_month)]
+            for name, hourly in candidates[:count]]
+    lines.append(format_table(rows, ['MACHINE TYPE', 'PER HOUR', 'PER MONTH']))
+
+    recommended, recommended_price = candidates[0]
+    if recommended == machine_type:
+        lines.append('The current machine type {} is already the cheapest fit.'.format(machine_type))
+        return '\n'.join(lines), None
+    if current_price is not None:
+        lines.append('Current machine type {} costs ${:.3f} per hour; {} would {} ${:.0f} per month.'.format(
+            machine_type, current_price, recommended,
+            'save' if recommended_price <= current_price else 'cost an extra',
+            abs(current_price - recommended_price) * hours_per_month))
+    return '\n'.join(lines), recommended
+
+def recommend_machine_type(instance_m, headroom=0.2, cpu_stat='p95', families=('n1', 'n2')):
+    """
+    Recommend machine type for instance from the usage published by its agent.
+    :param instance_m: GCEInstanceManager
+    :return: (report string, recommended machine type or None)
+    """
+    instance = instance_m.get()
+    if instance['status'] != 'RUNNING':
+        raise RuntimeError('Instance {} is {}. Usage is only published while it is running, '.format(
+            instance_m.name, instance['status']) + 'please start it first.')
+    summary = instance_m.get_guest_attributes().get('usage-summary')
+    if not summary:
+        raise RuntimeError('Instance {} has not published usage yet. '.format(instance_m.name) +
+                           'Usage is published every minute by instances created with this version of lab-gcp.')
+    return recommendation_report(instance['machineType'].split('/')[-1],
+                                 parse_usage_summary(summary),
+                                 headroom=headroom,
+                                 cpu_stat=cpu_stat,
+                                 families=families)
@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Waiting on long running Google Cloud operations and resources.
+
+Polls with exponential backoff instead of sleeping for a fixed time, so callers continue
+as soon as an operation is done and fail with a clear message if it errors or times out.
+"""
+import time
+
+from lab_sc_gcp.clients import get_service
+
+# Calls per HTTP batch request (the API allows up to 1000, smaller batches fail less as a whole)
+batch_size = 100
+
+def poll(fetch, is_done, timeout=300, initial_delay=1.0, max_delay=10.0, description='operation'):
+    """
+    Call fetch() until is_done(result) is true, backing off exponentially between calls.
+    :param fetch: function returning the current state
+    :param is_done: function of the state returning True when finished
+    :param timeout: seconds before giving up
+    :param initial_delay: seconds before the second call
+    :param max_delay: upper bound on seconds between calls
+    :param description: used in the timeout error message
+    :return: final state
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        result = fetch()
+        if is_done(result):
+            return result
+        if time.time() + delay > deadline:
+            raise RuntimeError('Timed out after {}s waiting for {}.'.format(timeout, description))
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def _last_path_part(url):
+    return url.split('/')[-1]
+
+def operation_errors(operation):
+    # Error messages of a finished compute operation
+    errors = operation.get('error', {}).get('errors', [])
+    return [error.get('message', error.get('code', '')) for error in errors]
+
+def execute_batch(service, requests):
+    """
+    Execute many API requests as HTTP batch requests.
+    :param service: API client the requests belong to
+    :param requests: dict of request id (string) -> request
+    :return: dict of request id -> (response, exception), one of which is None
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    request_ids = list(requests)
+    for i in range(0, len(request_ids), batch_size):
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id in request_ids[i:i + batch_size]:
+            batch.add(requests[request_id], request_id=request_id)
+        batch.execute()
+    return results
+
+def operation_request(service, operation, project):
+    # Unexecuted get request for a global, regional or zonal compute operation
+    if operation.get('zone'):
+        return service.zoneOperations().get(project=project,
+                                            zone=_last_path_part(operation['zone']),
+                                            operation=operation['name'])
+    elif operation.get('region'):
+        return service.regionOperations().get(project=project,
+                                              region=_last_path_part(operation['region']),
+                                              operation=operation['name'])
+    return service.globalOperations().get(project=project,
+                                          operation=operation['name'])
+
+def get_compute_operation(operation, project):
+    """
+    Fetch current state of a global, regional or zonal compute operation.
+    :param operation: operation resource (as returned by insert, start, etc.)
+    :param project:
+    :return: operation resource
+    """
+    return operation_request(get_service('compute', 'v1'), operation, project).execute()
+
+def wait_for_operation(operation, project, timeout=300):
+    """
+    Wait for a global, regional or zonal compute operation to finish.
+    :param operation: operation resource (as returned by insert, start, etc.)
+    :param project:
+    :param timeout: seconds before giving up
+    :return: finished operation resource
+    """
+    target = _last_path_part(operation.get('targetLink', operation['name']))
+    description = '{} of {}'.format(operation.get('operationType', 'operation'), target)
+    if operation.get('status') != 'DONE':
+        operation = poll(lambda: get_compute_operation(operation, project),
+                         lambda op: op.get('status') == 'DONE',
+                         timeout=timeout,
+                         description=description)
+
+    errors = operation_errors(operation)
+    if errors:
+        raise RuntimeError('{} failed: {}'.format(description, '; '.join(errors)))
+    return operation
+
+def wait_for_operations(operations, project, timeout=600, initial_delay=1.0, max_delay=10.0):
+    """
+    Wait for many compute operations together, polling all unfinished ones in batch requests.
+    :param operations: dict of key (string) -> operation resource
+    :param project:
+    :param timeout: seconds before giving up on unfinished operations
+    :param initial_delay: seconds before the first poll
+    :param max_delay: upper bound on seconds between polls
+    :return: dict of key -> error message, or None if the operation succeeded
+    """
+    service = get_service('compute', 'v1')
+    results = {}
+    pending = {}
+    for key, operation in operations.items():
+        if operation.get('status') == 'DONE':
+            results[key] = '; '.join(operation_errors(operation)) or None
+        else:
+            pending[key] = operation
+
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while pending:
+        if time.time() + delay > deadline:
+            for key in pending:
+                results[key] = 'Timed out after {}s.'.format(timeout)
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+        responses = execute_batch(service, {key: operation_request(service, operation, project)
+                                            for key, operation in pending.items()})
+        for key, (operation, exception) in responses.items():
+            if exception is not None:
+                results[key] = str(exception)
+            elif operation.get('status') == 'DONE':
+                results[key] = '; '.join(operation_errors(operation)) or None
+            else:
+                continue
+            del pending[key]
+
+    return results
+
+def wait_for_long_running_operation(operation, service, timeout=300):
+    """
+    Wait for a long running operation of an API with an operations collection
+    (eg. resource manager or service usage).
+    :param operation: operation resource with "name" and "done" fields
+    :param service: API client that created the operation
+    :param timeout: seconds before giving up
+    :return: finished operation resource
+    """
+    if not operation.get('done'):
+        operation = poll(lambda: service.operations().get(name=operation['name']).execute(),
+                         lambda op: op.get('done'),
+                         timeout=timeout,
+                         description='operation {}'.format(operation['name']))
+
+    if 'error' in operation:
+        raise RuntimeError('Operation {} failed: {}'.format(operation['name'],
+                                                            operation['error'].get('message', '')))
+    return operation
@@ -6,12 +6,18 @@ Functions for managing Google Cloud projects.
 
 """
 
-from googleapiclient.discovery import build
-from google.cloud import storage
+import base64
+import hashlib
+import json
+import os
+import shutil
+from subprocess import PIPE, run
+
+from lab_sc_gcp.clients import get_service, get_storage_client
 from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.operations import execute_batch, poll, wait_for_long_running_operation, wait_for_operations
+from lab_sc_gcp.steps import Step, run_steps
 from lab_sc_gcp.utilities import *
-from pkg_resources import resource_filename
-import time
 
 config = get_config()
 
@@ -25,7 +31,7 @@ def create_project(
     billing_account,
     set_default=False,
 ):
-    service = build('cloudresourcemanager', 'v1')
+    service = get_service('cloudresourcemanager', 'v1')
     projects = service.projects()
 
     # Note that user can only specify billing after creation
@@ -38,11 +44,11 @@ def create_project(
         }
     )
     res = req.execute()
-    # Prevent permissions errors
-    time.sleep(10)
+    # Project must exist before billing can be attached
+    res = wait_for_long_running_operation(res, service)
 
     # Add billing info
-    service = build('cloudbilling', 'v1')
+    service = get_service('cloudbilling', 'v1')
     projects = service.projects()
 
     # https://developers.google.com/resources/api-libraries/documentation/cloudbilling/v1/python/latest/cloudbilling_v1.projects.html
@@ -75,7 +81,7 @@ def create_bucket(
     # Convert compute region zone to region (works for most zones)
     location = '-'.join(location.split('-')[:-1])
 
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
 
     bucket = storage_client.create_bucket(
         bucket_or_name=name,
@@ -95,172 +101,584 @@ def create_bucket(
 
     return bucket
 
+# APIs used by instances and by the shutdown/startup schedule
+compute_apis = ['compute.googleapis.com']
+function_apis = ['cloudfunctions.googleapis.com', 'pubsub.googleapis.com', 'cloudscheduler.googleapis.com',
+                 'appengine.googleapis.com']
+
+def ensure_apis(apis, project=config['GCP']['gcp_project_id']):
+    """
+    Enable APIs that are not enabled yet, all in one Service Usage batch call.
+    :param apis: list of service names, eg. compute.googleapis.com
+    :return: outcome
+    """
+    service = get_service('serviceusage', 'v1')
+    parent = 'projects/{}'.format(project)
+    current = service.services().batchGet(parent=parent,
+                                          names=['{}/services/{}'.format(parent, api) for api in apis]).execute()
+    enabled = set(api['config']['name'] for api in current.get('services', []) if api.get('state') == 'ENABLED')
+    missing = [api for api in apis if api not in enabled]
+    if not missing:
+        return 'already enabled'
+    operation = service.services().batchEnable(parent=parent, body={'serviceIds': missing}).execute()
+    wait_for_long_running_operation(operation, service, timeout=600)
+    return 'enabled {}'.format(', '.join(missing))
+
+def ensure_app_engine(project=config['GCP']['gcp_project_id'], location='us-central'):
+    """
+    Create App Engine app (needed by Cloud Scheduler) if project has none.
+    :return: outcome
+    """
+    apps = get_service('appengine', 'v1').apps()
+    if _get_or_none(apps.get(appsId=project)) is not None:
+        return 'already exists'
+    operation = apps.create(body={'id': project, 'locationId': location}).execute()
+    operation_id = operation['name'].split('/')[-1]
+    operation = poll(lambda: apps.operations().get(appsId=project, operationsId=operation_id).execute(),
+                     lambda op: op.get('done'),
+                     timeout=600,
+                     description='App Engine app creation')
+    if 'error' in operation:
+        raise RuntimeError('App Engine app creation failed: {}'.format(operation['error'].get('message', '')))
+    return 'created in {}'.format(location)
+
 def enable_apis(
     project=config['GCP']['gcp_project_id'],
     exclude_compute=False,
     exclude_functions=False,
 ):
+    apis = []
     if not exclude_compute:
-        call(['gcloud', 'services', 'enable', 'compute.googleapis.com',
-              '--project', project])
-        print('Enabled Compute Engine API.')
+        apis.extend(compute_apis)
+    if not exclude_functions:
+        apis.extend(function_apis)
+    if apis:
+        print('APIs: {}.'.format(ensure_apis(apis, project=project)))
     if not exclude_functions:
-        call(['gcloud', 'services', 'enable', 'cloudfunctions.googleapis.com',
-              'pubsub.googleapis.com', 'cloudscheduler.googleapis.com',
-              'appengine.googleapis.com', '--project', project])
         # Create app engine app in central region for now
-        call(['gcloud', 'app', 'create', '--region', 'us-central', '--project', project])
-        print('Enabled Cloud Functions,Pub/Sub and Scheduler APIs.')
-
-def configure_network(
+        print('App Engine app: {}.'.format(ensure_app_engine(project=project)))
+
+# Cloud Functions and Cloud Scheduler location (Scheduler uses the App Engine app region, see enable_apis)
+schedule_location = 'us-central1'
+# Runtimes must be supported by Cloud Functions, see https://cloud.google.com/functions/docs/runtime-support
+functions_runtime = 'nodejs22'
+python_functions_runtime = 'python312'
+
+# Deployed function name and entry point per schedule engine and action
+# (nodejs: shipped schedule/index.js, python: lab_sc_gcp/scheduler.py)
+schedule_engines = {
+    'nodejs': {'stop': ('stopInstancePubSub', 'stopInstancePubSub'),
+               'start': ('startInstancePubSub', 'startInstancePubSub')},
+    'python': {'stop': ('stopInstancesPy', 'stop_instances_pubsub'),
+               'start': ('startInstancesPy', 'start_instances_pubsub')},
+}
+# Where the Python schedule engine is staged for deployment
+engine_source_dir = os.path.join(os.path.dirname(user_config), 'functions', 'scheduler')
+
+# Desired network configuration, reconciled by configure_network
+network_name = 'managed'
+subnet_name = 'managed-subnet'
+subnet_range = '10.100.1.0/24'
+# Default rules opening SSH and RDP to the internet
+closed_firewalls = ['default-allow-rdp', 'default-allow-ssh']
+
+def managed_firewalls(source_ranges=allowed_ips):
+    # Firewall rules for managed network (access to default RStudio, jupyter, and SSH ports)
+    rules = [('managed-allow-ssh', ['22']), ('managed-allow-rstudio', ['8787', '8888'])]
+    return {name: {
+        "name": name,
+        "network": "global/networks/{}".format(network_name),
+        "allowed": [{
+            "IPProtocol": "tcp",
+            "ports": ports,
+        }],
+        "logConfig": {
+            "enable": True,
+        },
+        "sourceRanges": source_ranges,
+    } for name, ports in rules}
+
+def _firewall_state(rule):
+    # Parts of a firewall rule managed by configure_network, in comparable form
+    return (rule.get('network', '').split('/')[-1],
+            sorted((allowed['IPProtocol'], sorted(allowed.get('ports', []))) for allowed in rule.get('allowed', [])),
+            sorted(rule.get('sourceRanges', [])),
+            rule.get('logConfig', {}).get('enable', False))
+
+def _not_found(exception):
+    return getattr(getattr(exception, 'resp', None), 'status', None) == 404
+
+def plan_network(
     project=config['GCP']['gcp_project_id'],
     region=config['GCP']['gcp_zone'],
 ):
+    """
+    Compare current network configuration of project with the desired one.
+    Current state is fetched with a single batch request (plus one request per further page of
+    firewall rules).
+    :param project:
+    :param region: region (or zone in region) of subnetwork
+    :return: list of (description, request function of compute client, whether it needs the network)
+    """
+    service = get_service('compute', 'v1')
+    # Convert compute region zone to region (works for most zones)
+    if len(region.split('-')) > 2:
+        region = '-'.join(region.split('-')[:-1])
+
+    firewalls_req = service.firewalls().list(
+        project=project, fields='items(name,network,allowed,sourceRanges,logConfig),nextPageToken')
+    state = execute_batch(service, {
+        'network': service.networks().get(project=project, network=network_name),
+        'subnet': service.subnetworks().get(project=project, region=region, subnetwork=subnet_name),
+        'firewalls': firewalls_req,
+    })
+    for key, (_, exception) in state.items():
+        if exception is not None and not _not_found(exception):
+            raise RuntimeError('Could not get current {} configuration: {}'.format(key, exception))
+    network, subnet = state['network'][0], state['subnet'][0]
+    firewalls = {}
+    res = state['firewalls'][0]
+    while res is not None:
+        firewalls.update((rule['name'], rule) for rule in res.get('items', []))
+        firewalls_req = service.firewalls().list_next(previous_request=firewalls_req, previous_response=res)
+        res = firewalls_req.execute() if firewalls_req is not None else None
+
+    changes = []
     # Best practices outlined in https://dsp-security.broadinstitute.org/cloud-security/google-cloud-platform/securing-the-network
-    service = build('compute', 'v1')
-    firewalls = service.firewalls()
-
-    # TODO: clean up error messages if configuration steps already done
     # First close default SSH and RDP access
-    try:
-        res = firewalls.delete(
-            firewall='default-allow-rdp',
-            project=project,
-        ).execute()
-    except Exception as e:
-        print(e)
-
-    try:
-        res = firewalls.delete(
-            firewall='default-allow-ssh',
-            project=project,
-        ).execute()
-    except Exception as e:
-        print(e)
+    for name in closed_firewalls:
+        if name in firewalls:
+            changes.append(('Delete firewall rule {}'.format(name),
+                            lambda s, name=name: s.firewalls().delete(project=project, firewall=name),
+                            False))
 
     # Create a managed network and subnet
-    networks = service.networks()
-    req = networks.insert(
-        project=project,
-        body={
-            "name": "managed",
-            "autoCreateSubnetworks": True,
-        }
-    )
-    try:
-        res = req.execute()
-        print("Managed network created.")
-    except Exception as e:
-        print(e)
-    # Network needs some time to be ready
-    time.sleep(30)
-
-    # Convert compute region zone to region (works for most zones)
-    region = '-'.join(region.split('-')[:-1])
+    if network is None:
+        changes.append(('Create network {}'.format(network_name),
+                        lambda s: s.networks().insert(project=project, body={
+                            "name": network_name,
+                            "autoCreateSubnetworks": True,
+                        }),
+                        False))
+    if subnet is None:
+        changes.append(('Create subnetwork {} in {}'.format(subnet_name, region),
+                        lambda s: s.subnetworks().insert(project=project, region=region, body={
+                            "name": subnet_name,
+                            "network": "global/networks/{}".format(network_name),
+                            "ipCidrRange": subnet_range,
+                            "enableFlowlogs": True,
+                        }),
+                        True))
+    elif subnet['ipCidrRange'] != subnet_range:
+        print('Warning: subnetwork {} has range {} instead of {}, leaving it unchanged.'.format(
+            subnet_name, subnet['ipCidrRange'], subnet_range))
+
+    # Firewall rules, updated in place if they differ from the desired rules
+    for name, rule in managed_firewalls().items():
+        if name not in firewalls:
+            changes.append(('Create firewall rule {}'.format(name),
+                            lambda s, rule=rule: s.firewalls().insert(project=project, body=rule),
+                            True))
+        elif _firewall_state(firewalls[name]) != _firewall_state(rule):
+            changes.append(('Update firewall rule {}'.format(name),
+                            lambda s, name=name, rule=rule: s.firewalls().update(project=project,
+                                                                                firewall=name,
+                                                                                body=rule),
+                            False))
+    return changes
 
-    subnetworks = service.subnetworks()
-    req = subnetworks.insert(
-        project=project,
-        region=region,
-        body={
-            "name": "managed-subnet",
-            "network": "global/networks/managed",
-            "ipCidrRange": "10.100.1.0/24",
-            "enableFlowlogs": True,
-        }
-    )
+def configure_network(
+    project=config['GCP']['gcp_project_id'],
+    region=config['GCP']['gcp_zone'],
+):
+    """
+    Bring network, subnetwork and firewall rules of project in line with the desired configuration.
+    Independent changes are sent together in batch requests and their operations awaited together;
+    changes that need the network wait for it to be created first. Safe to rerun.
+    :param project:
+    :param region: region (or zone in region) of subnetwork
+    :return: list of descriptions of changes made
+    """
+    changes = plan_network(project=project, region=region)
+    if not changes:
+        print('Network configuration is up to date.')
+        return []
+
+    creating_network = any(description.startswith('Create network') for description, _, _ in changes)
+    rounds = [changes]
+    if creating_network:
+        # Subnetwork and firewall rules can only be added once the network exists
+        rounds = [[change for change in changes if not change[2]],
+                  [change for change in changes if change[2]]]
+
+    service = get_service('compute', 'v1')
+    failed = []
+    for round_changes in rounds:
+        if not round_changes:
+            continue
+        responses = execute_batch(service, {description: make_request(service)
+                                            for description, make_request, _ in round_changes})
+        results, operations = {}, {}
+        for description, (operation, exception) in responses.items():
+            if exception is None:
+                operations[description] = operation
+            else:
+                results[description] = str(exception)
+        results.update(wait_for_operations(operations, project))
+
+        for description, _, _ in round_changes:
+            error = results[description]
+            print('{}: {}'.format(description, 'done' if error is None else 'FAILED ({})'.format(error)))
+            if error is not None:
+                failed.append(description)
+        if failed:
+            break
+
+    if failed:
+        raise RuntimeError('{} network configuration change(s) failed. '.format(len(failed)) +
+                           'Rerun the command to retry.')
+    return [description for description, _, _ in changes]
+
+def _get_or_none(req):
+    # Execute get request, None if resource does not exist
+    from googleapiclient.errors import HttpError
     try:
-        res = req.execute()
-        print("Managed subnetwork created.")
-    except Exception as e:
-        print(e)
-
-    # Create firewall rules for managed network (access to default RStudio, jupyter, and SSH ports)
-    req = firewalls.insert(
-        project=project,
-        body={
-            "name": "managed-allow-ssh",
-            "network": "global/networks/managed",
-            "allowed": {
-                "IPProtocol": "tcp",
-                "ports": ["22"],
-            },
-            "logConfig": {
-                "enable": True,
-            },
-            "sourceRanges": allowed_ips,
-        }
-    )
-    res = req.execute()
-    print('SSH firewall rule created.')
-
-    # Rstudio and jupyter
-    req = firewalls.insert(
-        project=project,
-        body={
-            "name": "managed-allow-rstudio",
-            "network": "global/networks/managed",
-            "allowed": {
-                "IPProtocol": "tcp",
-                "ports": ["8787", "8888"],
-            },
-            "logConfig": {
-                "enable": True,
-            },
-            "sourceRanges": allowed_ips,
-        }
-    )
-    res = req.execute()
-    print("RStudio/jupyter firewall rule created.")
+        return req.execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+
+def source_hash(source_dir):
+    # Digest of all files in source directory, used to tell whether a function needs redeploying
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(source_dir)):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, source_dir).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def ensure_topic(topic, project=config['GCP']['gcp_project_id']):
+    """
+    Create Pub/Sub topic if it does not exist.
+    :return: outcome
+    """
+    from googleapiclient.errors import HttpError
+    topics = get_service('pubsub', 'v1').projects().topics()
+    name = 'projects/{}/topics/{}'.format(project, topic)
+    if _get_or_none(topics.get(topic=name)) is not None:
+        return 'already exists'
+    try:
+        topics.create(name=name, body={}).execute()
+    except HttpError as e:
+        # Created concurrently
+        if e.resp.status == 409:
+            return 'already exists'
+        raise
+    return 'created'
+
+def stage_engine_source():
+    # Function source directory with the Python schedule engine as main.py
+    os.makedirs(engine_source_dir, exist_ok=True)
+    shutil.copyfile(package_path('scheduler.py'), os.path.join(engine_source_dir, 'main.py'))
+    with open(os.path.join(engine_source_dir, 'requirements.txt'), 'w') as f:
+        f.write('google-api-python-client\ngoogle-auth\n')
+    return engine_source_dir
+
+def ensure_function(
+    function,
+    topic,
+    project=config['GCP']['gcp_project_id'],
+    source_dir=package_path('schedule'),
+    runtime=functions_runtime,
+    entry_point=None,
+):
+    """
+    Deploy Cloud Function triggered by topic, unless the deployed function has the same source
+    and runtime. Deployed functions are labeled with a hash of their source.
+    :return: outcome
+    """
+    digest = source_hash(source_dir)
+    functions = get_service('cloudfunctions', 'v1').projects().locations().functions()
+    current = _get_or_none(functions.get(name='projects/{}/locations/{}/functions/{}'.format(
+        project, schedule_location, function)))
+    if (current is not None and current.get('status') == 'ACTIVE' and
+            current.get('runtime') == runtime and
+            current.get('labels', {}).get('source-hash') == digest and
+            current.get('eventTrigger', {}).get('resource', '').endswith('/topics/{}'.format(topic))):
+        return 'already up to date'
+
+    # Deploying needs the source uploaded and built, which gcloud takes care of
+    # Got source from https://github.com/GoogleCloudPlatform/nodejs-docs-samples
+    # 1st gen functions, as both engines are background functions and are looked up with the v1 API
+    res = run(['gcloud', 'functions', 'deploy', function, '--no-gen2', '--trigger-topic', topic,
+               '--project', project, '--region', schedule_location,
+               '--runtime', runtime, '--source', source_dir,
+               '--entry-point', entry_point or function,
+               '--update-labels', 'source-hash={}'.format(digest), '--quiet'],
+              stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr.strip().splitlines()[-1] if res.stderr.strip() else 'gcloud failed')
+    return 'updated' if current is not None else 'deployed'
+
+def ensure_function_deleted(function, project=config['GCP']['gcp_project_id']):
+    """
+    Delete Cloud Function if it is deployed (eg. the function of the schedule engine not in use).
+    :return: outcome
+    """
+    service = get_service('cloudfunctions', 'v1')
+    functions = service.projects().locations().functions()
+    name = 'projects/{}/locations/{}/functions/{}'.format(project, schedule_location, function)
+    if _get_or_none(functions.get(name=name)) is None:
+        return 'not deployed'
+    operation = functions.delete(name=name).execute()
+    wait_for_long_running_operation(operation, service, timeout=600)
+    return 'deleted'
+
+def ensure_scheduler_job(
+    job,
+    schedule,
+    topic,
+    message,
+    project=config['GCP']['gcp_project_id'],
+    time_zone='America/New_York',
+):
+    """
+    Create Cloud Scheduler job publishing message to topic, or update it in place if it differs.
+    :param schedule: cron schedule, eg. "59 23 * * *"
+    :return: outcome
+    """
+    jobs = get_service('cloudscheduler', 'v1').projects().locations().jobs()
+    parent = 'projects/{}/locations/{}'.format(project, schedule_location)
+    body = {
+        'name': '{}/jobs/{}'.format(parent, job),
+        'schedule': schedule,
+        'timeZone': time_zone,
+        'pubsubTarget': {
+            'topicName': 'projects/{}/topics/{}'.format(project, topic),
+            'data': base64.b64encode(message.encode('utf-8')).decode('ascii'),
+        },
+    }
+    current = _get_or_none(jobs.get(name=body['name']))
+    if current is None:
+        jobs.create(parent=parent, body=body).execute()
+        return 'created'
+    if (current.get('schedule') == body['schedule'] and current.get('timeZone') == body['timeZone'] and
+            current.get('pubsubTarget', {}).get('topicName') == body['pubsubTarget']['topicName'] and
+            current.get('pubsubTarget', {}).get('data') == body['pubsubTarget']['data']):
+        return 'already up to date'
+    jobs.patch(name=body['name'], updateMask='schedule,timeZone,pubsubTarget', body=body).execute()
+    return 'updated'
+
+def schedule_message(zone, engine='nodejs'):
+    # Pub/Sub message selecting time-managed instances in zone(s)
+    zones = [zone] if isinstance(zone, str) else list(zone)
+    if engine == 'python':
+        return json.dumps({'zones': zones, 'label': 'env=time-managed'})
+    if len(zones) != 1:
+        raise RuntimeError('The nodejs schedule engine handles a single zone, use the python engine for several.')
+    return '{{"zone":"{}", "label":"env=time-managed"}}'.format(zones[0])
+
+def schedule_steps(
+    shutdown_time="23:59",
+    startup_time=None,
+    zone=config['GCP']['gcp_zone'],
+    project=config['GCP']['gcp_project_id'],
+    engine='nodejs',
+):
+    """
+    Steps creating instance shutdown (and startup) functions, topics and jobs.
+    Topics come first, then each topic's function deployment and scheduler job run concurrently.
+    Functions of the other engine are deleted, so each topic triggers a single engine.
+    :param zone: zone or list of zones (python engine only) of instances to manage
+    :param engine: 'nodejs' (schedule/index.js) or 'python' (lab_sc_gcp/scheduler.py)
+    :return: list of Step
+    """
+    if engine not in schedule_engines:
+        raise RuntimeError('Unknown schedule engine {}, expected one of: {}'.format(
+            engine, ', '.join(schedule_engines)))
+    # Schedule the jobs, every day by default
+    # TODO: Add time-zone option instead of assuming east coast time
+    message = schedule_message(zone, engine=engine)
+    pipelines = [('stop-instance-event', 'stop', 'shutdown-tm-instances', shutdown_time)]
+    # Start up function is deployed even without a startup time, so a schedule can be added later
+    pipelines.append(('start-instance-event', 'start', 'startup-tm-instances', startup_time))
+
+    if engine == 'python':
+        # Staged once here, as both functions are deployed from it concurrently
+        source_dir, runtime = stage_engine_source(), python_functions_runtime
+    else:
+        source_dir, runtime = package_path('schedule'), functions_runtime
+
+    steps = []
+    for topic, action, job, job_time in pipelines:
+        topic_step = 'topic {}'.format(topic)
+        function, entry_point = schedule_engines[engine][action]
+        steps.append(Step(topic_step, lambda topic=topic: ensure_topic(topic, project=project), []))
+        steps.append(Step('function {}'.format(function),
+                          lambda function=function, entry_point=entry_point, topic=topic: ensure_function(
+                              function, topic, project=project, source_dir=source_dir, runtime=runtime,
+                              entry_point=entry_point),
+                          [topic_step]))
+        for other_engine, other_functions in schedule_engines.items():
+            if other_engine != engine:
+                other_function = other_functions[action][0]
+                steps.append(Step('remove function {}'.format(other_function),
+                                  lambda function=other_function: ensure_function_deleted(function,
+                                                                                          project=project),
+                                  ['function {}'.format(function)]))
+        if job_time:
+            hour, minute = job_time.replace(',', ':').split(':')
+            steps.append(Step('job {}'.format(job),
+                              lambda job=job, topic=topic, hour=hour, minute=minute: ensure_scheduler_job(
+                                  job, '{} {} * * *'.format(int(minute), int(hour)), topic, message,
+                                  project=project),
+                              [topic_step]))
+    return steps
 
 def create_schedule(
-    shutdown_time="23,59",
+    shutdown_time="23:59",
     startup_time=None,
     zone=config['GCP']['gcp_zone'],
-    project=config['GCP']['gcp_project_id']
+    project=config['GCP']['gcp_project_id'],
+    engine='nodejs',
 ):
-    # For now use gcloud utilities here
-    # Got source from https://github.com/GoogleCloudPlatform/nodejs-docs-samples
-    # However, most recent version breaks functionality, so have rolled back json source
-    source_dir = resource_filename('lab_sc_gcp', 'schedule')
-
-    # Create instance shutdown and startup functions
-    function_command = ['gcloud', 'pubsub', 'topics', 'create', 'stop-instance-event',
-                        '--project', project]
-    call(function_command)
-    function_command = ['gcloud', 'functions', 'deploy', 'stopInstancePubSub', '--trigger-topic',
-                        'stop-instance-event', '--project', project,
-                        '--runtime', 'nodejs8', '--source', source_dir]
-    call(function_command)
-    # Start up
-    function_command = ['gcloud', 'pubsub', 'topics', 'create', 'start-instance-event',
-                        '--project', project]
-    call(function_command)
-    function_command = ['gcloud', 'functions', 'deploy', 'startInstancePubSub', '--trigger-topic',
-                        'start-instance-event', '--project', project,
-                        '--runtime', 'nodejs8', '--source', source_dir]
-    call(function_command)
+    """
+    Create or update shutdown (and startup) schedule for time-managed instances in zone.
+    Resources that already exist are kept or updated in place, so this is safe to rerun.
+    :param zone: zone or list of zones (python engine only)
+    :param engine: 'nodejs' or 'python' start/stop engine
+    :return: StepReport
+    """
+    report = run_steps(schedule_steps(shutdown_time=shutdown_time,
+                                      startup_time=startup_time,
+                                      zone=zone,
+                                      project=project,
+                                      engine=engine))
+    print(report.summary())
+    if report.failures:
+        raise RuntimeError('Schedule setup did not finish. Rerun the command to retry failed steps.')
+    return report
+
+
+def ensure_project(project_id):
+    """
+    Create project if it does not exist (or is not visible to the user).
+    :return: outcome
+    """
+    from googleapiclient.errors import HttpError
+    service = get_service('cloudresourcemanager', 'v1')
+    try:
+        service.projects().get(projectId=project_id).execute()
+        return 'already exists'
+    except HttpError as e:
+        # Missing projects look the same as projects without access
+        if e.resp.status not in (403, 404):
+            raise
+    operation = service.projects().create(body={'projectId': project_id, 'name': project_id}).execute()
+    wait_for_long_running_operation(operation, service)
+    return 'created'
+
+def ensure_billing(billing_account, project=config['GCP']['gcp_project_id']):
+    """
+    Link project to billing account unless already linked to it.
+    :return: outcome
+    """
+    projects = get_service('cloudbilling', 'v1').projects()
+    name = 'projects/{}'.format(project)
+    account = 'billingAccounts/{}'.format(billing_account)
+    if projects.getBillingInfo(name=name).execute().get('billingAccountName') == account:
+        return 'already linked'
+    projects.updateBillingInfo(name=name, body={'billingAccountName': account}).execute()
+    return 'linked to {}'.format(billing_account)
+
+def ensure_bucket(name, project=config['GCP']['gcp_project_id'], location=config['GCP']['gcp_zone']):
+    """
+    Create bucket in project if it does not exist.
+    :return: outcome
+    """
+    if get_storage_client().lookup_bucket(name) is not None:
+        return 'already exists'
+    create_bucket(name=name, project=project, location=location)
+    return 'created'
+
+def network_outcome(changes):
+    # Step outcome of configure_network
+    return '{} change(s)'.format(len(changes)) if changes else 'already up to date'
+
+def bootstrap_steps(
+    project,
+    billing_account,
+    bucket=None,
+    zone=config['GCP']['gcp_zone'],
+    shutdown_time="23:59",
+    startup_time=None,
+    engine='nodejs',
+):
+    """
+    All steps of setting up a new lab project, with their dependencies.
+    :return: list of Step
+    """
+    steps = [
+        Step('project', lambda: ensure_project(project), []),
+        Step('billing', lambda: ensure_billing(billing_account, project=project), ['project']),
+        Step('apis', lambda: ensure_apis(compute_apis + function_apis, project=project), ['billing']),
+        Step('app engine', lambda: ensure_app_engine(project=project), ['apis']),
+        Step('network', lambda: network_outcome(configure_network(project=project, region=zone)), ['apis']),
+    ]
+    if bucket:
+        steps.append(Step('bucket', lambda: ensure_bucket(bucket, project=project, location=zone), ['billing']))
+
+    # Schedule topics need the APIs, scheduler jobs also need the App Engine app
+    for step in schedule_steps(shutdown_time=shutdown_time, startup_time=startup_time, zone=zone, project=project,
+                               engine=engine):
+        needs = step.needs or ['apis']
+        if step.name.startswith('job '):
+            needs = needs + ['app engine']
+        steps.append(step._replace(needs=needs))
+    return steps
+
+def bootstrap_project(
+    project,
+    billing_account,
+    bucket=None,
+    zone=config['GCP']['gcp_zone'],
+    shutdown_time="23:59",
+    startup_time=None,
+    engine='nodejs',
+    set_default=False,
+):
+    """
+    Set up a new lab project in one go: create project, link billing, enable APIs, create bucket,
+    configure network and create shutdown schedule. Independent steps run concurrently and steps
+    already done are skipped, so this can be rerun after a failure.
+    :return: StepReport
+    """
+    report = run_steps(bootstrap_steps(project=project,
+                                       billing_account=billing_account,
+                                       bucket=bucket,
+                                       zone=zone,
+                                       shutdown_time=shutdown_time,
+                                       startup_time=startup_time,
+                                       engine=engine))
+    print(report.summary())
+    if report.failures:
+        raise RuntimeError('Project setup did not finish. Rerun the command to retry failed steps.')
 
-    # Schedule the jobs, every day by default
-    # TODO: Add time-zone option instead of assuming east coast time
-    stop_hr = shutdown_time.split(':')[0]
-    stop_min = shutdown_time.split(':')[1]
-    stop_args = ['gcloud', 'beta', 'scheduler', 'jobs', 'create', 'pubsub', 'shutdown-tm-instances',
-                 '--project', project, '--schedule', '{} {} * * *'.format(stop_min, stop_hr),
-                 '--topic', 'stop-instance-event',
-                 '--message-body', '{{"zone":"{}", "label":"env=time-managed"}}'.format(zone),
-                 '--time-zone', 'America/New_York']
-    call(stop_args)
-
-    if startup_time:
-        start_hr = startup_time.split(':')[0]
-        start_min = startup_time.split(':')[1]
-        start_args = ['gcloud', 'beta', 'scheduler', 'jobs', 'create', 'pubsub', 'startup-tm-instances',
-                      '--project', project, '--schedule', '{} {} * * *'.format(start_min, start_hr),
-                      '--topic', 'start-instance-event',
-                      '--message-body', '{{"zone":"{}", "label":"env=time-managed"}}'.format(zone),
-                      '--time-zone', 'America/New_York']
-        call(start_args)
+    # Set as default if requested
+    if set_default:
+        config.set('GCP', 'GCP_PROJECT_ID', project)
+        if bucket:
+            config.set('GCP', 'BUCKET', bucket)
+
+        # Write new config
+        with open(user_config, 'w') as configfile:
+            config.write(configfile)
+        print('Project {} set as default project.'.format(project))
+    return report
 
 
 # TODO: Create snapshot schedule that can be easily applied to all instance disks
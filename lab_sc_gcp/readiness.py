@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Wait for a new or restarted instance to be usable, not just running, and report on the
+library prefetch run by its startup script.
+
+Instance status is polled until the instance is running with an external IP, then the startup
+script (which reports completion as a guest attribute) and the RStudio Server and Jupyter ports
+are probed concurrently with backoff. Every step is recorded on a timeline, so boot to usable
+latency can be measured.
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from lab_sc_gcp.gce import get_nat_ip
+from lab_sc_gcp.operations import get_compute_operation
+from lab_sc_gcp.utilities import *
+
+# Services probed after the instance is running: (event name, port, HTTP path, required)
+services = [
+    ('RStudio Server login page', 8787, '/auth-sign-in', True),
+    ('Jupyter', 8888, '/', False),
+]
+
+class Timeline(object):
+    """
+    Elapsed time of named events since a start time.
+    """
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self.events = []
+
+    def mark(self, event):
+        self.events.append((time.time() - self.start, event))
+
+    def format(self):
+        rows = [['{:.1f}s'.format(elapsed), event] for elapsed, event in self.events]
+        return format_table(rows, ['ELAPSED', 'EVENT'])
+
+def metadata_value(instance, key):
+    # Value of instance metadata item, None if not set
+    for item in instance.get('metadata', {}).get('items', []):
+        if item['key'] == key:
+            return item['value']
+    return None
+
+def guest_attributes_enabled(instance):
+    # Whether instance can report startup script progress through guest attributes
+    return (metadata_value(instance, 'enable-guest-attributes') or '').upper() == 'TRUE'
+
+def start_timestamp(instance):
+    # Seconds since epoch at which instance was last started (0 if unknown)
+    timestamp = instance.get('lastStartTimestamp') or instance.get('creationTimestamp')
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+def wait_running(instance_m, operation, timeline, timeout=300, initial_delay=0.5, max_delay=2.0):
+    """
+    Poll operation and instance status together until instance is running with an external IP,
+    marking each status change on the timeline.
+    :param instance_m: GCEInstanceManager
+    :param operation: operation resource of the create or start request
+    :param timeline: Timeline
+    :param timeout: seconds before giving up
+    :return: instance resource
+    """
+    from googleapiclient.errors import HttpError
+
+    deadline = time.time() + timeout
+    delay = initial_delay
+    status = None
+    while True:
+        if operation.get('status') != 'DONE':
+            operation = get_compute_operation(operation, instance_m.project)
+            if operation.get('status') == 'DONE':
+                # Raises if the operation failed
+                instance_m.wait_for_operation(operation)
+                timeline.mark('{} operation done'.format(operation.get('operationType', '')).strip())
+
+        try:
+            instance = instance_m.get()
+        except HttpError as e:
+            # Instance may not be visible yet right after insert
+            if e.resp.status != 404:
+                raise
+            instance = None
+        if instance is not None and instance['status'] != status:
+            status = instance['status']
+            timeline.mark(status)
+            if status in ('STOPPING', 'TERMINATED', 'SUSPENDED'):
+                raise RuntimeError('Instance {} is {} and will not become ready.'.format(instance_m.name, status))
+        if operation.get('status') == 'DONE' and status == 'RUNNING' and get_nat_ip(instance):
+            return instance
+
+        if time.time() + delay > deadline:
+            raise RuntimeError('Timed out after {}s waiting for instance {} to be running.'.format(timeout,
+                                                                                                  instance_m.name))
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+async def tcp_open(host, port, timeout=3):
+    # Whether a TCP connection to host:port can be opened
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+async def http_status(host, port, path, timeout=5):
+    # HTTP status code of GET request, None if there is no answer
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        request = 'GET {} HTTP/1.0\r\nHost: {}:{}\r\n\r\n'.format(path, host, port)
+        writer.write(request.encode('ascii'))
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    parts = status_line.split()
+    if len(parts) > 1 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+async def wait_until(check, event, timeline, initial_delay=0.5, max_delay=5.0):
+    # Await check() with backoff until it returns true, then mark event
+    delay = initial_delay
+    while not await check():
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    timeline.mark(event)
+
+async def wait_services(instance_m, instance, timeline, timeout=600):
+    """
+    Probe startup script completion and service ports concurrently until required ones are ready.
+    Probes of optional services are stopped once all required ones are done.
+    """
+    host = get_nat_ip(instance)
+    loop = asyncio.get_running_loop()
+    required, optional = [], []
+
+    for name, port, path, is_required in services:
+        optional.append(wait_until(lambda port=port: tcp_open(host, port),
+                                   'port {} open'.format(port), timeline))
+
+        async def responding(port=port, path=path):
+            status = await http_status(host, port, path)
+            return status is not None and status < 500
+
+        probe = wait_until(responding, '{} (:{}) responding'.format(name, port), timeline)
+        (required if is_required else optional).append(probe)
+
+    if guest_attributes_enabled(instance):
+        started = start_timestamp(instance)
+
+        async def startup_done():
+            attributes = await loop.run_in_executor(None, instance_m.get_guest_attributes)
+            return float(attributes.get('startup-done', 0)) >= int(started)
+
+        required.append(wait_until(startup_done, 'startup script done', timeline))
+    else:
+        print('Instance {} does not report startup script progress, '.format(instance_m.name) +
+              'only waiting on services.')
+
+    optional_tasks = [asyncio.ensure_future(probe) for probe in optional]
+    try:
+        await asyncio.wait_for(asyncio.gather(*required), timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError('Timed out after {}s waiting for services on {}.'.format(timeout, instance_m.name))
+    finally:
+        for task in optional_tasks:
+            task.cancel()
+        await asyncio.gather(*optional_tasks, return_exceptions=True)
+    timeline.mark('ready')
+
+def wait_ready(instance_m, operation, timeline, timeout=600):
+    """
+    Wait for instance to be running, its startup script to be done and RStudio Server to answer.
+    :param instance_m: GCEInstanceManager
+    :param operation: operation resource of the create or start request
+    :param timeline: Timeline, events are added to it
+    :param timeout: seconds before giving up (for each of the two phases)
+    :return: instance resource
+    """
+    instance = wait_running(instance_m, operation, timeline, timeout=timeout)
+    asyncio.run(wait_services(instance_m, instance, timeline, timeout=timeout))
+    return instance
+
+def prefetch_status(instance_m):
+    """
+    Progress of the library prefetch run by the startup script, from instance guest attributes.
+    :param instance_m: GCEInstanceManager
+    :return: status report (string)
+    """
+    instance = instance_m.get()
+    libraries = metadata_value(instance, 'prefetch-libs')
+    if not libraries:
+        return 'Instance {} has no libraries to prefetch.'.format(instance_m.name)
+    bucket = metadata_value(instance, 'prefetch-bucket')
+    lines = ['Libraries to prefetch from gs://{}/libraries/: {}'.format(bucket, libraries)]
+
+    attributes = instance_m.get_guest_attributes() if instance['status'] == 'RUNNING' else {}
+    started = float(attributes.get('prefetch-started', 0))
+    if instance['status'] != 'RUNNING' or started < int(start_timestamp(instance)):
+        lines.append('Prefetch has not started since the instance was last started (instance is {}).'.format(
+            instance['status']))
+        return '\n'.join(lines)
+
+    finished = float(attributes.get('prefetch-finished', 0))
+    elapsed = (finished if finished >= started else time.time()) - started
+    downloaded = int(attributes.get('prefetch-bytes', 0))
+    lines.append('Status: {}'.format(attributes.get('prefetch-status', 'unknown')))
+    lines.append('Library patterns done: {} of {} ({} failed)'.format(attributes.get('prefetch-done', 0),
+                                                                     attributes.get('prefetch-total', '?'),
+                                                                     attributes.get('prefetch-failed', 0)))
+    if attributes.get('prefetch-current'):
+        lines.append('Downloading: {}'.format(attributes['prefetch-current']))
+    lines.append('Downloaded: {} in {:.0f}s ({}/s)'.format(format_bytes(downloaded),
+                                                          elapsed,
+                                                          format_bytes(downloaded / max(elapsed, 1))))
+    return '\n'.join(lines)
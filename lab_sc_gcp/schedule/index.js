@@ -14,8 +14,9 @@
 
 // [START functions_start_instance_pubsub]
 // [START functions_stop_instance_pubsub]
-const Compute = require('@google-cloud/compute');
-const compute = new Compute();
+const compute = require('@google-cloud/compute');
+const instancesClient = new compute.InstancesClient();
+const operationsClient = new compute.ZoneOperationsClient();
 // [END functions_stop_instance_pubsub]
 
 /**
@@ -27,6 +28,7 @@ const compute = new Compute();
  *  label - the label of instances to start.
  *
  * @param {!object} event Cloud Function PubSub message event.
+ * @param {!object} context Cloud Function event metadata.
  * @param {!object} callback Cloud Function PubSub callback indicating
  *  completion.
  */
@@ -35,20 +37,8 @@ exports.startInstancePubSub = async (event, context, callback) => {
     const payload = _validatePayload(
       JSON.parse(Buffer.from(event.data, 'base64').toString())
     );
-    const options = {filter: `labels.${payload.label}`};
-    const [vms] = await compute.getVMs(options);
-    await Promise.all(
-      vms.map(async (instance) => {
-        if (payload.zone === instance.zone.id) {
-          const [operation] = await compute
-            .zone(payload.zone)
-            .vm(instance.name)
-            .start();
-
-          // Operation pending
-          return operation.promise();
-        }
-      })
+    await _applyToInstances(payload, (request) =>
+      instancesClient.start(request)
     );
 
     // Operation complete. Instance successfully started.
@@ -72,6 +62,7 @@ exports.startInstancePubSub = async (event, context, callback) => {
  *  label - the label of instances to stop.
  *
  * @param {!object} event Cloud Function PubSub message event.
+ * @param {!object} context Cloud Function event metadata.
  * @param {!object} callback Cloud Function PubSub callback indicating completion.
  */
 exports.stopInstancePubSub = async (event, context, callback) => {
@@ -79,22 +70,8 @@ exports.stopInstancePubSub = async (event, context, callback) => {
     const payload = _validatePayload(
       JSON.parse(Buffer.from(event.data, 'base64').toString())
     );
-    const options = {filter: `labels.${payload.label}`};
-    const [vms] = await compute.getVMs(options);
-    await Promise.all(
-      vms.map(async (instance) => {
-        if (payload.zone === instance.zone.id) {
-          const [operation] = await compute
-            .zone(payload.zone)
-            .vm(instance.name)
-            .stop();
-
-          // Operation pending
-          return operation.promise();
-        } else {
-          return Promise.resolve();
-        }
-      })
+    await _applyToInstances(payload, (request) =>
+      instancesClient.stop(request)
     );
 
     // Operation complete. Instance successfully stopped.
@@ -108,6 +85,45 @@ exports.stopInstancePubSub = async (event, context, callback) => {
 };
 // [START functions_start_instance_pubsub]
 
+/**
+ * Runs an instance operation on all instances with the payload's label in
+ * the payload's zone, and waits for the operations to finish.
+ *
+ * @param {!object} payload the validated request payload.
+ * @param {!function} action starts the operation for a {project, zone,
+ *  instance} request.
+ */
+const _applyToInstances = async (payload, action) => {
+  const project = await instancesClient.getProjectId();
+  const zone = payload.zone;
+  const [key, value] = payload.label.split('=');
+  const filter =
+    value === undefined ? `labels.${key}:*` : `labels.${key} = "${value}"`;
+  const names = [];
+  for await (const instance of instancesClient.listAsync({
+    project,
+    zone,
+    filter,
+  })) {
+    names.push(instance.name);
+  }
+  await Promise.all(
+    names.map(async (instance) => {
+      const [response] = await action({project, zone, instance});
+      let operation = response.latestResponse;
+
+      // Operation pending
+      while (operation.status !== 'DONE') {
+        [operation] = await operationsClient.wait({
+          operation: operation.name,
+          project,
+          zone,
+        });
+      }
+    })
+  );
+};
+
 /**
  * Validates that a request payload contains the expected fields.
  *
@@ -0,0 +1,292 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Start/stop engine for time-managed instances, run by the scheduled Cloud Functions or locally.
+
+Instances are selected with a server-side filter on label and status in each zone of the
+message, so instances in other zones or already in the target state are never fetched.
+Start/stop requests are sent by a bounded pool of workers with retries on rate limiting and
+server errors, then all operations are polled together in batch requests.
+
+This module is deployed as the function's main.py, so it must only depend on the Google API
+client (not on the rest of lab_sc_gcp).
+
+Message format (JSON): {"zone": "us-east1-b", "label": "env=time-managed"}, where "zones"
+(a list) may be given instead of "zone" to cover several zones with one message.
+"""
+import base64
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Target status and statuses to act on, per action
+actions = {
+    'start': ('RUNNING', ['TERMINATED']),
+    'stop': ('TERMINATED', ['RUNNING', 'PROVISIONING', 'STAGING']),
+}
+
+# HTTP statuses worth retrying (rate limiting and server errors)
+retry_statuses = (429, 500, 502, 503, 504)
+
+# Calls per HTTP batch request when polling operations
+batch_size = 100
+
+def parse_payload(payload):
+    """
+    Validate schedule message.
+    :param payload: dict with "label" and "zone" or "zones"
+    :return: (list of zones, label key, label value or None)
+    """
+    zones = payload.get('zones') or ([payload['zone']] if payload.get('zone') else [])
+    if isinstance(zones, str):
+        zones = [zones]
+    if not zones:
+        raise ValueError("Attribute 'zone' or 'zones' missing from payload")
+    if not payload.get('label'):
+        raise ValueError("Attribute 'label' missing from payload")
+    key, _, value = payload['label'].partition('=')
+    return zones, key, value or None
+
+def instance_filter(label_key, label_value, statuses):
+    # Compute API filter for instances with label in one of statuses
+    if label_value is None:
+        label = '(labels.{}:*)'.format(label_key)
+    else:
+        label = '(labels.{} = "{}")'.format(label_key, label_value)
+    if len(statuses) == 1:
+        return '{} AND (status = "{}")'.format(label, statuses[0])
+    # The API has no list membership test, so statuses are combined with OR
+    return '{} AND ({})'.format(label, ' OR '.join('(status = "{}")'.format(status) for status in statuses))
+
+def _http_status(exception):
+    # HTTP status of an API error, None for other errors
+    resp = getattr(exception, 'resp', None)
+    return getattr(resp, 'status', None)
+
+def _is_retryable(exception):
+    status = _http_status(exception)
+    if status is not None:
+        return status in retry_statuses
+    # Connection errors and timeouts
+    return isinstance(exception, (OSError, ConnectionError))
+
+def execute_with_retries(request, retries=3, initial_delay=1.0):
+    """
+    Execute API request, retrying retryable errors with exponential backoff and jitter.
+    :return: response
+    """
+    delay = initial_delay
+    for attempt in range(retries + 1):
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempt == retries or not _is_retryable(e):
+                raise
+        time.sleep(delay * (1 + random.random()))
+        delay *= 2
+
+def default_service_factory():
+    # Compute API client with the function's default credentials
+    from googleapiclient import discovery
+    return discovery.build('compute', 'v1', cache_discovery=False)
+
+def default_project():
+    import google.auth
+    return google.auth.default()[1]
+
+class ScheduleEngine(object):
+    """
+    Applies a start or stop action to all labeled instances in some zones.
+    """
+    def __init__(
+        self,
+        project,
+        service_factory=default_service_factory,
+        max_workers=16,
+        retries=3,
+        timeout=480,
+        initial_delay=1.0,
+        max_delay=10.0,
+    ):
+        """
+        :param project:
+        :param service_factory: function returning a compute API client (called once per worker thread)
+        :param max_workers: maximum number of API requests in flight
+        :param retries: retries of each request on rate limiting and server errors
+        :param timeout: seconds to wait on operations (Cloud Functions time out after 540s)
+        """
+        self.project = project
+        self.service_factory = service_factory
+        self.max_workers = int(max_workers)
+        self.retries = retries
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._local = threading.local()
+
+    def service(self):
+        # API clients are not thread safe, each worker gets its own
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.service_factory()
+        return self._local.service
+
+    def list_zone(self, zone, filter):
+        # Names of instances in zone matching filter
+        names = []
+        page_token = None
+        while True:
+            request = self.service().instances().list(project=self.project,
+                                                      zone=zone,
+                                                      filter=filter,
+                                                      fields='items(name,status),nextPageToken',
+                                                      maxResults=500,
+                                                      pageToken=page_token)
+            res = execute_with_retries(request, retries=self.retries)
+            names.extend(item['name'] for item in res.get('items', []))
+            page_token = res.get('nextPageToken')
+            if not page_token:
+                return names
+
+    def send(self, action, zone, name):
+        # Send start or stop request, returning (operation, error message)
+        request = getattr(self.service().instances(), action)(project=self.project, zone=zone, instance=name)
+        try:
+            return execute_with_retries(request, retries=self.retries), None
+        except Exception as e:
+            return None, str(e) or e.__class__.__name__
+
+    def wait(self, operations):
+        """
+        Poll operations together in batch requests until all are done or the timeout is reached.
+        :param operations: dict of key -> operation resource
+        :return: (dict of key -> error message or None, list of keys still pending)
+        """
+        service = self.service()
+        results = {}
+        pending = dict(operations)
+        deadline = time.time() + self.timeout
+        delay = self.initial_delay
+        while pending:
+            for key, operation in list(pending.items()):
+                if operation.get('status') == 'DONE':
+                    errors = operation.get('error', {}).get('errors', [])
+                    results[key] = '; '.join(error.get('message', '') for error in errors) or None
+                    del pending[key]
+            if not pending or time.time() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+            def callback(key, response, exception):
+                if exception is None:
+                    pending[key] = response
+                elif _http_status(exception) not in retry_statuses:
+                    results[key] = str(exception)
+                    pending.pop(key, None)
+
+            keys = list(pending)
+            for i in range(0, len(keys), batch_size):
+                batch = service.new_batch_http_request(callback=callback)
+                for key in keys[i:i + batch_size]:
+                    zone = key.split('/')[0]
+                    batch.add(service.zoneOperations().get(project=self.project,
+                                                           zone=zone,
+                                                           operation=pending[key]['name']),
+                              request_id=key)
+                try:
+                    batch.execute()
+                except Exception as e:
+                    # Unfinished operations are polled again in the next round
+                    if not _is_retryable(e):
+                        raise
+        return results, list(pending)
+
+    def run(self, action, payload, dry_run=False):
+        """
+        Apply action to all instances selected by payload that are not in the target state yet.
+        :param action: 'start' or 'stop'
+        :param payload: schedule message (dict)
+        :param dry_run: only select instances
+        :return: ScheduleReport
+        """
+        if action not in actions:
+            raise ValueError('Unknown action {}, expected one of: {}'.format(action, ', '.join(actions)))
+        zones, label_key, label_value = parse_payload(payload)
+        target_status, from_statuses = actions[action]
+        report = ScheduleReport(action)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            filter = instance_filter(label_key, label_value, from_statuses)
+            listed = executor.map(lambda zone: (zone, self.list_zone(zone, filter)), zones)
+            targets = ['{}/{}'.format(zone, name) for zone, names in listed for name in names]
+            report.selected = len(targets)
+            report.mark('listed {} instance(s) to {} in {} zone(s)'.format(len(targets), action, len(zones)))
+            if dry_run or not targets:
+                report.finish()
+                return report
+
+            operations = {}
+            sent = executor.map(lambda key: (key, self.send(action, *key.split('/'))), targets)
+            for key, (operation, error) in sent:
+                if error is None:
+                    operations[key] = operation
+                else:
+                    report.errors[key] = error
+            report.mark('sent {} request(s), {} failed'.format(len(targets), len(report.errors)))
+
+        results, report.pending = self.wait(operations)
+        for key, error in results.items():
+            if error is None:
+                report.succeeded += 1
+            else:
+                report.errors[key] = error
+        report.mark('{} instance(s) {}'.format(report.succeeded, target_status))
+        report.finish()
+        return report
+
+class ScheduleReport(object):
+    """
+    Outcome of one schedule run.
+    """
+    def __init__(self, action):
+        self.action = action
+        self.start_time = time.time()
+        self.seconds = None
+        self.selected = 0
+        self.succeeded = 0
+        self.errors = {}
+        self.pending = []
+        self.events = []
+
+    def mark(self, event):
+        self.events.append((time.time() - self.start_time, event))
+
+    def finish(self):
+        self.seconds = time.time() - self.start_time
+
+    def summary(self):
+        lines = ['[{:6.1f}s] {}'.format(elapsed, event) for elapsed, event in self.events]
+        lines.append('{}: {} selected, {} succeeded, {} failed, {} still pending after {:.1f}s.'.format(
+            self.action, self.selected, self.succeeded, len(self.errors), len(self.pending), self.seconds))
+        for key, error in sorted(self.errors.items()):
+            lines.append('{}: {}'.format(key, error))
+        return '\n'.join(lines)
+
+def _run_event(action, event):
+    # Cloud Function entry point body: run action for Pub/Sub message
+    payload = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+    engine = ScheduleEngine(project=payload.get('project') or default_project())
+    report = engine.run(action, payload)
+    print(report.summary())
+    if report.errors:
+        raise RuntimeError('Could not {} {} instance(s).'.format(action, len(report.errors)))
+    return report.summary()
+
+def start_instances_pubsub(event, context):
+    return _run_event('start', event)
+
+def stop_instances_pubsub(event, context):
+    return _run_event('stop', event)
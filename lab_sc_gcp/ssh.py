@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SSH access to instances without starting gcloud for every command.
+
+Commands go straight to the instance's external IP with the key gcloud generates and propagates
+(~/.ssh/google_compute_engine), checking host keys against gcloud's known hosts file. gcloud is
+only used to create and propagate the key when it is missing or not accepted by the instance.
+
+The first command to an instance opens a multiplexed master connection that stays up in the
+background (see [SSH] CONTROL_PERSIST), and the instance's IP and id are saved locally, so later
+commands and transfers skip both the API lookup and the SSH handshake. A saved IP that stops
+working (eg. after the instance was restarted) is looked up again.
+"""
+import getpass
+import json
+import os
+import shlex
+import threading
+import time
+from subprocess import DEVNULL, PIPE, Popen, call, run
+
+from lab_sc_gcp.cache import cache_dir
+from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.utilities import *
+
+config = get_config()
+
+ssh_dir = os.path.join(os.path.expanduser('~'), '.ssh')
+ssh_key = os.path.join(ssh_dir, 'google_compute_engine')
+known_hosts = os.path.join(ssh_dir, 'google_compute_known_hosts')
+
+# Sockets of master connections (unix socket paths are limited to ~100 characters, so keep it short)
+control_dir = os.path.join(os.path.dirname(user_config), 'ssh')
+# IP and id of instances connected to before
+targets_path = os.path.join(cache_dir, 'ssh-targets.json')
+
+# ssh exits with this status when the connection or authentication fails
+ssh_error_status = 255
+
+def remote_path(path):
+    # Quote path for the remote shell, keeping ~ expansion
+    if path == '~':
+        return '"$HOME"'
+    if path.startswith('~/'):
+        return '"$HOME"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+class SavedTargets(object):
+    """
+    IP and id of instances, keyed by project, zone and instance name.
+    """
+    _lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(targets_path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def put(self, key, target):
+        # Save target (dict with natIP and id), or forget it if None
+        with self._lock:
+            targets = self._read()
+            if target is None:
+                targets.pop(key, None)
+            else:
+                targets[key] = target
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '{}.{}.{}.tmp'.format(targets_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(targets, f)
+            os.replace(tmp_path, targets_path)
+
+class SSHConnection(object):
+    """
+    Runs commands on an instance over SSH, sharing one master connection per instance.
+    """
+    def __init__(
+        self,
+        user=config['LOCAL']['user'],
+        name=config['GCP']['instance_name'],
+        project=config['GCP']['gcp_project_id'],
+        zone=config['GCP']['gcp_zone'],
+        login=None,
+        key=ssh_key,
+        control_persist=config['SSH']['control_persist'],
+    ):
+        """
+        :param user: user the instance belongs to
+        :param name: instance name
+        :param project:
+        :param zone:
+        :param login: login user on instance (defaults to local user name, like gcloud)
+        :param key: private key propagated to the instance by gcloud
+        :param control_persist: how long an idle master connection stays up (ssh ControlPersist value)
+        """
+        self.user = user
+        self.name = get_full_inst_name(name, user)
+        self.project = project
+        self.zone = zone
+        self.login = login or getpass.getuser()
+        self.key = key
+        self.control_persist = control_persist
+        self.saved = SavedTargets()
+        self._instance_m = None
+        self._target = None
+        self._target_saved = False
+        self._access = False
+
+    @property
+    def target_key(self):
+        return '{}/{}/{}'.format(self.project, self.zone, self.name)
+
+    @property
+    def instance_m(self):
+        # Only built when the instance has to be looked up, as it needs an API client
+        if self._instance_m is None:
+            from lab_sc_gcp.gce import GCEInstanceManager
+            self._instance_m = GCEInstanceManager(user=self.user, name=self.name, project=self.project,
+                                                  zone=self.zone)
+        return self._instance_m
+
+    def target(self, refresh=False):
+        """
+        External IP and id of the instance, as saved by an earlier connection or looked up
+        (from the instance cache if fresh).
+        :param refresh: look up instance again, ignoring the saved IP and the instance cache
+        :return: (IP, instance id)
+        """
+        if self._target is not None and not refresh:
+            return self._target
+        saved = None if refresh else self.saved.get(self.target_key)
+        if saved is not None:
+            self._target, self._target_saved = (saved['natIP'], saved['id']), True
+            return self._target
+
+        summary = self.instance_m.describe(max_age=0 if refresh else None)
+        if summary['status'] != 'RUNNING' or not summary.get('natIP') or not summary.get('id'):
+            summary = self.instance_m.describe(max_age=0)
+        if summary['status'] != 'RUNNING' or not summary.get('natIP'):
+            self.saved.put(self.target_key, None)
+            raise RuntimeError('Instance {} is {}. Please start it first.'.format(self.name, summary['status']))
+        self._target, self._target_saved = (summary['natIP'], summary.get('id')), False
+        return self._target
+
+    def options(self, multiplex=True):
+        # ssh options shared by all commands
+        options = ['-i', self.key,
+                   '-o', 'IdentitiesOnly=yes',
+                   '-o', 'BatchMode=yes',
+                   '-o', 'ConnectTimeout=15',
+                   '-o', 'ServerAliveInterval=30',
+                   '-o', 'UserKnownHostsFile={}'.format(known_hosts),
+                   # Another instance now using a saved IP is refused rather than logged in to
+                   '-o', 'StrictHostKeyChecking=accept-new']
+        host_id = self.target()[1]
+        if host_id:
+            # Host keys are stored by instance id, as external IPs change between restarts
+            options.extend(['-o', 'HostKeyAlias=compute.{}'.format(host_id)])
+        if multiplex:
+            os.makedirs(control_dir, mode=0o700, exist_ok=True)
+            options.extend(['-o', 'ControlMaster=auto',
+                            '-o', 'ControlPath={}'.format(os.path.join(control_dir, '%C')),
+                            '-o', 'ControlPersist={}'.format(self.control_persist)])
+        else:
+            options.extend(['-o', 'ControlPath=none'])
+        return options
+
+    def command(self, remote_command=None, multiplex=True, tty=False):
+        """
+        Command line running remote_command on instance.
+        :param remote_command: shell command, None for a login shell
+        :param multiplex: share the master connection (parallel bulk streams are faster on their own)
+        :param tty: allocate a terminal
+        """
+        command = ['ssh'] + self.options(multiplex=multiplex)
+        if tty:
+            command.append('-t')
+        command.append('{}@{}'.format(self.login, self.target()[0]))
+        if remote_command is not None:
+            command.append(remote_command)
+        return command
+
+    def setup_key(self):
+        # Let gcloud create the key (if needed) and add it to the instance metadata
+        print('Setting up SSH key for instance {} with gcloud.'.format(self.name))
+        status = call(['gcloud', 'compute', 'ssh', '{}@{}'.format(self.login, self.name),
+                       '--project', self.project, '--zone', self.zone,
+                       '--command', 'true'])
+        if status != 0:
+            raise RuntimeError('Could not set up SSH access to instance {}.'.format(self.name))
+
+    def _check(self):
+        # Log in once, which also starts the master connection if none is up
+        # (no pipes, as the master stays in the background and would hold them open)
+        return call(self.command('true'), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+    def ensure_access(self):
+        """
+        Make sure commands can log in, looking up the instance again if its saved IP does not work
+        and setting up the key with gcloud only if logging in still fails.
+        """
+        if self._access:
+            return
+        if not os.path.isfile(self.key):
+            self.target()
+            self.setup_key()
+        elif self._check() == ssh_error_status:
+            # A saved IP may be stale, so look the instance up again before blaming the key
+            retry = self._target_saved
+            if retry:
+                self.target(refresh=True)
+            if not retry or self._check() == ssh_error_status:
+                self.setup_key()
+        ip, host_id = self.target()
+        self.saved.put(self.target_key, {'natIP': ip, 'id': host_id, 'saved_at': time.time()})
+        self._access = True
+
+    def popen(self, remote_command, multiplex=True, **kwargs):
+        return Popen(self.command(remote_command, multiplex=multiplex), **kwargs)
+
+    def run(self, remote_command, **kwargs):
+        return run(self.command(remote_command), **kwargs)
+
+    def call(self, remote_command=None, tty=False):
+        """
+        Run command (or a login shell) with the local terminal attached.
+        :return: exit status
+        """
+        return call(self.command(remote_command, tty=tty))
+
+    def close(self):
+        """
+        Stop the master connection to the instance, if one is up.
+        :return: whether a master connection was stopped
+        """
+        if self._target is None and self.saved.get(self.target_key) is None:
+            return False
+        command = self.command()
+        return run(command[:-1] + ['-O', 'exit', command[-1]], stdout=PIPE, stderr=PIPE).returncode == 0
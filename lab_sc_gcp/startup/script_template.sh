@@ -11,4 +11,140 @@ usermod -a -G staff '${USER}'
 usermod -a -G google-sudoers '${USER}'
 
 mkdir -p /home/data/libraries && chmod 777 /home/data && chmod 777 /home/data/libraries/
-mkdir -p /home/downloads && chmod 777 /home/downloads
\ No newline at end of file
+mkdir -p /home/downloads && chmod 777 /home/downloads
+
+# Put libraries on a fast volume if the instance has one: local NVMe SSDs (striped as RAID 0)
+# or an attached data disk. Local SSDs are wiped when the instance is stopped, so the volume
+# is rebuilt whenever it has no filesystem.
+data_mount=/mnt/disks/data
+local_ssds=$(ls /dev/disk/by-id/google-local-nvme-ssd-* 2>/dev/null)
+data_device=
+if [ -n "$local_ssds" ] ; then
+   ssd_count=$(echo "$local_ssds" | wc -l)
+   if [ "$ssd_count" -gt 1 ] ; then
+      which mdadm >/dev/null 2>&1 || apt-get install -y -q mdadm
+      mdadm --assemble /dev/md0 $local_ssds >/dev/null 2>&1 || \
+         mdadm --create /dev/md0 --run --level=0 --raid-devices=$ssd_count $local_ssds
+      data_device=/dev/md0
+   else
+      data_device=$local_ssds
+   fi
+elif [ -e /dev/disk/by-id/google-data ] ; then
+   data_device=/dev/disk/by-id/google-data
+fi
+
+if [ -n "$data_device" ] && ! mountpoint -q $data_mount ; then
+   blkid $data_device >/dev/null 2>&1 || mkfs.ext4 -F -m 0 -E discard $data_device
+   mkdir -p $data_mount
+   mount -o discard,defaults $data_device $data_mount
+   mkdir -p $data_mount/libraries && chmod 777 $data_mount $data_mount/libraries
+   mountpoint -q /home/data/libraries || mount --bind $data_mount/libraries /home/data/libraries
+fi
+
+# Download libraries listed in instance metadata (lab-gcp create-instance --prefetch-libs) in the
+# background, so data staging overlaps with RStudio Server startup. Progress is reported as guest
+# attributes (read by "lab-gcp prefetch-status"). Files already downloaded are skipped.
+metadata_url=http://metadata.google.internal/computeMetadata/v1/instance
+report() {
+   curl -s -X PUT --data "$2" -H 'Metadata-Flavor: Google' $metadata_url/guest-attributes/lab-sc-gcp/$1
+}
+prefetch_libs=$(curl -sf -H 'Metadata-Flavor: Google' $metadata_url/attributes/prefetch-libs)
+prefetch_bucket=$(curl -sf -H 'Metadata-Flavor: Google' $metadata_url/attributes/prefetch-bucket)
+if [ -n "$prefetch_libs" ] && [ -n "$prefetch_bucket" ] ; then
+   (
+      # Library patterns (eg. *BICCN*) are expanded by gsutil, not the shell
+      set -f
+      libs_total=$(echo $prefetch_libs | wc -w)
+      libs_done=0
+      libs_failed=0
+      report prefetch-started "$(date +%s)"
+      report prefetch-total $libs_total
+      report prefetch-done 0
+      report prefetch-failed 0
+      report prefetch-status running
+      for lib in $prefetch_libs ; do
+         report prefetch-current "$lib"
+         # Large files are uploaded as composite objects, which have no MD5, so gsutil (on images without
+         # gcloud storage) must not insist on checking hashes with a slow crcmod
+         if gcloud storage cp --help >/dev/null 2>&1 ; then
+            gcloud storage --no-user-output-enabled cp -r -n "gs://$prefetch_bucket/libraries/$lib" /home/data/libraries/
+         else
+            gsutil -o GSUtil:check_hashes=if_fast_else_skip -m -q cp -r -n \
+               "gs://$prefetch_bucket/libraries/$lib" /home/data/libraries/
+         fi || \
+            libs_failed=$((libs_failed + 1))
+         libs_done=$((libs_done + 1))
+         report prefetch-done $libs_done
+         report prefetch-failed $libs_failed
+         report prefetch-bytes "$(du -sb /home/data/libraries | cut -f1)"
+      done
+      chmod -R a+rwX /home/data/libraries
+      report prefetch-current ""
+      report prefetch-finished "$(date +%s)"
+      if [ $libs_failed -eq 0 ] ; then report prefetch-status done ; else report prefetch-status failed ; fi
+   ) > /var/log/lab-sc-gcp-prefetch.log 2>&1 &
+fi
+
+# Sample CPU, memory, swap and disk I/O in the background (read by "lab-gcp recommend-machine-type").
+# The peak of each minute is appended to a buffer on the boot disk holding the last 7 days, so usage
+# is kept across restarts and machine type changes, and a summary of the buffer is published as a
+# guest attribute every minute.
+cat > /usr/local/bin/lab-sc-gcp-usage-agent <<'AGENT'
+#!/bin/bash
+buffer=/var/lib/lab-sc-gcp/usage.buf
+max_lines=10080
+interval=10
+summary_url=http://metadata.google.internal/computeMetadata/v1/instance/guest-attributes/lab-sc-gcp/usage-summary
+mkdir -p /var/lib/lab-sc-gcp
+cpus=$(nproc)
+mem_total=$(awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo)
+
+# Busy and total CPU time (idle and iowait are not busy, steal is not available to the guest)
+cpu_counters() { awk '/^cpu / {print $2 + $3 + $4 + $7 + $8, $2 + $3 + $4 + $5 + $6 + $7 + $8}' /proc/stat; }
+# Pages swapped in and out
+swap_counters() { awk '/^pswpin |^pswpout / {n += $2} END {print n + 0}' /proc/vmstat; }
+# Sectors read and written on physical disks
+disk_counters() { awk '$3 ~ /^(sd[a-z]+|nvme[0-9]+n[0-9]+)$/ {n += $6 + $10} END {print n + 0}' /proc/diskstats; }
+# Value at percentile of a buffer column
+percentile() { cut -d' ' -f$1 $buffer | sort -n | awk -v n=$(wc -l < $buffer) -v p=$2 'NR >= n * p {print; exit}'; }
+
+read busy total <<< "$(cpu_counters)"
+swaps=$(swap_counters)
+sectors=$(disk_counters)
+while true ; do
+   samples=
+   for i in 1 2 3 4 5 6 ; do
+      sleep $interval
+      read new_busy new_total <<< "$(cpu_counters)"
+      new_swaps=$(swap_counters)
+      new_sectors=$(disk_counters)
+      # Columns: CPUs busy, memory used (MB), swap used (MB), swap I/O (pages/s), disk I/O (KB/s)
+      samples="$samples$(awk -v busy=$((new_busy - busy)) -v total=$((new_total - total)) -v cpus=$cpus \
+         -v swaps=$((new_swaps - swaps)) -v sectors=$((new_sectors - sectors)) -v interval=$interval '
+         /^MemTotal:/ {mem_total = $2} /^MemAvailable:/ {mem_available = $2}
+         /^SwapTotal:/ {swap_total = $2} /^SwapFree:/ {swap_free = $2}
+         END {printf "%.2f %d %d %d %d\n", (total > 0 ? busy / total * cpus : 0), (mem_total - mem_available) / 1024,
+              (swap_total - swap_free) / 1024, swaps / interval, sectors / 2 / interval}' /proc/meminfo)
+"
+      busy=$new_busy total=$new_total swaps=$new_swaps sectors=$new_sectors
+   done
+   printf '%s' "$samples" | awk -v now=$(date +%s) '{for (k = 1; k <= 5; k++) if ($k > peak[k]) peak[k] = $k}
+      END {printf "%d %.2f %d %d %d %d\n", now, peak[1], peak[2], peak[3], peak[4], peak[5]}' >> $buffer
+   tail -n $max_lines $buffer > $buffer.tmp && mv $buffer.tmp $buffer
+
+   summary=$(awk -v cpus=$cpus -v mem_total=$mem_total '
+      NR == 1 {first = $1}
+      {for (k = 2; k <= 6; k++) if ($k > peak[k]) peak[k] = $k; last = $1}
+      END {printf "window=%d minutes=%d cpus=%d mem_total_mb=%d cpu_peak=%.2f mem_peak_mb=%d swap_peak_mb=%d swap_io_peak=%d disk_peak_kbps=%d",
+           last - first + 60, NR, cpus, mem_total, peak[2], peak[3], peak[4], peak[5], peak[6]}' $buffer)
+   summary="$summary cpu_p95=$(percentile 2 0.95) mem_p95_mb=$(percentile 3 0.95) updated=$(date +%s)"
+   curl -s -X PUT --data "$summary" -H 'Metadata-Flavor: Google' $summary_url
+done
+AGENT
+chmod 755 /usr/local/bin/lab-sc-gcp-usage-agent
+pgrep -f /usr/local/bin/lab-sc-gcp-usage-agent >/dev/null || \
+   nohup /usr/local/bin/lab-sc-gcp-usage-agent > /var/log/lab-sc-gcp-usage.log 2>&1 &
+
+# Report completion (read by "lab-gcp create-instance --wait-ready")
+curl -s -X PUT --data "$(date +%s)" -H 'Metadata-Flavor: Google' \
+    http://metadata.google.internal/computeMetadata/v1/instance/guest-attributes/lab-sc-gcp/startup-done
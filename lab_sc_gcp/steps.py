@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run setup steps as a dependency graph, with independent steps running concurrently.
+
+Each step is a function returning a short outcome (eg. "created", "already up to date"), so
+steps check current state themselves and reruns skip work that is already done. A failed step
+is recorded and steps depending on it are skipped, while unrelated steps continue.
+"""
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lab_sc_gcp.utilities import *
+
+# run: function taking no arguments and returning an outcome string
+# needs: names of steps that must succeed before this one starts
+Step = namedtuple('Step', ['name', 'run', 'needs'])
+
+StepResult = namedtuple('StepResult', ['outcome', 'seconds', 'error'])
+
+class StepReport(object):
+    """
+    Outcome and duration of each step of one run.
+    """
+    def __init__(self, steps):
+        self.order = [step.name for step in steps]
+        self.results = {}
+        self.start_time = time.time()
+        self.end_time = None
+
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    @property
+    def failures(self):
+        # Failed steps and steps skipped because of them
+        return [name for name in self.order if name in self.results and self.results[name].error]
+
+    def summary(self):
+        rows = []
+        for name in self.order:
+            result = self.results[name]
+            outcome = result.outcome if not result.error else '{}: {}'.format(result.outcome, result.error)
+            rows.append([name, '{:.1f}s'.format(result.seconds), outcome])
+        lines = [format_table(rows, ['STEP', 'TIME', 'OUTCOME'])]
+        serial = sum(result.seconds for result in self.results.values())
+        lines.append('Finished {} step(s) in {:.1f}s ({:.1f}s if run one after another).'.format(
+            len(self.order), self.elapsed(), serial))
+        if self.failures:
+            lines.append('{} step(s) failed or were skipped.'.format(len(self.failures)))
+        return '\n'.join(lines)
+
+def _run_timed(step):
+    start = time.time()
+    try:
+        outcome = step.run()
+    except Exception as e:
+        return StepResult('FAILED', time.time() - start, str(e) or e.__class__.__name__)
+    return StepResult(outcome, time.time() - start, None)
+
+def run_steps(steps, max_workers=8, verbose=True):
+    """
+    Run steps as soon as the steps they need have succeeded.
+    :param steps: list of Step
+    :param max_workers: maximum number of steps running at once
+    :param verbose: print each step's outcome as it finishes
+    :return: StepReport
+    """
+    names = set(step.name for step in steps)
+    for step in steps:
+        unknown = [need for need in step.needs if need not in names]
+        if unknown:
+            raise ValueError('Step "{}" needs unknown step(s): {}'.format(step.name, ', '.join(unknown)))
+
+    report = StepReport(steps)
+    pending = list(steps)
+    running = {}
+
+    def finish(name, result):
+        report.results[name] = result
+        if verbose:
+            outcome = result.outcome if not result.error else '{}: {}'.format(result.outcome, result.error)
+            print('[{:6.1f}s] {}: {}'.format(report.elapsed(), name, outcome))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Skip steps whose dependencies failed, start those whose dependencies succeeded
+            progressed = False
+            for step in list(pending):
+                results = [report.results.get(need) for need in step.needs]
+                if any(result is not None and result.error for result in results):
+                    pending.remove(step)
+                    finish(step.name, StepResult('skipped', 0.0, 'a step it needs failed'))
+                    progressed = True
+                elif all(result is not None for result in results):
+                    pending.remove(step)
+                    running[executor.submit(_run_timed, step)] = step.name
+                    progressed = True
+            if not running:
+                if pending and progressed:
+                    # Steps were skipped in this pass, check their dependents again
+                    continue
+                if pending:
+                    raise ValueError('Steps depend on each other in a cycle: {}'.format(
+                        ', '.join(step.name for step in pending)))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(running.pop(future), future.result())
+
+    report.end_time = time.time()
+    return report
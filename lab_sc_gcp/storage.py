@@ -4,16 +4,670 @@
 """
 Functions for managing Google Compute Storage (GCE) resources.
 
-Also includes some wrappers for gsutil calls.
+Includes a small transfer engine for moving many files between local disk and a bucket.
 """
-from googleapiclient.discovery import build
+import base64
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from lab_sc_gcp.clients import get_storage_client
 from lab_sc_gcp.config.configure import *
+from lab_sc_gcp.library_index import LibraryIndex, scan_library
+from lab_sc_gcp.utilities import *
 
-from google.cloud import storage
 from subprocess import PIPE, run, call
 
 config = get_config()
 
+# Local record of library files already in each bucket
+manifest_dir = os.path.join(os.path.dirname(user_config), 'manifests')
+# Progress of interrupted parallel composite uploads
+upload_state_dir = os.path.join(os.path.dirname(user_config), 'uploads')
+# Bucket prefix for slices of parallel composite uploads (outside of libraries/)
+composite_prefix = 'tmp/parallel_composite_uploads'
+# Maximum number of source objects in a single compose request
+max_compose_sources = 32
+# Library directory on instances (created by the startup script)
+instance_lib_dir = '/home/data/libraries'
+
+# Single file to move between local disk and a bucket
+# crc32c is base64 encoded (as in bucket object metadata) and None until computed
+TransferTask = namedtuple('TransferTask', ['library', 'local_path', 'object_name', 'size', 'mtime', 'crc32c'])
+
+class TransferReport(object):
+    """
+    Aggregate progress and per-file failures for one transfer run.
+    """
+    def __init__(self, tasks, verb='Transferred'):
+        self.verb = verb
+        self.total_files = len(tasks)
+        self.total_bytes = sum(task.size for task in tasks)
+        self.done_files = 0
+        self.done_bytes = 0
+        self.failures = []  # (task, error) pairs
+        self.start_time = time.time()
+        self.end_time = None
+
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return max(end_time - self.start_time, 1e-6)
+
+    def throughput(self):
+        # Bytes per second
+        return self.done_bytes / self.elapsed()
+
+    def progress_line(self):
+        return '{} {}/{} files, {}/{} ({}/s)'.format(self.verb,
+                                                    self.done_files,
+                                                    self.total_files,
+                                                    format_bytes(self.done_bytes),
+                                                    format_bytes(self.total_bytes),
+                                                    format_bytes(self.throughput()))
+
+    def summary(self):
+        lines = ['{} in {:.1f}s.'.format(self.progress_line(), self.elapsed())]
+        if self.failures:
+            lines.append('{} file(s) failed:'.format(len(self.failures)))
+            for task, error in self.failures:
+                lines.append('  {}: {}'.format(task.local_path, error))
+        return '\n'.join(lines)
+
+class TransferEngine(object):
+    """
+    Bounded worker pool for moving files between local disk and a bucket.
+
+    Files from all libraries share one pool, and the byte budget caps the combined
+    size of files in flight. A failed file is recorded and the remaining files continue.
+    """
+    def __init__(
+        self,
+        bucket_name=config['GCP']['bucket'],
+        max_workers=config['TRANSFER']['max_workers'],
+        max_inflight_mb=config['TRANSFER']['max_inflight_mb'],
+        composite_threshold_mb=config['TRANSFER']['composite_threshold_mb'],
+        composite_slices=config['TRANSFER']['composite_slices'],
+        sliced_download_threshold_mb=config['TRANSFER']['sliced_download_threshold_mb'],
+        sliced_download_slices=config['TRANSFER']['sliced_download_slices'],
+        hash_workers=config['TRANSFER']['hash_workers'],
+    ):
+        self.bucket_name = bucket_name.replace('gs://', '').strip('/')
+        self.max_workers = int(max_workers)
+        self.max_inflight = int(float(max_inflight_mb) * 1024 ** 2)
+        self.composite_threshold = int(float(composite_threshold_mb) * 1024 ** 2)
+        self.composite_slices = min(int(composite_slices), max_compose_sources)
+        self.sliced_download_threshold = int(float(sliced_download_threshold_mb) * 1024 ** 2)
+        self.sliced_download_slices = int(sliced_download_slices)
+        self.hash_workers = int(hash_workers)
+
+        self._local = threading.local()
+        # Shared by all large files so slice uploads reuse connections
+        self._slice_executor = None
+        self._budget = threading.Condition()
+        self._inflight = 0
+        self._progress_lock = threading.Lock()
+        self._last_progress = 0
+
+    def bucket(self):
+        # storage.Client is not guaranteed to be thread safe, so keep one per worker thread
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            bucket = get_storage_client().bucket(self.bucket_name)
+            self._local.bucket = bucket
+        return bucket
+
+    def _acquire(self, size):
+        with self._budget:
+            # A file larger than the whole budget is still allowed through on its own
+            while self._inflight and self._inflight + size > self.max_inflight:
+                self._budget.wait()
+            self._inflight += size
+
+    def _release(self, size):
+        with self._budget:
+            self._inflight -= size
+            self._budget.notify_all()
+
+    def _show_progress(self, report):
+        now = time.time()
+        if now - self._last_progress >= 1:
+            self._last_progress = now
+            sys.stdout.write('\r' + report.progress_line())
+            sys.stdout.flush()
+
+    def _run_task(self, action, task, report):
+        try:
+            action(self.bucket(), task)
+        except Exception as e:
+            with self._progress_lock:
+                report.failures.append((task, e))
+        else:
+            with self._progress_lock:
+                report.done_files += 1
+                report.done_bytes += task.size
+                self._show_progress(report)
+        finally:
+            self._release(task.size)
+
+    def run(self, tasks, action, verb='Transferred'):
+        """
+        Apply action(bucket, task) to every task using the worker pool.
+        :param tasks: list of TransferTask
+        :param action: function moving a single file
+        :param verb: used in progress output
+        :return: TransferReport
+        """
+        report = TransferReport(tasks, verb=verb)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # Largest files first so they do not end up as a long tail
+            for task in sorted(tasks, key=lambda t: t.size, reverse=True):
+                self._acquire(task.size)
+                executor.submit(self._run_task, action, task, report)
+            executor.shutdown(wait=True)
+        except KeyboardInterrupt:
+            # Drop queued slices first, as files in progress wait on them, then queued files,
+            # and only wait for what is already running
+            if self._slice_executor is not None:
+                self._slice_executor.shutdown(wait=False, cancel_futures=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            if self._slice_executor is not None:
+                self._slice_executor.shutdown(wait=True, cancel_futures=True)
+                self._slice_executor = None
+            report.end_time = time.time()
+            # End the progress line, summary is left to the caller
+            if self._last_progress:
+                print('')
+
+        return report
+
+    def slice_executor(self):
+        if self._slice_executor is None:
+            self._slice_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._slice_executor
+
+    def upload_task(self, bucket, task):
+        # Large files are split into slices uploaded in parallel, small files use a single stream
+        if self.composite_slices > 1 and task.size >= self.composite_threshold:
+            return self.upload_composite(task)
+        return upload_file(bucket, task)
+
+    def upload(self, tasks, after_upload=None):
+        """
+        Upload tasks, verifying each object against the local CRC32C.
+
+        Files without a checksum are hashed (and their size and time checked again, see
+        refresh_task) in a separate pool of hash_workers threads, in the same order as they are
+        uploaded (largest first), so hashing stays ahead of the uploads.
+        :param tasks: list of TransferTask
+        :param after_upload: function called with (task, blob) for every uploaded file, task.crc32c
+        being the local checksum
+        :return: TransferReport
+        """
+        hash_executor = ThreadPoolExecutor(max_workers=self.hash_workers)
+        hashes = {}
+        try:
+            for task in sorted(tasks, key=lambda t: t.size, reverse=True):
+                if task.crc32c is None:
+                    hashes[task.object_name] = hash_executor.submit(refresh_task, task, crc32c=True)
+
+            def upload_hashed(bucket, task):
+                if task.crc32c is None:
+                    task = hashes[task.object_name].result()
+                blob = self.upload_task(bucket, task)
+                if after_upload is not None:
+                    after_upload(task, blob)
+
+            return self.run(tasks, upload_hashed, verb='Uploaded')
+        finally:
+            hash_executor.shutdown(wait=True, cancel_futures=True)
+
+    def _upload_slice(self, task, state, index, offset, length):
+        blob = self.bucket().blob(state.slice_name(index))
+        with open(task.local_path, 'rb') as f:
+            f.seek(offset)
+            blob.upload_from_file(f, size=length)
+        state.mark_done(index, blob.crc32c)
+
+    def upload_composite(self, task):
+        """
+        Upload one file as parallel slices and compose them into the final object.
+
+        Completed slices are recorded on disk, so an interrupted upload of the same
+        (unchanged) file only sends the missing slices when run again.
+        :param task: TransferTask
+        :return: composed blob
+        """
+        bucket = self.bucket()
+        # Slices are cut from the planned size, so a file rewritten since would be truncated
+        if os.path.getsize(task.local_path) != task.size:
+            raise RuntimeError('{} changed size since the upload was planned.'.format(task.local_path))
+        slice_size = -(-task.size // self.composite_slices)
+        state = CompositeUploadState(self.bucket_name, task, slice_size)
+
+        # Only trust slices that are still in the bucket
+        if state.completed:
+            existing = {blob.name: blob.crc32c for blob in
+                        bucket.list_blobs(prefix=state.prefix, fields='items(name,crc32c),nextPageToken')}
+            state.completed = {i: crc32c for i, crc32c in state.completed.items()
+                               if existing.get(state.slice_name(i)) == crc32c}
+
+        offsets = range(0, task.size, slice_size)
+        futures = []
+        for index, offset in enumerate(offsets):
+            if index not in state.completed:
+                futures.append(self.slice_executor().submit(self._upload_slice, task, state, index, offset,
+                                                            min(slice_size, task.size - offset)))
+        for future in futures:
+            future.result()
+
+        sources = [bucket.blob(state.slice_name(i)) for i in range(len(offsets))]
+        blob = bucket.blob(task.object_name)
+        blob.compose(sources)
+        if task.crc32c is not None and blob.crc32c != task.crc32c:
+            raise RuntimeError('Checksum mismatch after upload (local {}, bucket {}).'.format(task.crc32c,
+                                                                                             blob.crc32c))
+        # Clean up slices and saved progress
+        for source in sources:
+            source.delete()
+        state.clear()
+
+        return blob
+
+    def download(self, tasks):
+        return self.run(tasks, self.download_task, verb='Downloaded')
+
+    def download_task(self, bucket, task):
+        """
+        Download one object, as parallel byte ranges if it is large.
+
+        Data is written to a .part file that is only renamed once complete, so an existing
+        file of the right size can be trusted on later runs.
+        :param bucket:
+        :param task: TransferTask
+        """
+        local_dir = os.path.dirname(task.local_path)
+        if local_dir:
+            os.makedirs(local_dir, exist_ok=True)
+        part_path = task.local_path + '.part'
+
+        if self.sliced_download_slices > 1 and task.size >= self.sliced_download_threshold:
+            slice_size = -(-task.size // self.sliced_download_slices)
+            with open(part_path, 'wb') as f:
+                f.truncate(task.size)
+            futures = [self.slice_executor().submit(self._download_slice, task, part_path, start,
+                                                    min(start + slice_size, task.size) - 1)
+                       for start in range(0, task.size, slice_size)]
+            for future in futures:
+                future.result()
+            # Ranged downloads are not checksummed by the client library, so check the whole file
+            if task.crc32c is not None and file_crc32c(part_path) != task.crc32c:
+                raise RuntimeError('Checksum mismatch after download of {}.'.format(task.object_name))
+        else:
+            bucket.blob(task.object_name).download_to_filename(part_path)
+
+        os.replace(part_path, task.local_path)
+
+    def _download_slice(self, task, part_path, start, end):
+        blob = self.bucket().blob(task.object_name)
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            # end is inclusive
+            blob.download_to_file(f, start=start, end=end)
+
+class CompositeUploadState(object):
+    """
+    Slices of a parallel composite upload that have already been uploaded, saved to disk.
+    """
+    def __init__(self, bucket_name, task, slice_size):
+        key = hashlib.sha1('{}/{}'.format(bucket_name, task.object_name).encode('utf-8')).hexdigest()
+        self.path = os.path.join(upload_state_dir, '{}.json'.format(key))
+        self.prefix = '{}/{}/'.format(composite_prefix, key)
+        self.source = {
+            'local_path': task.local_path,
+            'size': task.size,
+            'mtime': task.mtime,
+            'slice_size': slice_size,
+        }
+        self.completed = {}  # slice index -> crc32c
+        self._lock = threading.Lock()
+
+        # Saved progress only applies if the local file is unchanged
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('source') == self.source:
+                self.completed = {int(i): crc32c for i, crc32c in saved['completed'].items()}
+
+    def slice_name(self, index):
+        return '{}{:02d}'.format(self.prefix, index)
+
+    def mark_done(self, index, crc32c):
+        with self._lock:
+            self.completed[index] = crc32c
+            os.makedirs(upload_state_dir, exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump({'source': self.source, 'completed': self.completed}, f)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def upload_file(bucket, task):
+    blob = bucket.blob(task.object_name)
+    blob.upload_from_filename(task.local_path)
+    # Verify against the local checksum if one was computed
+    if task.crc32c is not None and blob.crc32c != task.crc32c:
+        raise RuntimeError('Checksum mismatch after upload (local {}, bucket {}).'.format(task.crc32c,
+                                                                                         blob.crc32c))
+    return blob
+
+def refresh_task(task, crc32c=False):
+    """
+    Task with the current size and modification time of its file (eg. planned from the library
+    index, which does not notice files rewritten in place).
+    :param task: TransferTask
+    :param crc32c: also compute the checksum of the file
+    :return: TransferTask
+    """
+    stat = os.stat(task.local_path)
+    task = task._replace(size=stat.st_size, mtime=stat.st_mtime)
+    if crc32c:
+        task = task._replace(crc32c=file_crc32c(task.local_path))
+    return task
+
+def file_crc32c(path, chunk_size=8 * 1024 ** 2):
+    # Base64 encoded CRC32C, same format as bucket object metadata
+    import google_crc32c
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+class UploadManifest(object):
+    """
+    Local record of library files uploaded to a bucket.
+
+    Entries are keyed by library and path within the library, and hold the size, mtime
+    and crc32c of the local file at the time it was uploaded (or verified).
+    """
+    def __init__(self, bucket_name, path=None):
+        self.bucket_name = bucket_name.replace('gs://', '').strip('/')
+        self.path = path or os.path.join(manifest_dir, '{}.json'.format(self.bucket_name))
+        self.libraries = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.libraries = json.load(f).get('libraries', {})
+
+    @staticmethod
+    def key(task):
+        # Path of object relative to libraries/<lib>/
+        return task.object_name[len('libraries/{}/'.format(task.library)):]
+
+    def get(self, task):
+        return self.libraries.get(task.library, {}).get(self.key(task))
+
+    def record(self, task, crc32c):
+        with self._lock:
+            self.libraries.setdefault(task.library, {})[self.key(task)] = {
+                'size': task.size,
+                'mtime': task.mtime,
+                'crc32c': crc32c,
+            }
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        # Write to temporary file first so an interrupted save does not corrupt the manifest
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            with open(tmp_path, 'w') as f:
+                json.dump({'bucket': self.bucket_name, 'libraries': self.libraries}, f)
+        os.replace(tmp_path, self.path)
+
+def list_library_objects(bucket, library):
+    # Size and crc32c of all objects under libraries/<lib>/, keyed by object name
+    blobs = bucket.list_blobs(prefix='libraries/{}/'.format(library),
+                              fields='items(name,size,crc32c),nextPageToken')
+    return {blob.name: blob for blob in blobs}
+
+def reconcile_uploads(
+    tasks,
+    engine,
+    manifest,
+    hash_workers=config['TRANSFER']['hash_workers'],
+):
+    """
+    Split tasks into files that still need uploading and files already in the bucket.
+
+    Files whose size and mtime match the manifest, and whose manifest checksum matches the
+    bucket object, are skipped without being read. Files found in the bucket with the same
+    size but not confirmed by the manifest are hashed in parallel and skipped if the
+    checksums agree. Other files are hashed while uploading (see TransferEngine.upload).
+    :param tasks: list of TransferTask
+    :param engine: TransferEngine (provides bucket connections)
+    :param manifest: UploadManifest
+    :param hash_workers: number of files hashed concurrently
+    :return: (tasks to upload, skipped tasks)
+    """
+    libraries = sorted(set(task.library for task in tasks))
+    with ThreadPoolExecutor(max_workers=int(hash_workers)) as executor:
+        remote = {}
+        for objects in executor.map(lambda lib: list_library_objects(engine.bucket(), lib), libraries):
+            remote.update(objects)
+
+        # Files already in the bucket may be skipped on their size and time, so check those again
+        # (files not in the bucket get checked when hashed for upload)
+        tasks = list(executor.map(lambda t: refresh_task(t) if t.object_name in remote else t, tasks))
+
+        to_upload, skipped, to_hash = [], [], []
+        for task in tasks:
+            blob = remote.get(task.object_name)
+            entry = manifest.get(task)
+            if blob is None or blob.size != task.size:
+                # New or changed file
+                to_upload.append(task)
+            elif (entry is not None and entry['size'] == task.size and entry['mtime'] == task.mtime
+                  and entry['crc32c'] == blob.crc32c):
+                skipped.append(task)
+            else:
+                to_hash.append(task)
+
+        hashes = executor.map(lambda t: file_crc32c(t.local_path), to_hash)
+        for task, crc32c in zip(to_hash, hashes):
+            task = task._replace(crc32c=crc32c)
+            if crc32c == remote[task.object_name].crc32c:
+                manifest.record(task, crc32c)
+                skipped.append(task)
+            else:
+                to_upload.append(task)
+
+    return to_upload, skipped
+
+def library_tasks(library, entry):
+    """
+    Files to upload for a library, from its library index entry (see scan_library).
+    :param library:
+    :param entry:
+    :return: list of TransferTask
+    """
+    for path in entry['missing']:
+        warnings.warn('{} not found and is being skipped.'.format(path), RuntimeWarning)
+    return [TransferTask(library=library,
+                         local_path=record['path'],
+                         object_name=record['object_name'],
+                         size=record['size'],
+                         mtime=record['mtime'],
+                         crc32c=None) for record in entry['files']]
+
+def upload_libraries(
+    libraries,
+    bucket_name=config['GCP']['bucket'],
+    library_dir=config['LOCAL']['lib_dir_sc'],
+    max_workers=config['TRANSFER']['max_workers'],
+    max_inflight_mb=config['TRANSFER']['max_inflight_mb'],
+    hash_workers=config['TRANSFER']['hash_workers'],
+    force=False,
+    rescan=False,
+):
+    """
+    Upload all files of one or more libraries through a single worker pool.
+
+    Libraries and their files are found with the library index (see LibraryIndex), so unchanged
+    libraries are not scanned again. Files already in the bucket are skipped (see reconcile_uploads)
+    unless force is set.
+    :param libraries: list of library names or glob patterns (eg. "*BICCN*")
+    :param bucket_name:
+    :param library_dir:
+    :param max_workers: number of files transferred concurrently
+    :param max_inflight_mb: upper bound on combined size of files in flight
+    :param hash_workers: number of files hashed concurrently (to check the bucket and verify uploads)
+    :param force: upload all files even if already in the bucket
+    :param rescan: scan all libraries again instead of using the index
+    :return: TransferReport
+    """
+    index = LibraryIndex(library_dir)
+    names = index.select(libraries)
+    if not names:
+        raise RuntimeError('No libraries in {} to upload.'.format(library_dir))
+    tasks = []
+    for lib, entry in index.scan(names, refresh=rescan).items():
+        if entry['layout'] is None:
+            warnings.warn('Library {} does not have a recognized output format (10x, jp)'.format(lib) +
+                          ' and is being skipped.', RuntimeWarning)
+            continue
+        tasks.extend(library_tasks(lib, entry))
+
+    engine = TransferEngine(bucket_name=bucket_name,
+                            max_workers=max_workers,
+                            max_inflight_mb=max_inflight_mb,
+                            hash_workers=hash_workers)
+    manifest = UploadManifest(engine.bucket_name)
+
+    if not force:
+        tasks, skipped = reconcile_uploads(tasks, engine, manifest, hash_workers=hash_workers)
+        if skipped:
+            print('Skipping {} files ({}) already in gs://{}/libraries/.'.format(
+                len(skipped), format_bytes(sum(task.size for task in skipped)), engine.bucket_name))
+
+    if not tasks:
+        print('All files are already in gs://{}/libraries/.'.format(engine.bucket_name))
+        return TransferReport(tasks, verb='Uploaded')
+
+    print('Uploading {} files ({}) from {} libraries to gs://{}/libraries/.'.format(
+        len(tasks), format_bytes(sum(task.size for task in tasks)), len(set(task.library for task in tasks)),
+        engine.bucket_name))
+    try:
+        # Record the local checksum, which the bucket object was verified against
+        report = engine.upload(tasks, after_upload=lambda task, blob: manifest.record(task, task.crc32c))
+    finally:
+        # Keep record of completed files even if interrupted
+        manifest.save()
+    print(report.summary())
+
+    return report
+
+def list_bucket_libraries(bucket):
+    # Names of all libraries under libraries/ in bucket
+    iterator = bucket.list_blobs(prefix='libraries/', delimiter='/', fields='prefixes,nextPageToken')
+    for page in iterator.pages:
+        pass
+    return sorted(prefix[len('libraries/'):].strip('/') for prefix in iterator.prefixes)
+
+def pull_libraries(
+    libraries,
+    bucket_name=config['GCP']['bucket'],
+    dest_dir=instance_lib_dir,
+    max_workers=config['TRANSFER']['max_workers'],
+    max_inflight_mb=config['TRANSFER']['max_inflight_mb'],
+):
+    """
+    Download libraries from gs://<bucket>/libraries/ to a local directory (meant to run on an instance).
+
+    Files already present with the expected size are skipped, so interrupted runs can be repeated.
+    :param libraries: list of library names or glob patterns (eg. "*BICCN*")
+    :param bucket_name:
+    :param dest_dir:
+    :param max_workers: number of files transferred concurrently
+    :param max_inflight_mb: upper bound on combined size of files in flight
+    :return: TransferReport
+    """
+    engine = TransferEngine(bucket_name=bucket_name,
+                            max_workers=max_workers,
+                            max_inflight_mb=max_inflight_mb)
+
+    # Expand patterns against the libraries in the bucket
+    available = None
+    names = []
+    for lib in libraries:
+        if glob.has_magic(lib):
+            if available is None:
+                available = list_bucket_libraries(engine.bucket())
+            matches = fnmatch.filter(available, lib)
+            if not matches:
+                warnings.warn('No libraries in gs://{}/libraries/ match {}.'.format(engine.bucket_name, lib),
+                              RuntimeWarning)
+            names.extend(m for m in matches if m not in names)
+        elif lib not in names:
+            names.append(lib)
+
+    tasks, present = [], []
+    with ThreadPoolExecutor(max_workers=engine.max_workers) as executor:
+        listings = executor.map(lambda lib: list_library_objects(engine.bucket(), lib), names)
+        for lib, objects in zip(names, listings):
+            if not objects:
+                warnings.warn('Library {} not found in gs://{}/libraries/ and is being skipped.'.format(
+                    lib, engine.bucket_name), RuntimeWarning)
+                continue
+            missing = []
+            for name, blob in sorted(objects.items()):
+                # Skip placeholder objects for directories
+                if name.endswith('/'):
+                    continue
+                local_path = os.path.join(dest_dir, *name[len('libraries/'):].split('/'))
+                if os.path.isfile(local_path) and os.path.getsize(local_path) == blob.size:
+                    continue
+                missing.append(TransferTask(library=lib,
+                                            local_path=local_path,
+                                            object_name=name,
+                                            size=blob.size,
+                                            mtime=None,
+                                            crc32c=blob.crc32c))
+            if missing:
+                tasks.extend(missing)
+            else:
+                present.append(lib)
+
+    if present:
+        print('Skipping {} libraries already in {}.'.format(len(present), dest_dir))
+    if not tasks:
+        print('All requested libraries are already in {}.'.format(dest_dir))
+        return TransferReport(tasks, verb='Downloaded')
+
+    print('Downloading {} files ({}) from {} libraries to {}.'.format(
+        len(tasks), format_bytes(sum(task.size for task in tasks)), len(set(task.library for task in tasks)),
+        dest_dir))
+    report = engine.download(tasks)
+    print(report.summary())
+
+    return report
+
 def upload_libraries_10x(
     libraries,
     bucket_name=config['GCP']['bucket'],
@@ -21,28 +675,14 @@ def upload_libraries_10x(
 ):
     """
     Currently only supports 10x libraries generated with v>=3.
-    :param libraries:
+    :param libraries: single library name
     :param bucket_name:
     :param library_dir:
-    :return:
-    """
-    # Add prefix if necessary
-    if 'gs://' not in bucket_name:
-        bucket_name = 'gs://' + bucket_name
-
-    # Series of gsutil calls because rsync exclude functionality doesn't work...
-    gsutil_args = ['gsutil', 'cp', '{}/{}/outs/raw_feature_bc_matrix.h5'.format(library_dir, libraries),
-                    '{}/libraries/{}/outs/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '{}/{}/outs/filtered_feature_bc_matrix.h5'.format(library_dir, libraries),
-                   '{}/libraries/{}/outs/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '-r', '{}/{}/outs/raw_feature_bc_matrix/'.format(library_dir, libraries),
-                   '{}/libraries/{}/outs/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '-r', '{}/{}/outs/filtered_feature_bc_matrix/'.format(library_dir, libraries),
-                   '{}/libraries/{}/outs/'.format(bucket_name, libraries)]
-    call(gsutil_args)
+    :return: TransferReport
+    """
+    engine = TransferEngine(bucket_name=bucket_name)
+    entry = scan_library(library_dir, libraries, layout='10x')
+    return engine.upload(library_tasks(libraries, entry))
 
 def upload_libraries_jp(
     libraries,
@@ -51,43 +691,11 @@ def upload_libraries_jp(
 ):
     """
 
-    :param libraries:
+    :param libraries: single library name
     :param bucket_name:
     :param library_dir:
-    :return:
-    """
-    # Add prefix if necessary
-    if 'gs://' not in bucket_name:
-        bucket_name = 'gs://' + bucket_name
-
-    # Series of gsutil calls because rsync exclude functionality doesn't always work...
-    gsutil_args = ['gsutil', 'cp', '{}/{}/*/alignment/*digital_expression_matrix*'.format(library_dir, libraries),
-                    '{}/libraries/{}/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '{}/{}/*/alignment/*digital_expression_barcodes*'.format(library_dir, libraries),
-                   '{}/libraries/{}/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '{}/{}/*/alignment/*digital_expression_features*'.format(library_dir, libraries),
-                   '{}/libraries/{}/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-    gsutil_args = ['gsutil', 'cp', '{}/{}/*/alignment/*digital_expression_summary*'.format(library_dir, libraries),
-                   '{}/libraries/{}/'.format(bucket_name, libraries)]
-    call(gsutil_args)
-
-# def upload_file(
-#     source_file_name,
-#     destination_name,
-#     bucket_name=BUCKET,
-# ):
-#     """
-#     Uploads a file to the bucket.
-#     """
-#     # bucket_name = "your-bucket-name"
-#     # source_file_name = "local/path/to/file"
-#     # destination_blob_name = "storage-object-name"
-#
-#     storage_client = storage.Client()
-#     bucket = storage_client.bucket(bucket_name)
-#     blob = bucket.blob(destination_name)
-#
-#     blob.upload_from_filename(source_file_name)
\ No newline at end of file
+    :return: TransferReport
+    """
+    engine = TransferEngine(bucket_name=bucket_name)
+    entry = scan_library(library_dir, libraries, layout='jp')
+    return engine.upload(library_tasks(libraries, entry))
@@ -4,6 +4,11 @@
 """
 Helper functions for lab_sc_gcp module.
 """
+import os
+
+def package_path(*parts):
+    # Path to file shipped with the package (cheaper than pkg_resources, which is slow to import)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
 
 def get_full_inst_name(name, user):
     # Append user to instance name if necessary
@@ -11,6 +16,22 @@ def get_full_inst_name(name, user):
         name = '{}-{}'.format(name, user)
     return name
 
+def format_bytes(num_bytes):
+    # Human readable size, eg. 1.5 GB
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num_bytes) < 1024 or unit == 'TB':
+            break
+        num_bytes /= 1024.0
+    return '{:.1f} {}'.format(num_bytes, unit)
+
+def format_table(rows, headers):
+    # Plain text table with columns padded to the widest value
+    rows = [['' if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+             for row in [list(headers)] + rows]
+    return '\n'.join(lines)
+
 def confirm(prompt):
     while True:
         answer = input(prompt + ' (y/n): ').lower().strip()
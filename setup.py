@@ -17,7 +17,11 @@ setup(
       install_requires=[
           'google-api-python-client',
           'google-cloud-storage',
+          'google-crc32c',
       ],
+      extras_require={
+          'zstd': ['zstandard'],
+      },
       entry_points={
             'console_scripts': ['lab-gcp=lab_sc_gcp.cli:main'],
       },